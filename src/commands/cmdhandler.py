@@ -35,7 +35,8 @@ command line. The process is as follows:
 
 """
 
-from weakref import WeakValueDictionary
+from weakref import WeakKeyDictionary
+from collections import OrderedDict
 from copy import copy
 from traceback import format_exc
 from twisted.internet.defer import inlineCallbacks, returnValue
@@ -44,12 +45,35 @@ from src.comms.channelhandler import CHANNELHANDLER
 from src.utils import logger, utils
 from src.commands.cmdparser import at_multimatch_cmd
 from src.utils.utils import string_suggestions, to_unicode
+from src.utils.dbserialize import is_current_dbobj
 
 from django.utils.translation import ugettext as _
 
 __all__ = ("cmdhandler",)
 _GA = object.__getattribute__
-_CMDSET_MERGE_CACHE = WeakValueDictionary()
+
+# merged cmdsets, keyed on the identities of the merged cmdsets. This is
+# an LRU cache limited to settings.CMDSET_MERGE_CACHE_SIZE entries.
+_CMDSET_MERGE_CACHE = OrderedDict()
+_CMDSET_MERGE_CACHE_SIZE = settings.CMDSET_MERGE_CACHE_SIZE
+# per-caller merged cmdsets, keyed on the caller's cmdsethandler
+_CALLER_CMDSET_CACHE = WeakKeyDictionary()
+
+
+def _is_current(obj):
+    """
+    Check that obj, a typeclass fetched earlier, is still the one in
+    use: its database object was not flushed from the idmapper cache
+    (and possibly reloaded as a new instance) and it has not had its
+    typeclass swapped.
+    """
+    try:
+        dbobj = _GA(obj, "dbobj")
+    except AttributeError:
+        return False
+    if dbobj is not obj and _GA(dbobj, "_cached_typeclass") is not obj:
+        return False
+    return is_current_dbobj(dbobj)
 
 # This decides which command parser is to be used.
 # You have to restart the server for changes to take effect.
@@ -89,6 +113,52 @@ class ExecSystemCommand(Exception):
 # Helper function
 
 
+def _merge_cmdsets(cmdsets):
+    """
+    Merge a list of cmdsets into one, using the bounded merge cache.
+    The cache is keyed on the identity of the cmdsets involved; since
+    each entry keeps its source cmdsets alive, their id()s cannot be
+    reused by other cmdsets for as long as the merger remains cached.
+    """
+    # faster to do tuple on list than to build tuple directly
+    mergehash = tuple([id(cmdset) for cmdset in cmdsets])
+    cached = _CMDSET_MERGE_CACHE.pop(mergehash, None)
+    if cached:
+        # cached merge exist; use that (re-inserting marks it as recent)
+        _CMDSET_MERGE_CACHE[mergehash] = cached
+        return cached[1]
+
+    # we group and merge all same-prio cmdsets separately (this avoids
+    # order-dependent clashes in certain cases, such as
+    # when duplicates=True)
+    tempmergers = {}
+    for cmdset in cmdsets:
+        prio = cmdset.priority
+        #print cmdset.key, prio
+        if prio in tempmergers:
+            # merge same-prio cmdset together separately
+            tempmergers[prio] = cmdset + tempmergers[prio]
+        else:
+            tempmergers[prio] = cmdset
+
+    # sort cmdsets after reverse priority (highest prio are merged in last)
+    mergers = sorted(tempmergers.values(), key=lambda x: x.priority)
+
+    # Merge all command sets into one, beginning with the lowest-prio one
+    cmdset = mergers[0]
+    for merging_cmdset in mergers[1:]:
+        #print "<%s(%s,%s)> onto <%s(%s,%s)>" % (merging_cmdset.key, merging_cmdset.priority, merging_cmdset.mergetype,
+        #                                        cmdset.key, cmdset.priority, cmdset.mergetype)
+        cmdset = merging_cmdset + cmdset
+    # store the full sets for diagnosis
+    cmdset.merged_from = mergers
+    # cache, dropping the least recently used merger if full
+    _CMDSET_MERGE_CACHE[mergehash] = (tuple(cmdsets), cmdset)
+    if len(_CMDSET_MERGE_CACHE) > _CMDSET_MERGE_CACHE_SIZE:
+        _CMDSET_MERGE_CACHE.popitem(last=False)
+    return cmdset
+
+
 @inlineCallbacks
 def get_and_merge_cmdsets(caller, session, player, obj,
                           callertype, sessid=None):
@@ -105,9 +175,28 @@ def get_and_merge_cmdsets(caller, session, player, obj,
     cmdset is merged last (and will thus take precedence over
     same-named and same-prio commands on Player and Session).
 
+    The merged cmdset is cached per caller together with the version
+    stamps of all cmdsethandlers and contents involved. As long as
+    none of those change (the cmdsets are not added/deleted, nothing
+    enters or leaves the room etc), the room contents are not queried
+    and no merging takes place. The at_cmdset_get hooks and the
+    'call'-lock checks are still run for every call.
+
     Note that this function returns a deferred!
     """
     local_obj_cmdsets = [None]
+    # version stamps of everything making up the merged cmdset
+    versions = []
+    # gathered room contents (location, version stamps, object list)
+    gathered = [None]
+
+    try:
+        caller_cache = _CALLER_CMDSET_CACHE.setdefault(caller.cmdset, {})
+    except (AttributeError, TypeError):
+        # caller has no cmdsethandler to cache on
+        caller_cache = {}
+    cache_key = (callertype, session.sessid if session else sessid)
+    cached = caller_cache.get(cache_key)
 
     @inlineCallbacks
     def _get_channel_cmdsets(player, player_cmdset):
@@ -116,6 +205,7 @@ def get_and_merge_cmdsets(caller, session, player, obj,
         channel_cmdset = None
         if not player_cmdset.no_channels:
             channel_cmdset = yield CHANNELHANDLER.get_cmdset(player)
+        versions.append(channel_cmdset)
         returnValue(channel_cmdset)
 
     @inlineCallbacks
@@ -129,10 +219,18 @@ def get_and_merge_cmdsets(caller, session, player, obj,
             location = None
         if location and not obj_cmdset.no_objs:
             # Gather all cmdsets stored on objects in the room and
-            # also in the caller's inventory and the location itself
-            local_objlist = yield (location.contents_get(exclude=obj.dbobj) +
-                                   obj.contents +
-                                   [location])
+            # also in the caller's inventory and the location itself.
+            # The contents are only re-queried if they changed.
+            contents_key = (location.dbobj, location.contents_version,
+                            obj.contents_version)
+            if (cached and cached[1] and cached[1][0] == contents_key
+                    and all(_is_current(lobj) for lobj in cached[1][1])):
+                local_objlist = cached[1][1]
+            else:
+                local_objlist = yield (location.contents_get(exclude=obj.dbobj) +
+                                       obj.contents +
+                                       [location])
+            gathered[0] = (contents_key, local_objlist)
             for lobj in local_objlist:
                 try:
                     # call hook in case we need to do dynamic changing to cmdset
@@ -142,15 +240,11 @@ def get_and_merge_cmdsets(caller, session, player, obj,
             # the call-type lock is checked here, it makes sure a player
             # is not seeing e.g. the commands on a fellow player (which is why
             # the no_superuser_bypass must be True)
-            local_obj_cmdsets = \
-                yield [lobj.cmdset.current for lobj in local_objlist
-                   if (lobj.cmdset.current and
-                   lobj.locks.check(caller, 'call', no_superuser_bypass=True))]
-            for cset in local_obj_cmdsets:
-                #This is necessary for object sets, or we won't be able to
-                # separate the command sets from each other in a busy room.
-                cset.old_duplicates = cset.duplicates
-                cset.duplicates = True
+            local_objlist = [lobj for lobj in local_objlist
+                             if (lobj.cmdset.current and
+                             lobj.locks.check(caller, 'call', no_superuser_bypass=True))]
+            versions.append(tuple(lobj.cmdset.version for lobj in local_objlist))
+            local_obj_cmdsets = yield [lobj.cmdset.current for lobj in local_objlist]
         returnValue(local_obj_cmdsets)
 
     @inlineCallbacks
@@ -161,7 +255,9 @@ def get_and_merge_cmdsets(caller, session, player, obj,
         except Exception:
             logger.log_trace()
         try:
-            returnValue(obj.cmdset.current)
+            cmdsethandler = obj.cmdset
+            versions.append(cmdsethandler.version)
+            returnValue(cmdsethandler.current)
         except AttributeError:
             returnValue(None)
 
@@ -206,44 +302,26 @@ def get_and_merge_cmdsets(caller, session, player, obj,
     yield [report_to.msg(cmdset.errmessage) for cmdset in cmdsets
            if cmdset.key == "_CMDSET_ERROR"]
 
-    if cmdsets:
-        # faster to do tuple on list than to build tuple directly
-        mergehash = tuple([id(cmdset) for cmdset in cmdsets])
-        if mergehash in _CMDSET_MERGE_CACHE:
-            # cached merge exist; use that
-            cmdset = _CMDSET_MERGE_CACHE[mergehash]
-        else:
-            # we group and merge all same-prio cmdsets separately (this avoids
-            # order-dependent clashes in certain cases, such as
-            # when duplicates=True)
-            tempmergers = {}
-            for cmdset in cmdsets:
-                prio = cmdset.priority
-                #print cmdset.key, prio
-                if prio in tempmergers:
-                    # merge same-prio cmdset together separately
-                    tempmergers[prio] = yield cmdset + tempmergers[prio]
-                else:
-                    tempmergers[prio] = cmdset
-
-            # sort cmdsets after reverse priority (highest prio are merged in last)
-            cmdsets = yield sorted(tempmergers.values(), key=lambda x: x.priority)
-
-            # Merge all command sets into one, beginning with the lowest-prio one
-            cmdset = cmdsets[0]
-            for merging_cmdset in cmdsets[1:]:
-                #print "<%s(%s,%s)> onto <%s(%s,%s)>" % (merging_cmdset.key, merging_cmdset.priority, merging_cmdset.mergetype,
-                #                                        cmdset.key, cmdset.priority, cmdset.mergetype)
-                cmdset = yield merging_cmdset + cmdset
-            # store the full sets for diagnosis
-            cmdset.merged_from = cmdsets
-            # cache
-            _CMDSET_MERGE_CACHE[mergehash] = cmdset
+    versions = tuple(versions)
+    if cached and cached[0] == versions:
+        # nothing changed since last time; re-use the merged set
+        cmdset = cached[2]
+    elif cmdsets:
+        local_obj_cmdsets = [cset for cset in local_obj_cmdsets if cset]
+        for cset in local_obj_cmdsets:
+            #This is necessary for object sets, or we won't be able to
+            # separate the command sets from each other in a busy room.
+            cset.old_duplicates = cset.duplicates
+            cset.duplicates = True
+        try:
+            cmdset = yield _merge_cmdsets(cmdsets)
+        finally:
+            for cset in local_obj_cmdsets:
+                cset.duplicates = cset.old_duplicates
+        caller_cache[cache_key] = (versions, gathered[0], cmdset)
     else:
         cmdset = None
-
-    for cset in (cset for cset in local_obj_cmdsets if cset):
-        cset.duplicates = cset.old_duplicates
+        caller_cache.pop(cache_key, None)
     #print "merged set:", cmdset.key
     returnValue(cmdset)
 
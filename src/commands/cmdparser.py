@@ -51,17 +51,22 @@ def cmdparser(raw_string, cmdset, caller, match_index=None):
 
     matches = []
 
-    # match everything that begins with a matching cmdname.
+    # match everything that begins with a matching cmdname. We walk
+    # the cmdset's prefix trie along the input, so each step gives all
+    # command names that are exactly that long.
     l_raw_string = raw_string.lower()
-    for cmd in cmdset:
-        try:
-            matches.extend([create_match(cmdname, raw_string, cmd)
-                      for cmdname in [cmd.key] + cmd.aliases
-                        if cmdname and l_raw_string.startswith(cmdname.lower())
-                           and (not cmd.arg_regex or
-                             cmd.arg_regex.match(l_raw_string[len(cmdname):]))])
-        except Exception:
-            log_trace("cmdhandler error. raw_input:%s" % raw_string)
+    node = cmdset.get_cmdname_trie()
+    for char in l_raw_string:
+        node = node.get(char)
+        if node is None:
+            break
+        for cmdname, cmd in node.get(None, ()):
+            try:
+                if (not cmd.arg_regex or
+                        cmd.arg_regex.match(l_raw_string[len(cmdname):])):
+                    matches.append(create_match(cmdname, raw_string, cmd))
+            except Exception:
+                log_trace("cmdhandler error. raw_input:%s" % raw_string)
 
     if not matches:
         # no matches found.
@@ -14,8 +14,8 @@ See CmdHandler for practical examples on how to apply cmdsets
 together to create interesting in-game effects.
 """
 
-from weakref import WeakKeyDictionary
 from django.utils.translation import ugettext as _
+from src.utils import logger
 from src.utils.utils import inherits_from, is_iter
 __all__ = ("CmdSet",)
 
@@ -139,6 +139,12 @@ class CmdSet(object):
     to_duplicate = ("key", "cmdsetobj", "no_exits", "no_objs",
                     "no_channels", "permanent", "mergetype",
                     "priority", "duplicates", "errmessage")
+    # cached (commands, ncommands, trie), see get_cmdname_trie()
+    _cmdname_trie = None
+    # cached (commands, ncommands, keytable, nametable), see _get_cmd_tables()
+    _cmd_tables = None
+    # the last merger made with this set as A, see __add__()
+    _merge_memo = None
 
     def __init__(self, cmdsetobj=None, key=None):
         """
@@ -160,7 +166,6 @@ class CmdSet(object):
 
         # initialize system
         self.at_cmdset_creation()
-        self._contains_cache = WeakKeyDictionary()#{}
 
     # Priority-sensitive merge operations for cmdsets
 
@@ -205,11 +210,46 @@ class CmdSet(object):
         and not, say a cmdclass. If it is, instantiate it.
         Other types, like strings, are passed through.
         """
+        if not callable(cmd):
+            # the common case - already an instance (or a string)
+            return cmd
         try:
             return cmd()
         except TypeError:
             return cmd
 
+    def _get_cmd_tables(self):
+        """
+        Returns two dicts for quick lookup of commands in this set. The
+        first maps command keys to commands, the second maps both keys
+        and aliases to commands. If several commands share a name, the
+        first one in self.commands is used. The tables are cached until
+        the commands of this cmdset change.
+        """
+        commands = self.commands
+        cached = self._cmd_tables
+        if cached and cached[0] is commands and cached[1] == len(commands):
+            return cached[2], cached[3]
+        keytable, nametable = {}, {}
+        for cmd in commands:
+            keytable.setdefault(cmd.key, cmd)
+            for name in cmd._matchset:
+                nametable.setdefault(name, cmd)
+        self._cmd_tables = (commands, len(commands), keytable, nametable)
+        return keytable, nametable
+
+    def _merge_signature(self):
+        """
+        Returns a tuple of all properties of this cmdset that affect the
+        outcome of merging it with another. The commands list is given
+        by id, so it must be kept referenced along with the signature.
+        """
+        return (id(self.commands), len(self.commands),
+                len(self.system_commands), self.key, self.priority,
+                self.mergetype, self.duplicates, self.no_exits,
+                self.no_objs, self.no_channels, self.permanent,
+                tuple(self.key_mergetypes.items()))
+
     def _duplicate(self):
         """
         Returns a new cmdset with the same settings as this one
@@ -246,11 +286,14 @@ class CmdSet(object):
         by command name and aliases). This allows for things
         like 'if cmd in cmdset'
         """
-        ret = self._contains_cache.get(othercmd)
-        if ret is None:
-            ret = othercmd in self.commands
-            self._contains_cache[othercmd] = ret
-        return ret
+        try:
+            matchset = othercmd._matchset
+        except AttributeError:
+            # probably got a string; match it to keys and aliases
+            return othercmd in self._get_cmd_tables()[1]
+        # a command matches if any of our keys is one of its names
+        keytable = self._get_cmd_tables()[0]
+        return any(name in keytable for name in matchset)
 
     def __add__(self, cmdset_b):
         """
@@ -265,12 +308,25 @@ class CmdSet(object):
         the case of a tie, A takes priority and replaces the
         same-named commands in B unless A has the 'duplicate' variable
         set (which means both sets' commands are kept).
+
+        The result of the latest merger is remembered, so adding the
+        same, unchanged cmdset B to this set again returns the same
+        merged cmdset without re-merging. This means unchanged parts
+        of a chain of mergers (such as the lower part of a cmdset
+        stack) are re-used rather than re-computed. The merged cmdset
+        should thus be treated as read-only.
         """
 
         # It's okay to merge with None
         if not cmdset_b:
             return self
 
+        signature = (self._merge_signature(), cmdset_b._merge_signature())
+        memo = self._merge_memo
+        if memo and memo[0] is cmdset_b and memo[3] == signature:
+            # same merger as last time
+            return memo[4]
+
         sys_commands_a = self.get_system_cmds()
         sys_commands_b = cmdset_b.get_system_cmds()
 
@@ -327,6 +383,11 @@ class CmdSet(object):
 
         # return the system commands to the cmdset
         cmdset_c.add(sys_commands)
+
+        # remember the merger (the commands lists are stored so their
+        # ids in the signature remain valid)
+        self._merge_memo = (cmdset_b, self.commands, cmdset_b.commands,
+                            signature, cmdset_c)
         return cmdset_c
 
     def add(self, cmd):
@@ -363,19 +424,33 @@ class CmdSet(object):
             cmds = [self._instantiate(c) for c in cmd]
         else:
             cmds = [self._instantiate(cmd)]
-        commands = self.commands
+        commands = self.commands[:]
         system_commands = self.system_commands
+
+        def _index_names(commands):
+            "map each command name to the first command position using it"
+            positions = {}
+            for icmd, command in enumerate(commands):
+                for name in command._matchset:
+                    positions.setdefault(name, icmd)
+            return positions
+        positions = _index_names(commands)
+
         for cmd in cmds:
             # add all commands
             if not hasattr(cmd, 'obj'):
                 cmd.obj = self.cmdsetobj
-            try:
-                ic = commands.index(cmd)
-                commands[ic] = cmd  # replace
-            except ValueError:
+            ic = positions.get(cmd.key)
+            if ic is None:
+                for name in cmd._matchset:
+                    positions.setdefault(name, len(commands))
                 commands.append(cmd)
-            # extra run to make sure to avoid doublets
-            self.commands = list(set(commands))
+            else:
+                oldcmd = commands[ic]
+                commands[ic] = cmd  # replace
+                if oldcmd._matchset != cmd._matchset:
+                    # the names changed, so the index must be redone
+                    positions = _index_names(commands)
             #print "In cmdset.add(cmd):", self.key, cmd
             # add system_command to separate list as well,
             # for quick look-up
@@ -385,6 +460,12 @@ class CmdSet(object):
                     system_commands[ic] = cmd  # replace
                 except ValueError:
                     system_commands.append(cmd)
+        # extra run to make sure to avoid doublets
+        unique, self.commands = set(), []
+        for cmd in commands:
+            if id(cmd) not in unique:
+                unique.add(id(cmd))
+                self.commands.append(cmd)
 
     def remove(self, cmd):
         """
@@ -401,9 +482,12 @@ class CmdSet(object):
         a key string.
         """
         cmd = self._instantiate(cmd)
-        for thiscmd in self.commands:
-            if thiscmd == cmd:
-                return thiscmd
+        try:
+            cmdname = cmd.key
+        except AttributeError:
+            # probably got a string
+            cmdname = cmd
+        return self._get_cmd_tables()[1].get(cmdname)
 
     def count(self):
         "Return number of commands in set"
@@ -438,6 +522,38 @@ class CmdSet(object):
                 unique[cmd.key] = cmd
         self.commands = unique.values()
 
+    def get_cmdname_trie(self):
+        """
+        Returns a prefix trie over the keys and aliases of all commands
+        in this cmdset. This allows the parser to find all command names
+        that begin an input string in one pass over that string, rather
+        than comparing against every command name in the set.
+
+        Each node of the trie is a dict mapping a (lower-case) character
+        to the next node. The None key of a node holds a list of
+        (cmdname, cmdobj) tuples for all command names ending at that
+        node. The trie is built the first time it's needed and is then
+        cached until the commands of this cmdset change.
+        """
+        commands = self.commands
+        cached = self._cmdname_trie
+        if cached and cached[0] is commands and cached[1] == len(commands):
+            return cached[2]
+        trie = {}
+        for cmd in commands:
+            try:
+                for cmdname in [cmd.key] + cmd.aliases:
+                    if not cmdname:
+                        continue
+                    node = trie
+                    for char in cmdname.lower():
+                        node = node.setdefault(char, {})
+                    node.setdefault(None, []).append((cmdname, cmd))
+            except Exception:
+                logger.log_trace("Error indexing command %s in cmdset %s." % (cmd, self.key))
+        self._cmdname_trie = (commands, len(commands), trie)
+        return trie
+
     def get_all_cmd_keys_and_aliases(self, caller=None):
         """
         Returns a list of all command keys and aliases
@@ -63,6 +63,7 @@ can then implement separate sets for different situations. For
 example, you can have a 'On a boat' set, onto which you then tack on
 the 'Fishing' set. Fishing from a boat? No problem!
 """
+from itertools import count
 from django.conf import settings
 from src.utils import logger, utils
 from src.commands.cmdset import CmdSet
@@ -74,6 +75,10 @@ __all__ = ("import_cmdset", "CmdSetHandler")
 _CACHED_CMDSETS = {}
 _CMDSET_PATHS = utils.make_iter(settings.CMDSET_PATHS)
 
+# global source of cmdsethandler version stamps. Since stamps are
+# never reused they stay unique also across handler re-creation.
+_CMDSET_VERSION = count(1)
+
 class _ErrorCmdSet(CmdSet):
     "This is a special cmdset used to report errors"
     key = "_CMDSET_ERROR"
@@ -178,6 +183,8 @@ class CmdSetHandler(object):
         self.key = None
         # this holds the "merged" current command set
         self.current = None
+        # version stamp, changed every time self.current is re-merged
+        self.version = _CMDSET_VERSION.next()
         # this holds a history of CommandSets
         self.cmdset_stack = [_EmptyCmdSet(cmdsetobj=self.obj)]
         # this tracks which mergetypes are actually in play in the stack
@@ -276,6 +283,8 @@ class CmdSetHandler(object):
                 continue
             self.mergetype_stack.append(new_current.actual_mergetype)
         self.current = new_current
+        # this tells the cmdhandler to not use cached mergers of this set
+        self.version = _CMDSET_VERSION.next()
 
     def add(self, cmdset, emit_to_obj=None, permanent=False):
         """
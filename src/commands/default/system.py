@@ -707,16 +707,24 @@ class CmdServerLoad(MuxCommand):
 
             # object cache size
             total_num, cachedict = _idmapper.cache_size()
+            cachestats = _idmapper.cache_stats()
             sorted_cache = sorted([(key, num) for key, num in cachedict.items() if num > 0],
                                     key=lambda tup: tup[1], reverse=True)
             memtable = prettytable.PrettyTable(["entity name",
                                                 "number",
-                                                "idmapper %%"])
+                                                "idmapper %%",
+                                                "hits",
+                                                "misses",
+                                                "evicted"])
             memtable.align = 'l'
             for tup in sorted_cache:
+                _, _, hits, misses, evictions = cachestats.get(tup[0], (0, 0, 0, 0, 0))
                 memtable.add_row([tup[0],
                                  "%i" % tup[1],
-                                 "%.2f" % (float(tup[1]) / total_num * 100)])
+                                 "%.2f" % (float(tup[1]) / total_num * 100),
+                                 "%i" % hits,
+                                 "%i" % misses,
+                                 "%i" % evictions])
 
             # get sizes of other caches
             string += "\n{w Entity idmapper cache:{n %i items\n%s" % (total_num, memtable)
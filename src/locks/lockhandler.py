@@ -107,6 +107,7 @@ to any other identifier you can use.
 
 import re
 import inspect
+from collections import OrderedDict
 from django.conf import settings
 from src.utils import logger, utils
 from django.utils.translation import ugettext as _
@@ -152,6 +153,110 @@ _RE_SEPS = re.compile(r"(?<=[ )])AND(?=\s)|(?<=[ )])OR(?=\s)|(?<=[ )])NOT(?=\s)"
 _RE_OK = re.compile(r"%s|and|or|not")
 
 
+#
+# Compiled lock expressions
+#
+
+# compiled evaluators, keyed on evalstrings like '%s and not %s'
+_LOCK_EVALUATORS = {}
+# parsed lock tables keyed on their full lockstring, shared by all
+# handlers. The most recently used lockstrings are last.
+_LOCKSTRING_CACHE = OrderedDict()
+_LOCKSTRING_CACHE_SIZE = settings.LOCKSTRING_CACHE_SIZE
+
+
+def _lockfunc_evaluator(ifunc):
+    "Evaluator calling the ifunc:th lock function"
+    def _evaluate(lock_funcs, accessing_obj, accessed_obj):
+        func, args, kwargs = lock_funcs[ifunc]
+        return bool(func(accessing_obj, accessed_obj, *args, **kwargs))
+    return _evaluate
+
+
+def _not_evaluator(operand):
+    "Evaluator negating another"
+    def _evaluate(lock_funcs, accessing_obj, accessed_obj):
+        return not operand(lock_funcs, accessing_obj, accessed_obj)
+    return _evaluate
+
+
+def _and_evaluator(left, right):
+    "Evaluator combining two others with AND (skipping right if possible)"
+    def _evaluate(lock_funcs, accessing_obj, accessed_obj):
+        return (left(lock_funcs, accessing_obj, accessed_obj) and
+                right(lock_funcs, accessing_obj, accessed_obj))
+    return _evaluate
+
+
+def _or_evaluator(left, right):
+    "Evaluator combining two others with OR (skipping right if possible)"
+    def _evaluate(lock_funcs, accessing_obj, accessed_obj):
+        return (left(lock_funcs, accessing_obj, accessed_obj) or
+                right(lock_funcs, accessing_obj, accessed_obj))
+    return _evaluate
+
+
+def _compile_evalstring(evalstring):
+    """
+    Compiles an evalstring on the form '%s and not %s or %s' into
+    an evaluator function, called as
+
+        evaluator(lock_funcs, accessing_obj, accessed_obj)
+
+    where lock_funcs is a sequence of (func, args, kwargs), one per
+    %s placeholder and in the same order. The operators have the same
+    precedence as in Python (not, and, or) and evaluation stops as soon
+    as the result is known, so not all lock functions are always called.
+    Evaluators are cached, since the same evalstrings are used by
+    many locks. Raises LockException for malformed evalstrings.
+    """
+    if evalstring in _LOCK_EVALUATORS:
+        return _LOCK_EVALUATORS[evalstring]
+    tokens = evalstring.split()
+    state = {"pos": 0, "ifunc": 0}
+
+    def _next():
+        "Step to the next token, returning it"
+        if state["pos"] >= len(tokens):
+            raise LockException("Lock: '%s' ended unexpectedly." % evalstring)
+        token = tokens[state["pos"]]
+        state["pos"] += 1
+        return token
+
+    def _peek():
+        "Look at the next token without stepping"
+        return tokens[state["pos"]] if state["pos"] < len(tokens) else None
+
+    def _parse_not():
+        token = _next()
+        if token == "not":
+            return _not_evaluator(_parse_not())
+        elif token == "%s":
+            state["ifunc"] += 1
+            return _lockfunc_evaluator(state["ifunc"] - 1)
+        raise LockException("Lock: unexpected '%s' in '%s'." % (token, evalstring))
+
+    def _parse_and():
+        evaluator = _parse_not()
+        while _peek() == "and":
+            _next()
+            evaluator = _and_evaluator(evaluator, _parse_not())
+        return evaluator
+
+    def _parse_or():
+        evaluator = _parse_and()
+        while _peek() == "or":
+            _next()
+            evaluator = _or_evaluator(evaluator, _parse_and())
+        return evaluator
+
+    evaluator = _parse_or()
+    if _peek() is not None:
+        raise LockException("Lock: unexpected '%s' in '%s'." % (_peek(), evalstring))
+    _LOCK_EVALUATORS[evalstring] = evaluator
+    return evaluator
+
+
 #
 #
 # Lock handler
@@ -225,9 +330,11 @@ class LockHandler(object):
             if len(lock_funcs) < nfuncs:
                 continue
             try:
-                # purge the eval string of any superfluous items, then test it
+                # purge the eval string of any superfluous items, then compile it
                 evalstring = " ".join(_RE_OK.findall(evalstring))
-                eval(evalstring % tuple(True for func in funclist), {}, {})
+                evaluator = _compile_evalstring(evalstring)
+                if evalstring.count("%s") != len(lock_funcs):
+                    raise LockException
             except Exception:
                 elist.append(_("Lock: definition '%s' has syntax errors.") % raw_lockstring)
                 continue
@@ -235,7 +342,7 @@ class LockHandler(object):
                 duplicates += 1
                 wlist.append(_("LockHandler on %(obj)s: access type '%(access_type)s' changed from '%(source)s' to '%(goal)s' " % \
                         {"obj":self.obj, "access_type":access_type, "source":locks[access_type][2], "goal":raw_lockstring}))
-            locks[access_type] = (evalstring, tuple(lock_funcs), raw_lockstring)
+            locks[access_type] = (evaluator, tuple(lock_funcs), raw_lockstring)
         if wlist:
             # a warning text was set, it's not an error, so only report
             logger.log_file("\n".join(wlist), WARNING_LOG)
@@ -245,9 +352,26 @@ class LockHandler(object):
         # return the gathered locks in an easily executable form
         return locks
 
+    def _get_locks(self, storage_lockstring):
+        """
+        Get the parsed lock table for a lockstring. Lock tables are
+        cached and shared between all handlers with the same lockstring,
+        so they must never be modified in-place.
+        """
+        if not storage_lockstring:
+            return {}
+        locks = _LOCKSTRING_CACHE.pop(storage_lockstring, None)
+        if locks is None:
+            locks = self._parse_lockstring(storage_lockstring)
+            if len(_LOCKSTRING_CACHE) >= _LOCKSTRING_CACHE_SIZE:
+                # drop the least recently used lockstring
+                _LOCKSTRING_CACHE.popitem(last=False)
+        _LOCKSTRING_CACHE[storage_lockstring] = locks
+        return locks
+
     def _cache_locks(self, storage_lockstring):
         """Store data"""
-        self.locks = self._parse_lockstring(storage_lockstring)
+        self.locks = self._get_locks(storage_lockstring)
 
     def _save_locks(self):
         "Store locks to obj"
@@ -315,6 +439,8 @@ class LockHandler(object):
     def delete(self, access_type):
         "Remove a lock from the handler"
         if access_type in self.locks:
+            # the lock table may be shared, so don't change it in-place
+            self.locks = dict(self.locks)
             del self.locks[access_type]
             self._save_locks()
             return True
@@ -349,17 +475,15 @@ class LockHandler(object):
 
         Parsing the lockstring, we (during cache) extract the valid
         lock functions and store their function objects in the right
-        order along with their args/kwargs. These are now executed in
-        sequence, creating a list of True/False values. This is put
-        into the evalstring, which is a string of AND/OR/NOT entries
-        separated by placeholders where each function result should
-        go. We just put those results in and evaluate the string to
-        get a final, combined True/False value for the lockstring.
-
-        The important bit with this solution is that the full
-        lockstring is never blindly evaluated, and thus there (should
-        be) no way to sneak in malign code in it. Only "safe" lock
-        functions (as defined by your settings) are executed.
+        order along with their args/kwargs. The AND/OR/NOT structure
+        of the lock is compiled into an evaluator function that calls
+        the lock functions as needed, stopping as soon as the combined
+        True/False value of the lockstring is known.
+
+        The important bit with this solution is that the lockstring is
+        never evaluated as Python code, and thus there (should be) no
+        way to sneak in malign code in it. Only "safe" lock functions
+        (as defined by your settings) are executed.
 
         """
         try:
@@ -376,12 +500,10 @@ class LockHandler(object):
         # no superuser or bypass -> normal lock operation
         if access_type in self.locks:
             # we have a lock, test it.
-            evalstring, func_tup, raw_string = self.locks[access_type]
-            # execute all lock funcs in the correct order, producing a tuple of True/False results.
-            true_false = tuple(bool(tup[0](accessing_obj, self.obj, *tup[1], **tup[2])) for tup in func_tup)
-            # the True/False tuple goes into evalstring, which combines them
+            evaluator, func_tup, raw_string = self.locks[access_type]
+            # the evaluator calls the lock funcs and combines their results
             # with AND/OR/NOT in order to get the final result.
-            return eval(evalstring % true_false)
+            return evaluator(func_tup, accessing_obj, self.obj)
         else:
             return default
 
@@ -401,12 +523,10 @@ class LockHandler(object):
              or (hasattr(accessing_obj, 'get_player') and (not accessing_obj.get_player() or accessing_obj.get_player().is_superuser))):
                 return True
 
-        locks = self._parse_lockstring(lockstring)
+        locks = self._get_locks(lockstring)
         for access_type in locks:
-            evalstring, func_tup, raw_string = locks[access_type]
-            true_false = tuple(tup[0](accessing_obj, self.obj, *tup[1],**tup[2])
-                                      for tup in func_tup)
-            return eval(evalstring % true_false)
+            evaluator, func_tup, raw_string = locks[access_type]
+            return evaluator(func_tup, accessing_obj, self.obj)
 
 
 def _test():
@@ -61,3 +61,12 @@ class TestLockfuncs(LockTest):
         self.assertEquals(False, lockfuncs.attr_lt(self.obj2, self.obj1, 'testattr', '45'))
         self.assertEquals(True, lockfuncs.attr_le(self.obj2, self.obj1, 'testattr', '45'))
         self.assertEquals(False, lockfuncs.attr_ne(self.obj2, self.obj1, 'testattr', '45'))
+
+class TestLockEvaluation(LockTest):
+    def testrun(self):
+        self.obj2.permissions.add('Wizards')
+        self.obj1.locks.add("a:false() or true() and not false();b:not true() or false()")
+        self.assertEquals(True, self.obj1.locks.check(self.obj2, 'a'))
+        self.assertEquals(False, self.obj1.locks.check(self.obj2, 'b'))
+        self.assertEquals(True, self.obj1.locks.check_lockstring(self.obj2, "dummy:perm(Wizards) and not false()"))
+        self.assertEquals(False, self.obj1.locks.check_lockstring(self.obj2, "dummy:not perm(Wizards)"))
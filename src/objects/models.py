@@ -15,6 +15,7 @@ transparently through the decorating TypeClass.
 """
 
 import traceback
+from itertools import count
 from django.db import models
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
@@ -45,6 +46,10 @@ _DA = object.__delattr__
 # the sessid_max is based on the length of the db_sessid csv field (excluding commas)
 _SESSID_MAX = 16 if MULTISESSION_MODE in (1, 3) else 1
 
+# global source of contents version stamps (never reused, also not
+# after an object was flushed from the idmapper cache)
+_CONTENTS_VERSION = count(1)
+
 class SessidHandler(object):
     """
     Handles the get/setting of the sessid
@@ -91,6 +96,80 @@ class SessidHandler(object):
         return len(self._cache)
 
 
+class ContentsHandler(object):
+    """
+    Handles the contents of an object, i.e. all objects having it as
+    their location. The contents are loaded from the database the
+    first time they are needed and are then updated in memory as
+    objects move in and out, so lookups don't need to query the
+    database.
+    """
+    def __init__(self, obj):
+        self.obj = obj
+        self._pkcache = None
+        self._sorted = None
+
+    def _recache(self):
+        "Load the contents from the database"
+        contents = list(ObjectDB.objects.filter(db_location=self.obj))
+        # most things looking at the contents also look at their
+        # Attributes and Tags, so load those in bulk too
+        ObjectDB.objects.prefetch(contents)
+        self._pkcache = dict((_GA(con, "id"), con) for con in contents)
+        self._sorted = None
+
+    def _changed(self):
+        "Mark the contents as changed"
+        self._sorted = None
+        _GA(self.obj, "_bump_contents_version")()
+
+    def _get_sorted(self):
+        "Get the contents, ordered like the database would order them"
+        if self._pkcache is None:
+            self._recache()
+        if self._sorted is None:
+            contents = sorted(self._pkcache.values(), key=lambda con: _GA(con, "id"))
+            contents.sort(key=lambda con: _GA(con, "db_date_created"), reverse=True)
+            self._sorted = contents
+        return self._sorted
+
+    def get(self, exclude=None):
+        """
+        Returns a list of the database objects located in this
+        object, excluding the database objects in exclude, if given.
+        """
+        contents = self._get_sorted()
+        locid = _GA(self.obj, "id")
+        get_cached = ObjectDB.get_cached_instance
+        if not all(_GA(con, "db_location_id") == locid and
+                   get_cached(_GA(con, "id")) is con for con in contents):
+            # an object changed location without telling us, or was
+            # flushed from the idmapper cache - reload from the database
+            self._recache()
+            contents = self._get_sorted()
+        if exclude:
+            exclude = set(_GA(obj, "id") for obj in make_iter(exclude))
+            return [con for con in contents if _GA(con, "id") not in exclude]
+        return list(contents)
+
+    def add(self, obj):
+        "Add a database object to the contents"
+        if self._pkcache is not None:
+            self._pkcache[_GA(obj, "id")] = obj
+        self._changed()
+
+    def remove(self, obj):
+        "Remove a database object from the contents"
+        if self._pkcache is not None:
+            self._pkcache.pop(_GA(obj, "id"), None)
+        self._changed()
+
+    def clear(self):
+        "Forget the contents, reloading them from the database when next needed"
+        self._pkcache = None
+        self._changed()
+
+
 #------------------------------------------------------------
 #
 # ObjectDB
@@ -195,6 +274,14 @@ class ObjectDB(TypedObject):
     def sessid(self):
         return SessidHandler(self)
 
+    @lazy_property
+    def contents_cache(self):
+        return ContentsHandler(self)
+
+    def _idmapper_pinned(self):
+        "Objects puppeted by a session are never evicted from the cache."
+        return bool(_GA(self, "db_sessid")) or super(ObjectDB, self)._idmapper_pinned()
+
     def _at_db_player_postsave(self):
         """
         This hook is called automatically after the player field is saved.
@@ -202,6 +289,15 @@ class ObjectDB(TypedObject):
         # we need to re-cache this for superusers to bypass.
         self.locks.cache_lock_bypass(self)
 
+    def _at_db_location_postsave(self):
+        """
+        This hook is called automatically after the location field is
+        saved. It makes sure the new location knows its contents changed.
+        """
+        location = _GA(self, "db_location")
+        if location:
+            _GA(location, "contents_cache").add(self)
+
     # cmdset_storage property. We use a custom wrapper to manage this. This also
     # seems very sensitive to caching, so leaving it be for now. /Griatch
     #@property
@@ -260,8 +356,12 @@ class ObjectDB(TypedObject):
             except RuntimeWarning:
                 pass
             # actually set the field
-            _SA(_GA(self, "dbobj"), "db_location", _GA(location, "dbobj") if location else location)
-            _GA(_GA(self, "dbobj"), "save")(update_fields=["db_location"])
+            dbobj = _GA(self, "dbobj")
+            old_location = _GA(dbobj, "db_location")
+            _SA(dbobj, "db_location", _GA(location, "dbobj") if location else location)
+            _GA(dbobj, "save")(update_fields=["db_location"])
+            if old_location and old_location != _GA(dbobj, "db_location"):
+                _GA(old_location, "contents_cache").remove(dbobj)
         except RuntimeError:
             errmsg = "Error: %s.location = %s creates a location loop." % (self.key, location)
             logger.log_errmsg(errmsg)
@@ -273,8 +373,12 @@ class ObjectDB(TypedObject):
 
     def __location_del(self):
         "Cleanly delete the location reference"
-        _SA(_GA(self, "dbobj"), "db_location", None)
-        _GA(_GA(self, "dbobj"), "save")(upate_fields=["db_location"])
+        dbobj = _GA(self, "dbobj")
+        old_location = _GA(dbobj, "db_location")
+        _SA(dbobj, "db_location", None)
+        _GA(dbobj, "save")(upate_fields=["db_location"])
+        if old_location:
+            _GA(old_location, "contents_cache").remove(dbobj)
     location = property(__location_get, __location_set, __location_del)
 
     class Meta:
@@ -326,8 +430,8 @@ class ObjectDB(TypedObject):
         """
         if exclude:
             exclude = [obj.dbobj for obj in make_iter(exclude)]
-            return ObjectDB.objects.get_contents(self, excludeobj=exclude)
-        return ObjectDB.objects.get_contents(self)
+        return [(hasattr(con, "typeclass") and con.typeclass) or con
+                for con in _GA(self, "contents_cache").get(exclude=exclude)]
     contents = property(contents_get)
 
     #@property
@@ -336,10 +440,30 @@ class ObjectDB(TypedObject):
         Returns all exits from this object, i.e. all objects
         at this location having the property destination != None.
         """
-        return [exi for exi in _GA(self, "contents")
-                if exi.destination]
+        return [(hasattr(exi, "typeclass") and exi.typeclass) or exi
+                for exi in _GA(self, "contents_cache").get()
+                if _GA(exi, "db_destination_id")]
     exits = property(__exits_get)
 
+    def _bump_contents_version(self):
+        "Mark the contents of this object as changed."
+        version = _CONTENTS_VERSION.next()
+        _SA(self, "_contents_version", version)
+        return version
+
+    #@property
+    def __contents_version_get(self):
+        """
+        Returns a version stamp that changes whenever an object enters
+        or leaves this object. This allows callers to cache things
+        depending on the contents without querying them.
+        """
+        try:
+            return _GA(self, "_contents_version")
+        except AttributeError:
+            return _GA(self, "_bump_contents_version")()
+    contents_version = property(__contents_version_get)
+
     #
     # Main Search method
     #
@@ -714,7 +838,7 @@ class ObjectDB(TypedObject):
         Destroys all of the exits and any exits pointing to this
         object as a destination.
         """
-        for out_exit in [exi for exi in ObjectDB.objects.get_contents(self) if exi.db_destination]:
+        for out_exit in [exi for exi in _GA(self, "contents_cache").get() if exi.db_destination]:
             out_exit.delete()
         for in_exit in ObjectDB.objects.filter(db_destination=self):
             in_exit.delete()
@@ -725,7 +849,7 @@ class ObjectDB(TypedObject):
         location or to default home.
         """
         # Gather up everything that thinks this is its location.
-        objs = ObjectDB.objects.filter(db_location=self)
+        objs = _GA(self, "contents_cache").get()
         default_home_id = int(settings.DEFAULT_HOME.lstrip("#"))
         try:
             default_home = ObjectDB.objects.get(id=default_home_id)
@@ -845,6 +969,11 @@ class ObjectDB(TypedObject):
         _GA(self, "nicks").clear()
         _GA(self, "aliases").clear()
 
+        # let our location know we are leaving it
+        location = _GA(self, "db_location")
+        if location:
+            _GA(location, "contents_cache").remove(self)
+
         # Perform the deletion of the object
         super(ObjectDB, self).delete()
         return True
@@ -123,6 +123,9 @@ class PlayerDB(TypedObject, AbstractUser):
     def nicks(self):
         return NickHandler(self)
 
+    def _idmapper_pinned(self):
+        "Connected players are never evicted from the cache."
+        return _GA(self, "db_is_connected") or super(PlayerDB, self)._idmapper_pinned()
 
     # alias to the objs property
     def __characters_get(self):
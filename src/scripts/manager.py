@@ -6,6 +6,7 @@ from django.db.models import Q
 from src.typeclasses.managers import TypedObjectManager
 from src.typeclasses.managers import returns_typeclass_list
 from src.utils.utils import make_iter
+from src.server.hookrunner import hook_overridden, import_typeclass
 __all__ = ("ScriptManager",)
 _GA = object.__getattribute__
 
@@ -30,6 +31,7 @@ class ScriptManager(TypedObjectManager):
     get_all_scripts
     delete_script
     remove_non_persistent
+    get_scripts_to_validate
     validate
     script_search (equivalent to ev.search_script)
     copy_script
@@ -108,8 +110,37 @@ class ScriptManager(TypedObjectManager):
             script.delete()
         return nr_deleted
 
+    @returns_typeclass_list
+    def get_scripts_to_validate(self, event):
+        """
+        Get the scripts that need validating when an event happens.
+        Scripts whose typeclass does not override is_valid cannot
+        become invalid and are skipped, as are those whose typeclass
+        does not list event in its validate_on property. Inactive
+        scripts are always included, so they get (re)started.
+
+        event - "connect" or "timer" (see Script.validate_on).
+        """
+        paths = []
+        for path in self.values_list("db_typeclass_path", flat=True).order_by().distinct():
+            typeclass = import_typeclass(path) if path else None
+            if (not typeclass or (hook_overridden(typeclass, "is_valid") and
+                    event in typeclass.validate_on)):
+                # scripts failing to import are included, to report their errors
+                paths.append(path)
+        return self.filter(Q(db_typeclass_path__in=paths) | Q(db_is_active=False))
+
+    def _deactivate_all(self):
+        """
+        Turn off the activity flag for all scripts with a single
+        query, also updating the cached instances to match.
+        """
+        self.filter(db_is_active=True).update(db_is_active=False)
+        for dbobj in self.model.get_all_cached_instances():
+            dbobj.db_is_active = False
+
     def validate(self, scripts=None, obj=None, key=None, dbref=None,
-                 init_mode=False):
+                 init_mode=False, event=None):
         """
         This will step through the script database and make sure
         all objects run scripts that are still valid in the context
@@ -125,6 +156,8 @@ class ScriptManager(TypedObjectManager):
         obj = validate only scripts defined on a special object.
         key = validate only scripts with a particular key
         dbref = validate only the single script with this particular id.
+        event = validate only the scripts concerned by this event
+                ("connect" or "timer"), see get_scripts_to_validate.
 
         init_mode - This is used during server upstart and can have
              three values:
@@ -159,9 +192,8 @@ class ScriptManager(TypedObjectManager):
                 # This deletes all non-persistent scripts from database
                 nr_stopped += self.remove_non_persistent(obj=obj)
             # turn off the activity flag for all remaining scripts
+            self._deactivate_all()
             scripts = self.get_all_scripts()
-            for script in scripts:
-                script.dbobj.is_active = False
 
         elif not scripts:
             # normal operation
@@ -170,6 +202,8 @@ class ScriptManager(TypedObjectManager):
             elif obj:
                 #print "calling get_all_scripts_on_obj", obj, key, VALIDATE_ITERATION
                 scripts = self.get_all_scripts_on_obj(obj, key=key)
+            elif event and not key:
+                scripts = self.get_scripts_to_validate(event)
             else:
                 scripts = self.get_all_scripts(key=key) #self.model.get_all_cached_instances()
 
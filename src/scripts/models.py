@@ -171,6 +171,10 @@ class ScriptDB(TypedObject):
         self.is_active = True
         return super(ScriptDB, self).at_typeclass_error()
 
+    def _idmapper_pinned(self):
+        "Running scripts hold timers and are never evicted from the cache."
+        return _GA(self, "db_is_active") or super(ScriptDB, self)._idmapper_pinned()
+
     delete_iter = 0
     def delete(self):
         "Delete script"
@@ -0,0 +1,247 @@
+"""
+Scheduler
+
+This implements a shared timing-wheel scheduler for repeating
+tasks. Rather than every timed Script and every ticker interval
+keeping its own timer in the reactor, they all register with the
+SCHEDULER instance in this module. This sorts tasks into time
+slots (buckets) of a fixed resolution and keeps only a single
+timer in the reactor, set for the earliest occupied slot. When it
+fires, all tasks due in that slot are called as one batch.
+
+Tasks are created as ScheduledTask objects, which offer the same
+api as the ExtendedLoopingCall they replace:
+
+    from src.scripts.scheduler import ScheduledTask
+
+    task = ScheduledTask(myfunc, *args, **kwargs)
+    task.start(10, now=False)   # call myfunc every 10 seconds
+    task.next_call_time()       # seconds until the next call
+    task.force_repeat()         # call now and restart the timer
+    task.stop()
+
+Tasks are never called before they are due, but may be called up
+to one slot resolution late. As with LoopingCall, if the function
+returns a Deferred, the next call is not scheduled until it fires.
+"""
+
+from heapq import heappush, heappop
+from math import ceil
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from src.utils.logger import log_trace, log_err
+
+__all__ = ("TimingWheel", "ScheduledTask", "SCHEDULER")
+
+# the width of each time slot, in seconds
+_RESOLUTION = 0.1
+
+
+class TimingWheel(object):
+    """
+    Holds all scheduled tasks, sorted into time slots. The slot
+    numbers in use are kept in a heap, so finding the next slot
+    due is cheap no matter how many tasks are scheduled in it.
+    """
+    def __init__(self, resolution=_RESOLUTION, clock=None):
+        """
+        resolution - the width of each time slot, in seconds.
+        clock - the clock to use for timing (the reactor by default).
+        """
+        self.resolution = resolution
+        self.clock = clock or reactor
+        self.slots = {}
+        self.heap = []
+        self.call = None
+        self.call_slot = None
+        self.ticking = False
+
+    def schedule(self, task, when):
+        """
+        Schedule task to be fired at time when (as given by
+        clock.seconds()).
+        """
+        slot = int(ceil(when / self.resolution))
+        bucket = self.slots.get(slot)
+        if bucket is None:
+            bucket = self.slots[slot] = set()
+            heappush(self.heap, slot)
+        bucket.add(task)
+        task._slot = slot
+        if not self.ticking and (self.call_slot is None or slot < self.call_slot):
+            self._reschedule()
+
+    def unschedule(self, task):
+        "Remove task from the wheel"
+        slot = task._slot
+        task._slot = None
+        bucket = self.slots.get(slot)
+        if bucket:
+            bucket.discard(task)
+            # empty slots are cleaned from the heap lazily
+
+    def _reschedule(self):
+        "Set the reactor timer for the earliest slot with tasks in it"
+        heap, slots = self.heap, self.slots
+        while heap and not slots.get(heap[0]):
+            slots.pop(heappop(heap), None)
+        if self.call and self.call.active():
+            self.call.cancel()
+        self.call = self.call_slot = None
+        if heap:
+            slot = heap[0]
+            delay = max(0, slot * self.resolution - self.clock.seconds())
+            self.call = self.clock.callLater(delay, self._tick)
+            self.call_slot = slot
+
+    def _tick(self):
+        "Fire all tasks due in this and any earlier slots"
+        self.call = self.call_slot = None
+        heap, slots = self.heap, self.slots
+        # allow for rounding errors in the slot times
+        current = (self.clock.seconds() + self.resolution * 0.01) / self.resolution
+        due = []
+        while heap and heap[0] <= current:
+            bucket = slots.pop(heappop(heap), None)
+            if bucket:
+                due.extend(bucket)
+        for task in due:
+            task._slot = None
+        self.ticking = True
+        try:
+            for task in due:
+                # an earlier task in this batch may have stopped
+                # or restarted this one.
+                if task.running and task._slot is None:
+                    task._fire()
+        finally:
+            self.ticking = False
+            self._reschedule()
+
+    def __len__(self):
+        "Number of scheduled tasks"
+        return sum(len(bucket) for bucket in self.slots.values())
+
+
+# the main scheduler
+SCHEDULER = TimingWheel()
+
+
+class ScheduledTask(object):
+    """
+    A repeating task run by a TimingWheel. This mimics the api
+    of Twisted's LoopingCall (and the ExtendedLoopingCall).
+    """
+    def __init__(self, f, *a, **kw):
+        """
+        f - the function to call. Any other arguments are passed
+            on to it, except the keyword wheel, which gives the
+            TimingWheel to run on (SCHEDULER by default).
+        """
+        self.f = f
+        self.a = a
+        wheel = kw.pop("wheel", None)
+        # an empty wheel is False, so compare to None
+        self.wheel = SCHEDULER if wheel is None else wheel
+        self.kw = kw
+        self.clock = self.wheel.clock
+        self.running = False
+        self.interval = None
+        self.starttime = None
+        self.callcount = 0
+        self._expectNextCallAt = 0.0
+        self._slot = None
+        self._deferred = None
+
+    def start(self, interval, now=True, start_delay=None, count_start=0):
+        """
+        Start running function every interval seconds.
+
+        now - call the function immediately, then every interval.
+        start_delay - the number of seconds before the first call.
+                      If None, wait interval seconds. Only
+                      valid if now is False.
+        count_start - the task will track how many times it has run.
+                      This will change where it starts counting from.
+        """
+        assert not self.running, ("Tried to start an already running "
+                                  "ScheduledTask.")
+        if interval < 0:
+            raise ValueError("interval must be >= 0")
+        self.running = True
+        self._deferred = None
+        self.interval = interval
+        self.starttime = self.clock.seconds()
+        self.callcount = max(0, count_start)
+        if now:
+            self._expectNextCallAt = self.starttime
+            self._fire()
+        else:
+            if start_delay is None or start_delay < 0:
+                start_delay = interval
+            self._expectNextCallAt = self.starttime + start_delay
+            self.wheel.schedule(self, self._expectNextCallAt)
+
+    def stop(self):
+        "Stop running the task"
+        if self.running:
+            self.running = False
+            self.wheel.unschedule(self)
+
+    def __call__(self):
+        "tick one step"
+        self.callcount += 1
+        try:
+            return self.f(*self.a, **self.kw)
+        except Exception:
+            log_trace()
+
+    def _fire(self):
+        """
+        Call the function and schedule the next call, skipping
+        any calls that were missed due to lag. If the function
+        returns a Deferred, the next call is scheduled when it
+        fires instead.
+        """
+        result = self()
+        if isinstance(result, Deferred):
+            self._deferred = result
+            result.addErrback(lambda failure: log_err(failure.getTraceback()))
+            result.addBoth(self._resume, result)
+            return
+        self._schedule_next()
+
+    def _resume(self, _, deferred):
+        "Called when a Deferred returned by the function fires"
+        if self._deferred is deferred:
+            # not restarted while we waited
+            self._deferred = None
+            self._schedule_next()
+
+    def _schedule_next(self):
+        "Schedule the next call"
+        if self.running and self._slot is None:
+            now = self.clock.seconds()
+            interval = max(self.interval, self.wheel.resolution)
+            expect = self._expectNextCallAt + interval
+            if expect <= now:
+                expect = now + interval - ((now - expect) % interval)
+            self._expectNextCallAt = expect
+            self.wheel.schedule(self, expect)
+
+    def force_repeat(self):
+        "Force-fire the callback"
+        assert self.running, ("Tried to fire a ScheduledTask "
+                              "that was not running.")
+        self.wheel.unschedule(self)
+        self._deferred = None
+        self._expectNextCallAt = self.clock.seconds()
+        self._fire()
+
+    def next_call_time(self):
+        """
+        Return the time in seconds until the next call.
+        """
+        if self.running:
+            return self._expectNextCallAt - self.clock.seconds()
+        return None
@@ -5,12 +5,14 @@ scripts are inheriting from.
 It also defines a few common scripts.
 """
 
-from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
 from twisted.internet.task import LoopingCall
 from django.conf import settings
 from django.utils.translation import ugettext as _
 from src.typeclasses.typeclass import TypeClass
 from src.scripts.models import ScriptDB
+from src.scripts.scheduler import ScheduledTask
 from src.comms import channelhandler
 from src.utils import logger
 
@@ -24,6 +26,9 @@ class ExtendedLoopingCall(LoopingCall):
     """
     LoopingCall that can start at a delay different
     than self.interval.
+
+    Scripts and tickers no longer use this, but run on the
+    shared scheduler instead (see src.scripts.scheduler).
     """
     start_delay = None
     callcount = 0
@@ -113,6 +118,10 @@ class ScriptBase(TypeClass):
     Base class for scripts. Don't inherit from this, inherit
     from the class 'Script'  instead.
     """
+    # the global events on which is_valid is checked, see
+    # ScriptManager.get_scripts_to_validate.
+    validate_on = ("connect", "timer")
+
     # private methods
 
     def __eq__(self, other):
@@ -128,7 +137,7 @@ class ScriptBase(TypeClass):
     def _start_task(self):
         "start task runner"
 
-        self.ndb._task = ExtendedLoopingCall(self._step_task)
+        self.ndb._task = ScheduledTask(self._step_task)
 
         if self.db._paused_time:
             # the script was paused; restarting
@@ -163,7 +172,7 @@ class ScriptBase(TypeClass):
         logger.log_errmsg(estring)
 
     def _step_callback(self):
-        "step task runner. No try..except needed due to defer wrap."
+        "step task runner. No try..except needed, _step_task handles errors."
 
         if not self.is_valid():
             self.stop()
@@ -182,9 +191,9 @@ class ScriptBase(TypeClass):
     def _step_task(self):
         "Step task. This groups error handling."
         try:
-            return maybeDeferred(self._step_callback).addErrback(self._step_errback)
+            self._step_callback()
         except Exception:
-            logger.log_trace()
+            self._step_errback(Failure())
 
     # Public methods
 
@@ -353,7 +362,6 @@ class Script(ScriptBase):
     This is the class you should inherit from, it implements
     the hooks called by the script machinery.
     """
-
     def __init__(self, dbobj):
         """
         This is the base TypeClass for all Scripts. Scripts describe events,
@@ -422,6 +430,11 @@ class Script(ScriptBase):
                       can use this to check state changes (i.e. an script
                       tracking some combat stats at regular intervals is only
                       valid to run while there is actual combat going on).
+                      Besides when its object's scripts are validated, it is
+                      checked on the global events listed in the class
+                      property validate_on: "connect" (a session connects)
+                      and "timer" (the hourly validation sweep). Set it
+                      to () if only the object's state matters.
           at_start() - Called every time the script is started, which for
                       persistent scripts is at least once every server start.
                       Note that this is unaffected by self.delay_start, which
@@ -536,11 +549,12 @@ class CheckSessions(Script):
         #print "ValidateSessions run"
         _SESSIONS.validate_sessions()
 
-_FLUSH_CACHE = None
-_IDMAPPER_CACHE_MAX_MEMORY = settings.IDMAPPER_CACHE_MAXSIZE
 class ValidateIdmapperCache(Script):
     """
-    Check memory use of idmapper cache
+    Obsolete - the idmapper cache now restrains its own size (see
+    settings.IDMAPPER_CACHE_MAX_INSTANCES). This is kept so
+    existing instances of the script can load; they will
+    be removed at their next validation.
     """
     def at_script_creation(self):
         self.key = "sys_cache_validate"
@@ -548,12 +562,9 @@ class ValidateIdmapperCache(Script):
         self.interval = 61 * 5 # staggered compared to session check
         self.persistent = True
 
-    def at_repeat(self):
-        "Called every ~5 mins"
-        global _FLUSH_CACHE
-        if not _FLUSH_CACHE:
-            from src.utils.idmapper.base import conditional_flush as _FLUSH_CACHE
-        _FLUSH_CACHE(_IDMAPPER_CACHE_MAX_MEMORY)
+    def is_valid(self):
+        "This script is no longer used."
+        return False
 
 class ValidateScripts(Script):
     "Check script validation regularly"
@@ -567,7 +578,7 @@ class ValidateScripts(Script):
     def at_repeat(self):
         "called every hour"
         #print "ValidateScripts run."
-        ScriptDB.objects.validate()
+        ScriptDB.objects.validate(event="timer")
 
 
 class ValidateChannelHandler(Script):
@@ -0,0 +1,142 @@
+"""
+Tests for the scripts app.
+"""
+
+from django.test import TestCase
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+
+from src.scripts.models import ScriptDB
+from src.scripts.scripts import Script
+from src.scripts.scheduler import TimingWheel, ScheduledTask
+from src.utils import create
+
+
+class TestScheduledTask(TestCase):
+    "Test ScheduledTask on a TimingWheel driven by a fake clock"
+    def setUp(self):
+        self.clock = Clock()
+        self.wheel = TimingWheel(resolution=0.1, clock=self.clock)
+        self.calls = []
+
+    def _task(self, f=None):
+        return ScheduledTask(f or self._callback, wheel=self.wheel)
+
+    def _callback(self):
+        self.calls.append(self.clock.seconds())
+
+    def test_start_stop(self):
+        task = self._task()
+        task.start(1)
+        self.assertEqual(len(self.calls), 1)
+        self.clock.advance(1)
+        self.clock.advance(1)
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual(task.callcount, 3)
+        task.stop()
+        self.assertFalse(task.running)
+        self.assertEqual(len(self.wheel), 0)
+        self.clock.advance(5)
+        self.assertEqual(len(self.calls), 3)
+
+    def test_start_delay(self):
+        task = self._task()
+        task.start(2, now=False, start_delay=0.5)
+        self.assertEqual(self.calls, [])
+        self.clock.advance(0.5)
+        self.assertEqual(self.calls, [0.5])
+        self.clock.advance(2)
+        self.assertEqual(len(self.calls), 2)
+        task.stop()
+
+    def test_lag(self):
+        task = self._task()
+        task.start(1, now=False)
+        # the reactor was blocked for several intervals
+        self.clock.advance(3.5)
+        self.assertEqual(len(self.calls), 1)
+        # missed calls are skipped, keeping the original phase
+        self.assertAlmostEqual(task.next_call_time(), 0.5)
+        self.clock.advance(0.5)
+        self.assertEqual(len(self.calls), 2)
+        task.stop()
+
+    def test_force_repeat(self):
+        task = self._task()
+        task.start(10, now=False)
+        self.clock.advance(4)
+        task.force_repeat()
+        self.assertEqual(self.calls, [4])
+        self.assertAlmostEqual(task.next_call_time(), 10)
+        self.clock.advance(10)
+        self.assertEqual(self.calls, [4, 14])
+        task.stop()
+
+    def test_next_call_time(self):
+        task = self._task()
+        self.assertEqual(task.next_call_time(), None)
+        task.start(5, now=False)
+        self.assertAlmostEqual(task.next_call_time(), 5)
+        self.clock.advance(2)
+        self.assertAlmostEqual(task.next_call_time(), 3)
+        task.stop()
+        self.assertEqual(task.next_call_time(), None)
+
+    def test_deferred(self):
+        deferreds = []
+
+        def callback():
+            self._callback()
+            deferreds.append(Deferred())
+            return deferreds[-1]
+        task = self._task(callback)
+        task.start(1)
+        # no new call while the deferred is waiting
+        self.clock.advance(3)
+        self.assertEqual(len(self.calls), 1)
+        deferreds[0].callback(None)
+        self.clock.advance(1)
+        self.assertEqual(len(self.calls), 2)
+        task.stop()
+
+
+class _PlainScript(Script):
+    "Uses the default is_valid"
+
+
+class _CheckedScript(Script):
+    def is_valid(self):
+        return True
+
+
+class _LocalScript(_CheckedScript):
+    validate_on = ()
+
+
+class TestScriptValidation(TestCase):
+    "Test which scripts are validated on global events"
+    def _create(self, typeclass, autostart=True):
+        return create.create_script("src.scripts.tests.%s" % typeclass.__name__,
+                                    key=typeclass.__name__, autostart=autostart)
+
+    def _to_validate(self, event):
+        return [script.id for script in ScriptDB.objects.get_scripts_to_validate(event)]
+
+    def test_default_is_valid(self):
+        plain = self._create(_PlainScript)
+        checked = self._create(_CheckedScript)
+        ids = self._to_validate("connect")
+        self.assertFalse(plain.id in ids)
+        self.assertTrue(checked.id in ids)
+
+    def test_inactive(self):
+        plain = self._create(_PlainScript, autostart=False)
+        self.assertFalse(plain.is_active)
+        self.assertTrue(plain.id in self._to_validate("timer"))
+        ScriptDB.objects.validate(event="timer")
+        self.assertTrue(plain.is_active)
+
+    def test_validate_on(self):
+        local = self._create(_LocalScript)
+        self.assertFalse(local.id in self._to_validate("connect"))
+        self.assertFalse(local.id in self._to_validate("timer"))
@@ -47,47 +47,102 @@ If one wants to duplicate TICKER_HANDLER's auto-saving feature in
 a  custom handler one can make a custom AT_STARTSTOP_MODULE entry to
 call the handler's save() and restore() methods when the server reboots.
 
+To avoid lag spikes with many subscribers, settings.TICKER_SUBDIVISIONS
+spreads the subscribers of each interval across the interval, and
+settings.TICKER_TIME_BUDGET limits how long a ticker may call hooks
+before letting the server do other things. TICKER_HANDLER.stats()
+shows how much time is spent on the hooks of each interval.
+
 """
-from twisted.internet.defer import inlineCallbacks
-from src.scripts.scripts import ExtendedLoopingCall
-from src.server.models import ServerConfig
+from collections import deque
+from time import time
+from django.conf import settings
+from twisted.internet import reactor
+from src.scripts.scheduler import ScheduledTask
+from django.db import transaction
+from src.server.models import ServerConfig, StoreEntry
 from src.utils.logger import log_trace
-from src.utils.dbserialize import dbserialize, dbunserialize, pack_dbobj, unpack_dbobj
+from src.utils.dbserialize import dbunserialize, pack_dbobj, unpack_dbobj
 
 _GA = object.__getattribute__
 _SA = object.__setattr__
 
+_SUBDIVISIONS = max(1, int(settings.TICKER_SUBDIVISIONS or 1))
+_TIME_BUDGET = settings.TICKER_TIME_BUDGET
+
 
 class Ticker(object):
     """
     Represents a repeatedly running task that calls
     hooks repeatedly. Overload _callback to change the
     way it operates.
+
+    The subscribers are divided into self.subdivisions groups,
+    and the task runs that many times per interval, each time
+    calling the hooks of the next group.
     """
+    subdivisions = _SUBDIVISIONS
+    time_budget = _TIME_BUDGET
 
-    @inlineCallbacks
     def _callback(self):
         """
-        This will be called repeatedly every self.interval seconds.
-        self.subscriptions contain tuples of (obj, args, kwargs) for
-        each subscribing object.
+        This will be called repeatedly every self.interval seconds
+        (divided by self.subdivisions). self.subscriptions contain
+        tuples of (obj, args, kwargs) for each subscribing object.
 
         If overloading, this callback is expected to handle all
         subscriptions when it is triggered. It should not return
         anything and should not traceback on poorly designed hooks.
-        The callback should ideally work under @inlineCallbacks so it can yield
-        appropriately.
         """
-        for key, (obj, args, kwargs) in self.subscriptions.items():
-            hook_key = yield kwargs.get("hook_key", "at_tick")
+        group = self.groups[self.phase]
+        self.phase = (self.phase + 1) % len(self.groups)
+        queued = self.queued
+        for key in group:
+            if key not in queued:
+                queued.add(key)
+                self.queue.append(key)
+        if not self.continue_call:
+            self._process_queue()
+
+    def _process_queue(self):
+        """
+        Call the hooks of the queued subscribers. If this takes longer
+        than self.time_budget, the rest are handled in the next
+        reactor iteration.
+        """
+        self.continue_call = None
+        queue, queued, subscriptions = self.queue, self.queued, self.subscriptions
+        stats = self.stats
+        budget = self.time_budget
+        t0 = time()
+        ncalls = 0
+        while queue:
+            key = queue.popleft()
+            queued.discard(key)
+            try:
+                obj, args, kwargs = subscriptions[key]
+            except KeyError:
+                # unsubscribed while waiting
+                continue
             if not obj:
                 # object was deleted between calls
                 self.validate()
                 continue
+            hook_key = kwargs.get("hook_key", "at_tick")
             try:
-                yield _GA(obj, hook_key)(*args, **kwargs)
+                _GA(obj, hook_key)(*args, **kwargs)
             except Exception:
                 log_trace()
+            ncalls += 1
+            if budget and queue and time() - t0 > budget:
+                # over budget; let the server do other things first
+                self.continue_call = reactor.callLater(0, self._process_queue)
+                stats["deferrals"] += 1
+                break
+        duration = time() - t0
+        stats["calls"] += ncalls
+        stats["time"] += duration
+        stats["max_time"] = max(stats["max_time"], duration)
 
     def __init__(self, interval):
         """
@@ -95,8 +150,17 @@ class Ticker(object):
         """
         self.interval = interval
         self.subscriptions = {}
-        # set up a twisted asynchronous repeat call
-        self.task = ExtendedLoopingCall(self._callback)
+        # subscribers are spread over groups called in turn
+        self.groups = [set() for _ in range(self.subdivisions)]
+        self.group_of = {}
+        self.phase = 0
+        # subscribers waiting to have their hooks called
+        self.queue = deque()
+        self.queued = set()
+        self.continue_call = None
+        self.stats = {"calls": 0, "time": 0.0, "max_time": 0.0, "deferrals": 0}
+        # set up a repeating task on the shared scheduler
+        self.task = ScheduledTask(self._callback)
 
     def validate(self, start_delay=None):
         """
@@ -111,9 +175,15 @@ class Ticker(object):
         if self.task.running:
             if not subs:
                 self.task.stop()
+                if self.continue_call and self.continue_call.active():
+                    self.continue_call.cancel()
+                self.continue_call = None
+                self.queue.clear()
+                self.queued.clear()
         elif subs:
             #print "starting with start_delay=", start_delay
-            self.task.start(self.interval, now=False, start_delay=start_delay)
+            self.task.start(float(self.interval) / len(self.groups),
+                            now=False, start_delay=start_delay)
 
     def add(self, store_key, obj, *args, **kwargs):
         """
@@ -123,6 +193,11 @@ class Ticker(object):
         """
         start_delay = kwargs.pop("_start_delay", None)
         self.subscriptions[store_key] = (obj, args, kwargs)
+        if store_key not in self.group_of:
+            # put the subscriber in the smallest group
+            igroup = min(range(len(self.groups)), key=lambda i: len(self.groups[i]))
+            self.groups[igroup].add(store_key)
+            self.group_of[store_key] = igroup
         self.validate(start_delay=start_delay)
 
     def remove(self, store_key):
@@ -130,6 +205,9 @@ class Ticker(object):
         Unsubscribe object from this ticker
         """
         self.subscriptions.pop(store_key, False)
+        igroup = self.group_of.pop(store_key, None)
+        if igroup is not None:
+            self.groups[igroup].discard(store_key)
         self.validate()
 
     def stop(self):
@@ -137,12 +215,14 @@ class Ticker(object):
         Kill the Task, regardless of subscriptions
         """
         self.subscriptions = {}
+        self.groups = [set() for _ in self.groups]
+        self.group_of = {}
         self.validate()
 
 
 class TickerPool(object):
     """
-    This maintains a pool of Twisted LoopingCall tasks
+    This maintains a pool of scheduled tasks
     for calling subscribed objects at given times.
     """
     ticker_class = Ticker
@@ -228,42 +308,53 @@ class TickerHandler(object):
 
     def save(self):
         """
-        Save ticker_storage as a serialized string into a temporary
-        ServerConf field. Whereas saving is done on the fly, if called by
-        server when it shuts down, the current timer of each ticker will be
-        saved so it can start over from that point.
-        """
-        if self.ticker_storage:
-            start_delays = dict((interval, ticker.task.next_call_time())
-                                 for interval, ticker in self.ticker_pool.tickers.items())
-            # update the timers for the tickers
-            #for (obj, interval, idstring), (args, kwargs) in self.ticker_storage.items():
-            for store_key, (args, kwargs) in self.ticker_storage.items():
-                interval = store_key[1]
-                # this is a mutable, so it's updated in-place in ticker_storage
-                kwargs["_start_delay"] = start_delays.get(interval, None)
-            ServerConfig.objects.conf(key=self.save_name,
-                                    value=dbserialize(self.ticker_storage))
+        The subscriptions themselves are stored on the fly, one entry
+        at a time, as they are added and removed. This is called by the
+        server when it shuts down, and saves the current timer of each
+        ticker so it can start over from that point.
+        """
+        start_delays = dict((interval, ticker.task.next_call_time())
+                             for interval, ticker in self.ticker_pool.tickers.items()
+                             if ticker.task.running)
+        if start_delays:
+            ServerConfig.objects.conf(key="%s_delays" % self.save_name, value=start_delays)
         else:
-            ServerConfig.objects.conf(key=self.save_name, delete=True)
+            ServerConfig.objects.conf(key="%s_delays" % self.save_name, delete=True)
+
+    def _convert_storage(self):
+        """
+        Move subscriptions saved in the old format, as one serialized
+        dictionary in a ServerConfig field, into separate entries.
+        """
+        ticker_storage = ServerConfig.objects.conf(key=self.save_name)
+        if ticker_storage:
+            with transaction.atomic():
+                for store_key, (args, kwargs) in dbunserialize(ticker_storage).items():
+                    kwargs.pop("_start_delay", None)
+                    StoreEntry.objects.set_entry(self.save_name, store_key, (args, kwargs))
+                ServerConfig.objects.conf(key=self.save_name, delete=True)
 
     def restore(self):
         """
         Restore ticker_storage from database and re-initialize the handler from storage. This is triggered by the server at restart.
         """
+        self._convert_storage()
         # load stored command instructions and use them to re-initialize handler
-        ticker_storage = ServerConfig.objects.conf(key=self.save_name)
-        if ticker_storage:
-            self.ticker_storage = dbunserialize(ticker_storage)
-            #print "restore:", self.ticker_storage
-            for store_key, (args, kwargs) in self.ticker_storage.items():
-                if len(store_key) == 2:
-                    # old form of store_key - update it
-                    store_key = (store_key[0], store_key[1], "")
-                obj, interval, idstring = store_key
-                obj = unpack_dbobj(obj)
-                _, store_key = self._store_key(obj, interval, idstring)
-                self.ticker_pool.add(store_key, obj, interval, *args, **kwargs)
+        self.ticker_storage = StoreEntry.objects.load(self.save_name)
+        start_delays = ServerConfig.objects.conf(key="%s_delays" % self.save_name, default={})
+        #print "restore:", self.ticker_storage
+        for store_key, (args, kwargs) in self.ticker_storage.items():
+            if len(store_key) == 2:
+                # old form of store_key - update it
+                store_key = (store_key[0], store_key[1], "")
+            obj, interval, idstring = store_key
+            obj = unpack_dbobj(obj)
+            _, store_key = self._store_key(obj, interval, idstring)
+            if interval in start_delays:
+                kwargs = dict(kwargs, _start_delay=start_delays[interval])
+            self.ticker_pool.add(store_key, obj, interval, *args, **kwargs)
+        # the timers are only valid for the restart they were saved for
+        ServerConfig.objects.conf(key="%s_delays" % self.save_name, delete=True)
 
     def add(self, obj, interval, idstring="", *args, **kwargs):
         """
@@ -274,7 +365,7 @@ class TickerHandler(object):
         isdb, store_key = self._store_key(obj, interval, idstring)
         if isdb:
             self.ticker_storage[store_key] = (args, kwargs)
-            self.save()
+            StoreEntry.objects.set_entry(self.save_name, store_key, (args, kwargs))
         self.ticker_pool.add(store_key, obj, interval, *args, **kwargs)
 
     def remove(self, obj, interval=None, idstring=""):
@@ -286,21 +377,16 @@ class TickerHandler(object):
             isdb, store_key = self._store_key(obj, interval, idstring)
             if isdb:
                 self.ticker_storage.pop(store_key, None)
-                self.save()
+                StoreEntry.objects.del_entry(self.save_name, store_key)
             self.ticker_pool.remove(store_key, interval)
         else:
             # remove all objects with any intervals
             intervals = self.ticker_pool.tickers.keys()
-            should_save = False
             for interval in intervals:
                 isdb, store_key = self._store_key(obj, interval, idstring)
-                if isdb:
-                    self.ticker_storage.pop(store_key, None)
-                    should_save = True
+                if isdb and self.ticker_storage.pop(store_key, None) is not None:
+                    StoreEntry.objects.del_entry(self.save_name, store_key)
                 self.ticker_pool.remove(store_key, interval)
-            if should_save:
-                self.save()
-
 
 
     def clear(self, interval=None):
@@ -312,10 +398,27 @@ class TickerHandler(object):
         """
         self.ticker_pool.stop(interval)
         if interval:
-            self.ticker_storage = dict((store_key, store_key) for store_key in self.ticker_storage if store_key[1] != interval)
+            with transaction.atomic():
+                for store_key in self.ticker_storage.keys():
+                    if store_key[1] == interval:
+                        del self.ticker_storage[store_key]
+                        StoreEntry.objects.del_entry(self.save_name, store_key)
         else:
             self.ticker_storage = {}
-        self.save()
+            StoreEntry.objects.clear(self.save_name)
+            ServerConfig.objects.conf(key=self.save_name, delete=True)
+
+    def stats(self):
+        """
+        Get statistics on the hooks called by each ticker. Returns a
+        dictionary {interval: {"calls": number of hooks called,
+        "time": total seconds spent in hooks, "max_time": the longest
+        stretch in seconds spent calling hooks without a break,
+        "deferrals": how often the time budget made the ticker
+        continue calling in a later reactor iteration}}
+        """
+        return dict((interval, dict(ticker.stats))
+                     for interval, ticker in self.ticker_pool.tickers.items())
 
     def all(self, interval=None):
         """
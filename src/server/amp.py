@@ -14,19 +14,28 @@ Server - (AMP server) Handles all mud operations. The server holds its own list
          of sessions tied to player objects. This is synced against the portal
          at startup and when a session connects/disconnects
 
+Upgrade note: the message format and commands used between Portal
+and Server changed when the codec handshake and message batching
+were added. The Portal is not restarted on a server reload, so after
+upgrading across that change, Portal and Server must both be stopped
+and started again (a full stop/start, not @reload).
+
 """
 
 # imports needed on both server and portal side
 import os
+import sys
+import marshal
 from collections import defaultdict
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 from twisted.protocols import amp
-from twisted.internet import protocol
+from twisted.internet import protocol, reactor
 from twisted.internet.defer import Deferred
 from src.utils.utils import to_str, variable_from_module
+from src.utils import logger
 
 # communication bits
 
@@ -44,6 +53,15 @@ PCONNSYNC = chr(10)   # portal post-syncing a session
 MAXLEN = 65535  # max allowed data length in AMP protocol
 _MSGBUFFER = defaultdict(list)
 
+# Payloads are tagged with the codec used to encode them. Marshal is
+# used once both sides have confirmed (with the AmpHandshake command)
+# that they use the same marshal format; it is much faster than pickle
+# and can't create arbitrary objects. Pickle is used before that and
+# for data marshal can't handle.
+CODEC_MARSHAL = "M"
+CODEC_PICKLE = "P"
+CODEC_VERSION = "marshal-%s-py%s.%s" % (marshal.version, sys.version_info[0], sys.version_info[1])
+
 def get_restart_mode(restart_file):
     """
     Parse the server/portal restart status
@@ -132,6 +150,29 @@ class AmpClientFactory(protocol.ReconnectingClientFactory):
         protocol.ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
 
 
+# AMP argument types
+
+class LongString(amp.String):
+    """
+    A string argument of any length. AMP limits each value in a box to
+    MAXLEN bytes, so longer strings are split over several keys of the
+    same box (name, name.1, name.2 ...) and joined again when received.
+    """
+    def toBox(self, name, strings, objects, proto):
+        value = self.toStringProto(self.retrieve(objects, name, proto), proto)
+        strings[name] = value[:MAXLEN]
+        for ipart, istart in enumerate(xrange(MAXLEN, len(value), MAXLEN)):
+            strings["%s.%i" % (name, ipart + 1)] = value[istart:istart + MAXLEN]
+
+    def fromBox(self, name, strings, objects, proto):
+        parts = [strings.get(name, "")]
+        ipart = 1
+        while "%s.%i" % (name, ipart) in strings:
+            parts.append(strings["%s.%i" % (name, ipart)])
+            ipart += 1
+        objects[name] = self.fromStringProto("".join(parts), proto)
+
+
 # AMP Communication Command types
 
 class MsgPortal2Server(amp.Command):
@@ -142,8 +183,8 @@ class MsgPortal2Server(amp.Command):
     arguments = [('sessid', amp.Integer()),
                  ('ipart', amp.Integer()),
                  ('nparts', amp.Integer()),
-                 ('msg', amp.String()),
-                 ('data', amp.String())]
+                 ('msg', LongString()),
+                 ('data', LongString())]
     errors = [(Exception, 'EXCEPTION')]
     response = []
 
@@ -156,8 +197,28 @@ class MsgServer2Portal(amp.Command):
     arguments = [('sessid', amp.Integer()),
                  ('ipart', amp.Integer()),
                  ('nparts', amp.Integer()),
-                 ('msg', amp.String()),
-                 ('data', amp.String())]
+                 ('msg', LongString()),
+                 ('data', LongString())]
+    errors = [(Exception, 'EXCEPTION')]
+    response = []
+
+
+class MsgBatchPortal2Server(amp.Command):
+    """
+    Messages portal -> server, gathered during one reactor iteration
+    """
+    key = "MsgBatchPortal2Server"
+    arguments = [('data', LongString())]
+    errors = [(Exception, 'EXCEPTION')]
+    response = []
+
+
+class MsgBatchServer2Portal(amp.Command):
+    """
+    Messages server -> portal, gathered during one reactor iteration
+    """
+    key = "MsgBatchServer2Portal"
+    arguments = [('data', LongString())]
     errors = [(Exception, 'EXCEPTION')]
     response = []
 
@@ -175,7 +236,7 @@ class ServerAdmin(amp.Command):
                  ('ipart', amp.Integer()),
                  ('nparts', amp.Integer()),
                  ('operation', amp.String()),
-                 ('data', amp.String())]
+                 ('data', LongString())]
     errors = [(Exception, 'EXCEPTION')]
     response = []
 
@@ -192,11 +253,24 @@ class PortalAdmin(amp.Command):
                  ('ipart', amp.Integer()),
                  ('nparts', amp.Integer()),
                  ('operation', amp.String()),
-                 ('data', amp.String())]
+                 ('data', LongString())]
     errors = [(Exception, 'EXCEPTION')]
     response = []
 
 
+class AmpHandshake(amp.Command):
+    """
+    Portal -> Server
+
+    Sent when the portal connects, to agree on the codec used
+    for the data of all other commands.
+    """
+    key = "AmpHandshake"
+    arguments = [('version', amp.String())]
+    errors = [(Exception, 'EXCEPTION')]
+    response = [('version', amp.String())]
+
+
 class FunctionCall(amp.Command):
     """
     Bidirectional
@@ -207,16 +281,39 @@ class FunctionCall(amp.Command):
     key = "FunctionCall"
     arguments = [('module', amp.String()),
                  ('function', amp.String()),
-                 ('args', amp.String()),
-                 ('kwargs', amp.String())]
+                 ('args', LongString()),
+                 ('kwargs', LongString())]
     errors = [(Exception, 'EXCEPTION')]
-    response = [('result', amp.String())]
+    response = [('result', LongString())]
 
 
 # Helper functions
 
-dumps = lambda data: to_str(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
-loads = lambda data: pickle.loads(to_str(data))
+def dumps(data, codec=CODEC_PICKLE):
+    """
+    Encode data for sending with the given codec. Falls back to
+    pickle if marshal can't handle the data.
+    """
+    if codec == CODEC_MARSHAL:
+        try:
+            return CODEC_MARSHAL + marshal.dumps(data)
+        except ValueError:
+            # unmarshallable object somewhere in data
+            pass
+    return CODEC_PICKLE + to_str(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+
+
+def loads(data):
+    """
+    Decode data encoded with dumps(). Untagged pickles, as sent
+    before payloads were tagged, are also accepted.
+    """
+    data = to_str(data)
+    if data.startswith(CODEC_MARSHAL):
+        return marshal.loads(data[1:])
+    elif data.startswith(CODEC_PICKLE):
+        return pickle.loads(data[1:])
+    return pickle.loads(data)
 
 # multipart message store
 
@@ -236,8 +333,22 @@ class AMPProtocol(amp.AMP):
     subclasses that specify the datatypes of the input/output of these methods.
     """
 
+    # codec agreed on with the other side (see AmpHandshake)
+    codec = CODEC_PICKLE
+
+    def __init__(self, *args, **kwargs):
+        amp.AMP.__init__(self, *args, **kwargs)
+        # messages waiting to be sent at the end of this reactor
+        # iteration, as {command: [(sessids, msg, data), ...]}
+        self._batches = {}
+        self._batch_call = None
+
     # helper methods
 
+    def dumps(self, data):
+        "Encode data using the codec agreed on with the other side"
+        return dumps(data, self.codec)
+
     def connectionMade(self):
         """
         This is called when a connection is established
@@ -255,6 +366,7 @@ class AMPProtocol(amp.AMP):
             self.factory.portal.sessions.at_server_connection()
             if hasattr(self.factory, "server_restart_mode"):
                 del self.factory.server_restart_mode
+            self.call_remote_AmpHandshake()
 
     # Error handling
 
@@ -266,48 +378,50 @@ class AMPProtocol(amp.AMP):
 
     def safe_send(self, command, sessid, **kwargs):
         """
-        This helper method splits the sending of a message into
-        multiple parts with a maxlength of MAXLEN. This is to avoid
-        repetition in two sending commands. when calling this the
-        maximum length has already been exceeded.  The max-length will
-        be checked for all kwargs and these will be used as argument
-        to the command. The command type must have keywords ipart and
-        nparts to track the parts and put them back together on the
-        other side.
-
-        Returns a deferred or a list of such
-        """
-        to_send = [(key, [string[i:i+MAXLEN] for i in range(0, len(string), MAXLEN)])
-                          for key, string in kwargs.items()]
-        nparts_max = max(len(part[1]) for part in to_send)
-        if nparts_max == 1:
-            # first try to send directly
-            return self.callRemote(command,
-                                   sessid=sessid,
-                                   ipart=0,
-                                   nparts=1,
-                                   **kwargs).addErrback(self.errback, command.key)
+        This helper method sends a message as a single part. Data
+        longer than MAXLEN is split up within the same AMP box by the
+        LongString argument type, so there is no need to send it with
+        multiple commands. The command type must have keywords ipart
+        and nparts, used by safe_recv to put multi-part messages back
+        together on the other side.
+
+        Returns a deferred.
+        """
+        return self.callRemote(command,
+                               sessid=sessid,
+                               ipart=0,
+                               nparts=1,
+                               **kwargs).addErrback(self.errback, command.key)
+
+    def batch_send(self, command, sessid, msg, data):
+        """
+        Buffer a message to be sent together with all other messages
+        buffered during this reactor iteration. A message identical to
+        the one buffered before it (like when a text is sent to everyone
+        in a room) is merged with it, to be fanned out to all its
+        sessions on the other side.
+        """
+        batch = self._batches.setdefault(command, [])
+        if batch and batch[-1][1] == msg and batch[-1][2] == data:
+            batch[-1][0].append(sessid)
         else:
-            # one or more parts were too long for MAXLEN.
-            #print "TooLong triggered!"
-            deferreds = []
-            for ipart in range(nparts_max):
-                part_kwargs = {}
-                for key, str_part in to_send:
-                    try:
-                        part_kwargs[key] = str_part[ipart]
-                    except IndexError:
-                        # means this kwarg needed fewer splits
-                        part_kwargs[key] = ""
-                # send this part
-                #print "amp safe sending:", ipart, nparts_max, str_part
-                deferreds.append(self.callRemote(
-                                 command,
-                                 sessid=sessid,
-                                 ipart=ipart,
-                                 nparts=nparts_max,
-                                 **part_kwargs).addErrback(self.errback, command.key))
-            return deferreds
+            batch.append(([sessid], msg, data))
+        if not self._batch_call:
+            self._batch_call = reactor.callLater(0, self.batch_flush)
+
+    def batch_flush(self):
+        """
+        Send all buffered messages, with one command per direction.
+        This must be called before sending commands that should not
+        overtake the buffered messages.
+        """
+        if self._batch_call and self._batch_call.active():
+            self._batch_call.cancel()
+        self._batch_call = None
+        batches, self._batches = self._batches, {}
+        for command, batch in batches.items():
+            self.callRemote(command,
+                            data=self.dumps(batch)).addErrback(self.errback, command.key)
 
     def safe_recv(self, command, sessid, ipart, nparts, **kwargs):
         """
@@ -361,11 +475,27 @@ class AMPProtocol(amp.AMP):
     def call_remote_MsgPortal2Server(self, sessid, msg, data=""):
         """
         Access method called by the Portal and executed on the Portal.
+        The message is sent at the end of this reactor iteration.
         """
         #print "msg portal->server (portal side):", sessid, msg, data
-        return self.safe_send(MsgPortal2Server, sessid,
-                              msg=msg if msg is not None else "",
-                              data=dumps(data))
+        self.batch_send(MsgBatchPortal2Server, sessid,
+                        msg if msg is not None else "", data)
+
+    def amp_batch_portal2server(self, data):
+        """
+        Relays a batch of messages to the server. This method is
+        executed on the Server.
+        """
+        data_in = self.factory.server.sessions.data_in
+        for sessids, msg, kwargs in loads(data):
+            for sessid in sessids:
+                try:
+                    data_in(sessid, text=msg, **kwargs)
+                except Exception:
+                    # don't lose the rest of the batch
+                    logger.log_trace()
+        return {}
+    MsgBatchPortal2Server.responder(amp_batch_portal2server)
 
     # Server -> Portal message
 
@@ -386,11 +516,27 @@ class AMPProtocol(amp.AMP):
     def call_remote_MsgServer2Portal(self, sessid, msg, data=""):
         """
         Access method called by the Server and executed on the Server.
+        The message is sent at the end of this reactor iteration.
         """
         #print "msg server->portal (server side):", sessid, msg, data
-        return self.safe_send(MsgServer2Portal, sessid,
-                              msg=msg if msg is not None else "",
-                              data=dumps(data))
+        self.batch_send(MsgBatchServer2Portal, sessid,
+                        msg if msg is not None else "", data)
+
+    def amp_batch_server2portal(self, data):
+        """
+        Relays a batch of messages to the portal, fanning them out to
+        their sessions. This method is executed on the Portal.
+        """
+        data_out = self.factory.portal.sessions.data_out
+        for sessids, msg, kwargs in loads(data):
+            for sessid in sessids:
+                try:
+                    data_out(sessid, text=msg, **kwargs)
+                except Exception:
+                    # don't lose the rest of the batch
+                    logger.log_trace()
+        return {}
+    MsgBatchServer2Portal.responder(amp_batch_server2portal)
 
     # Server administration from the Portal side
     def amp_server_admin(self, sessid, ipart, nparts, operation, data):
@@ -437,7 +583,8 @@ class AMPProtocol(amp.AMP):
         Access method called by the Portal and Executed on the Portal.
         """
         #print "serveradmin (portal side):", sessid, ord(operation), data
-        data = dumps(data)
+        self.batch_flush()
+        data = self.dumps(data)
         return self.safe_send(ServerAdmin, sessid, operation=operation, data=data)
 
     # Portal administraton from the Server side
@@ -489,7 +636,30 @@ class AMPProtocol(amp.AMP):
         """
         Access method called by the server side.
         """
-        self.safe_send(PortalAdmin, sessid, operation=operation, data=dumps(data))
+        self.batch_flush()
+        self.safe_send(PortalAdmin, sessid, operation=operation, data=self.dumps(data))
+
+    # Codec handshake
+
+    def amp_handshake(self, version):
+        """
+        The portal tells which codec version it uses; if it matches
+        ours, both sides switch to it. This is executed on the Server.
+        """
+        if version == CODEC_VERSION:
+            self.codec = CODEC_MARSHAL
+        return {"version": CODEC_VERSION}
+    AmpHandshake.responder(amp_handshake)
+
+    def call_remote_AmpHandshake(self):
+        """
+        Access method called by the Portal and executed on the Portal.
+        """
+        def _set_codec(ret):
+            if ret["version"] == CODEC_VERSION:
+                self.codec = CODEC_MARSHAL
+        return self.callRemote(AmpHandshake,
+                               version=CODEC_VERSION).addCallback(_set_codec).addErrback(self.errback, "AmpHandshake")
 
     # Extra functions
 
@@ -507,10 +677,10 @@ class AMPProtocol(amp.AMP):
         if isinstance(result, Deferred):
             # if result is a deferred, attach handler to properly
             # wrap the return value
-            result.addCallback(lambda r: {"result": dumps(r)})
+            result.addCallback(lambda r: {"result": self.dumps(r)})
             return result
         else:
-            return {'result': dumps(result)}
+            return {'result': self.dumps(result)}
     FunctionCall.responder(amp_function_call)
 
     def call_remote_FunctionCall(self, modulepath, functionname, *args, **kwargs):
@@ -528,8 +698,9 @@ class AMPProtocol(amp.AMP):
             A deferred that fires with the return value of the remote
             function call
         """
+        self.batch_flush()
         return self.callRemote(FunctionCall,
                                module=modulepath,
                                function=functionname,
-                               args=dumps(args),
-                               kwargs=dumps(kwargs)).addCallback(lambda r: loads(r["result"])).addErrback(self.errback, "FunctionCall")
+                               args=self.dumps(args),
+                               kwargs=self.dumps(kwargs)).addCallback(lambda r: loads(r["result"])).addErrback(self.errback, "FunctionCall")
@@ -0,0 +1,240 @@
+"""
+Lifecycle hook runner.
+
+When the server starts, reloads or shuts down, a hook such as
+at_init or at_server_reload must be called on every cached
+typeclassed entity. This module runs such sweeps efficiently:
+
+ - entities whose typeclass does not override the hook (that is,
+   still uses the empty default defined on the base typeclass) are
+   skipped without even loading their typeclass.
+ - the hooks are called in batches, each batch inside a single
+   database transaction, so Attribute saves done by the hooks are
+   not committed one by one.
+ - the time spent per typeclass is measured and reported to the log.
+
+Which typeclasses override which hooks is worked out once per class.
+precompute_hook_overrides() does this for all typeclasses in the
+database at server start, so the sweeps need not import anything.
+
+"""
+
+from time import time
+from collections import defaultdict
+
+from django.db import transaction
+from src.utils import logger
+
+__all__ = ("hook_overridden", "import_typeclass", "precompute_hook_overrides", "run_hooks")
+
+_GA = object.__getattribute__
+
+# number of hooks to call per transaction
+_HOOK_BATCH_SIZE = 500
+# number of the slowest typeclasses to report per sweep
+_REPORT_COUNT = 10
+
+# hooks for which the override check is precomputed
+_LIFECYCLE_HOOKS = ("at_init", "at_server_reload", "at_server_shutdown")
+
+_NOOP_HOOKS = None
+_OVERRIDE_CACHE = {}
+_CLASS_CACHE = {}
+
+
+def _get_noop_hooks():
+    """
+    Gather the default hook implementations that do nothing. A
+    typeclass using one of these for a hook needs not have it called.
+    Script.is_valid is counted among them; it only checks that the
+    script was not deleted, which always holds for scripts found in
+    the database. ScriptBase.is_valid is not, since it returns None,
+    which makes the script invalid.
+    """
+    global _NOOP_HOOKS
+    if _NOOP_HOOKS is None:
+        from src.objects.objects import Object
+        from src.players.player import Player
+        from src.scripts.scripts import ScriptBase, Script
+        from src.comms.comms import Channel
+        _NOOP_HOOKS = defaultdict(set)
+        for hookname in _LIFECYCLE_HOOKS:
+            for base in (Object, Player, ScriptBase, Script, Channel):
+                hook = getattr(base, hookname, None)
+                if hook is not None:
+                    _NOOP_HOOKS[hookname].add(getattr(hook, "im_func", hook))
+        _NOOP_HOOKS["is_valid"].add(Script.is_valid.im_func)
+    return _NOOP_HOOKS
+
+
+def hook_overridden(typeclass, hookname):
+    """
+    Check if a typeclass class defines a hook doing anything at all.
+
+    typeclass - a typeclass class (not an instance)
+    hookname - name of the hook, like "at_init"
+
+    Returns False only if the hook is known to be an empty default.
+    The result is cached per class.
+    """
+    key = (typeclass, hookname)
+    try:
+        return _OVERRIDE_CACHE[key]
+    except KeyError:
+        hook = getattr(typeclass, hookname, None)
+        if hook is None:
+            overridden = False
+        else:
+            overridden = getattr(hook, "im_func", hook) not in _get_noop_hooks()[hookname]
+        _OVERRIDE_CACHE[key] = overridden
+        return overridden
+
+
+def import_typeclass(path):
+    """
+    Import a typeclass class from its full python path, caching
+    the result. Returns None if the import fails.
+    """
+    try:
+        return _CLASS_CACHE[path]
+    except KeyError:
+        cls = None
+        try:
+            modpath, class_name = path.rsplit(".", 1)
+            cls = getattr(__import__(modpath, fromlist=["none"]), class_name, None)
+        except Exception:
+            pass
+        cls = cls if callable(cls) else None
+        _CLASS_CACHE[path] = cls
+        return cls
+
+
+def precompute_hook_overrides():
+    """
+    Import all typeclasses currently used in the database and
+    check which of the lifecycle hooks each of them overrides.
+    Typeclasses failing to import are ignored here; they will
+    report their errors when their objects are first used.
+    """
+    from src.objects.models import ObjectDB
+    from src.players.models import PlayerDB
+    from src.scripts.models import ScriptDB
+    for model in (ObjectDB, PlayerDB, ScriptDB):
+        paths = model.objects.values_list("db_typeclass_path", flat=True).order_by().distinct()
+        for path in paths:
+            cls = import_typeclass(path) if path else None
+            if cls:
+                for hookname in _LIFECYCLE_HOOKS:
+                    hook_overridden(cls, hookname)
+
+
+def _typeclass_class(dbobj):
+    """
+    Get the typeclass class of dbobj, without loading (and
+    initializing) its typeclass if that has not already happened.
+    Returns None if the class could not be determined this way.
+    """
+    path = _GA(dbobj, "typeclass_path")
+    typeclass = _GA(dbobj, "_cached_typeclass")
+    try:
+        if typeclass and _GA(typeclass, "path") == path:
+            return typeclass.__class__
+    except AttributeError:
+        pass
+    return import_typeclass(path) if path else None
+
+
+def _is_loaded(dbobj):
+    "Check if dbobj's typeclass is already initialized"
+    typeclass = _GA(dbobj, "_cached_typeclass")
+    try:
+        return bool(typeclass) and _GA(typeclass, "path") == _GA(dbobj, "typeclass_path")
+    except AttributeError:
+        return False
+
+
+def _calls_hook(dbobj, hookname, always):
+    """
+    Check if handling dbobj will call any hook, and so may write
+    to the database. This also counts loading its typeclass, which
+    calls at_init.
+    """
+    if always:
+        return True
+    cls = _typeclass_class(dbobj)
+    if cls is None:
+        return True
+    return (hook_overridden(cls, hookname) or
+            (not _is_loaded(dbobj) and hook_overridden(cls, "at_init")))
+
+
+def _call_batch(batch, hookname, always, timings):
+    """
+    Call hooks on one batch of database objects, inside a single
+    transaction. Each entity whose hooks are called is handled in its
+    own savepoint, so an error in one hook (logged, it does not stop
+    the sweep) only rolls back that hook's database changes.
+    """
+    with transaction.atomic():
+        for dbobj in batch:
+            if not _calls_hook(dbobj, hookname, always):
+                continue
+            t0 = time()
+            try:
+                with transaction.atomic():
+                    loaded = _is_loaded(dbobj)
+                    typeclass = dbobj.typeclass
+                    if always:
+                        always(typeclass)
+                    # loading the typeclass calls at_init already
+                    if ((loaded or hookname != "at_init")
+                            and hook_overridden(typeclass.__class__, hookname)):
+                        getattr(typeclass, hookname)()
+            except Exception:
+                logger.log_trace("Error calling %s on %s." % (hookname, dbobj))
+            timing = timings[_GA(dbobj, "typeclass_path")]
+            timing[0] += 1
+            timing[1] += time() - t0
+
+
+def run_hooks(dbobjs, hookname, always=None, batch_size=_HOOK_BATCH_SIZE):
+    """
+    Call a lifecycle hook on all given typeclassed entities.
+
+    dbobjs - iterable of database objects (like
+             ObjectDB.get_all_cached_instances())
+    hookname - the typeclass hook to call, like "at_server_reload"
+    always - optional callable taking the typeclass as argument.
+             It is called on all entities, also those whose typeclass
+             does not override the hook (these must then be loaded).
+    batch_size - number of entities to handle per transaction.
+
+    Returns a dict {typeclass_path: (count, seconds)} with the time
+    spent on the entities that had hooks called.
+    """
+    timings = defaultdict(lambda: [0, 0.0])
+    batch = []
+    nskipped = 0
+    t0 = time()
+    for dbobj in dbobjs:
+        if not always:
+            cls = _typeclass_class(dbobj)
+            if cls and not hook_overridden(cls, hookname):
+                nskipped += 1
+                continue
+        batch.append(dbobj)
+        if len(batch) >= batch_size:
+            _call_batch(batch, hookname, always, timings)
+            batch = []
+    if batch:
+        _call_batch(batch, hookname, always, timings)
+
+    ncalled = sum(timing[0] for timing in timings.values())
+    if ncalled or nskipped:
+        slowest = sorted(timings.items(), key=lambda tup: tup[1][1], reverse=True)
+        string = "%s: called on %i entities, skipped %i (%.2fs)." % (
+                        hookname, ncalled, nskipped, time() - t0)
+        for path, (count, seconds) in slowest[:_REPORT_COUNT]:
+            string += "\n  %s: %i in %.3fs" % (path, count, seconds)
+        logger.log_infomsg(string)
+    return dict((path, tuple(timing)) for path, timing in timings.items())
@@ -1,7 +1,47 @@
 """
-Custom manager for ServerConfig objects.
+Custom managers for ServerConfig and StoreEntry objects.
 """
+from base64 import b64encode, b64decode
+from hashlib import md5
 from django.db import models
+from src.utils.utils import to_str
+
+_DBSERIALIZE = None
+_DBUNSERIALIZE = None
+
+
+def _init_serializers():
+    "Delayed import, dbserialize imports our models"
+    global _DBSERIALIZE, _DBUNSERIALIZE
+    if not _DBSERIALIZE:
+        from src.utils.dbserialize import dbserialize, dbunserialize
+        _DBSERIALIZE, _DBUNSERIALIZE = dbserialize, dbunserialize
+
+
+def _encode(data):
+    "Serialize data to an ascii string, safe for any text field"
+    _init_serializers()
+    return b64encode(_DBSERIALIZE(data))
+
+
+def _decode(data):
+    "Retrieve data stored with _encode"
+    _init_serializers()
+    return _DBUNSERIALIZE(b64decode(to_str(data)))
+
+
+def _normalize_key(key):
+    """
+    Convert a key to a form that is the same for all keys comparing
+    equal, so u"x" and "x" or 10 and 10.0 give the same entry.
+    """
+    if isinstance(key, basestring):
+        return to_str(key)
+    elif isinstance(key, (int, long)) or (isinstance(key, float) and key.is_integer()):
+        return int(key)
+    elif isinstance(key, (tuple, list)):
+        return tuple(_normalize_key(part) for part in key)
+    return key
 
 
 class ServerConfigManager(models.Manager):
@@ -51,3 +91,58 @@ class ServerConfigManager(models.Manager):
         conn.execute("SELECT VERSION()")
         version = conn.fetchone()
         return version and str(version[0]) or ""
+
+
+class StoreEntryManager(models.Manager):
+    """
+    This StoreEntryManager handles the StoreEntry table, a persistent
+    key-value storage split into named stores. Each entry is written
+    and removed on its own, so changing one entry never requires
+    re-saving all the others in the store.
+
+    Keys and values are serialized with dbserialize (and base64
+    encoded), so they may contain (packed) database objects. Entries
+    are looked up by a hash of the key, so keys must be built from
+    strings, numbers and tuples, like the store keys of the
+    TickerHandler and OOBHandler.
+
+    Evennia-specific:
+    set_entry
+    del_entry
+    load
+    clear
+
+    """
+    def _hash_key(self, key):
+        "Returns the hash entries are looked up by"
+        return md5(repr(_normalize_key(key))).hexdigest()
+
+    def set_entry(self, store, key, value):
+        """
+        Store value under key in the given store, replacing any
+        value already stored there.
+        """
+        keyhash = self._hash_key(key)
+        value = _encode(value)
+        if not self.filter(db_store=store, db_hash=keyhash).update(db_value=value):
+            self.create(db_store=store, db_hash=keyhash, db_key=_encode(key), db_value=value)
+
+    def del_entry(self, store, key):
+        """
+        Remove the entry stored under key in the given store, if any.
+        """
+        self.filter(db_store=store, db_hash=self._hash_key(key)).delete()
+
+    def load(self, store):
+        """
+        Get all entries in the given store with one query. Returns
+        a dictionary {key: value}.
+        """
+        return dict((_decode(key), _decode(value)) for key, value in
+                     self.filter(db_store=store).values_list("db_key", "db_value"))
+
+    def clear(self, store):
+        """
+        Remove all entries in the given store.
+        """
+        self.filter(db_store=store).delete()
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoreEntry',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('db_store', models.CharField(max_length=64, db_index=True)),
+                ('db_hash', models.CharField(max_length=32)),
+                ('db_key', models.TextField()),
+                ('db_value', models.TextField(blank=True)),
+            ],
+            options={
+                'verbose_name': 'Store Entry',
+                'verbose_name_plural': 'Store Entries',
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='storeentry',
+            unique_together=set([('db_store', 'db_hash')]),
+        ),
+    ]
@@ -7,6 +7,9 @@ This holds persistent server configuration flags.
 Config values should usually be set through the
 manager's conf() method.
 
+It also holds the StoreEntry table, used by server handlers
+to persist their state one entry at a time.
+
 """
 try:
     import cPickle as pickle
@@ -16,7 +19,7 @@ except ImportError:
 from django.db import models
 from src.utils.idmapper.models import WeakSharedMemoryModel
 from src.utils import logger, utils
-from src.server.manager import ServerConfigManager
+from src.server.manager import ServerConfigManager, StoreEntryManager
 
 
 #------------------------------------------------------------
@@ -116,3 +119,44 @@ class ServerConfig(WeakSharedMemoryModel):
         """
         self.key = key
         self.value = value
+
+
+#------------------------------------------------------------
+#
+# StoreEntry
+#
+#------------------------------------------------------------
+
+class StoreEntry(models.Model):
+    """
+    One entry in a persistent key-value store. This is used by
+    handlers (like the TickerHandler) that must remember many
+    entries across a server restart, and adds and removes them
+    one at a time while running.
+
+    Entries are not cached, they are only read in bulk at startup.
+    They should be handled through the manager's set_entry,
+    del_entry and load methods.
+
+    Properties defined on StoreEntry:
+      store - name of the store this entry belongs to
+      hash - md5 hash of the key (normalized), used for lookups
+      key - the serialized key, base64 encoded
+      value - the serialized value, base64 encoded
+
+    """
+    db_store = models.CharField(max_length=64, db_index=True)
+    db_hash = models.CharField(max_length=32)
+    db_key = models.TextField()
+    db_value = models.TextField(blank=True)
+
+    objects = StoreEntryManager()
+
+    class Meta:
+        "Define Django meta options"
+        verbose_name = "Store Entry"
+        verbose_name_plural = "Store Entries"
+        unique_together = ("db_store", "db_hash")
+
+    def __unicode__(self):
+        return "%s : %s" % (self.db_store, self.db_hash)
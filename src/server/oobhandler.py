@@ -37,12 +37,12 @@ messages.
 from inspect import isfunction
 from twisted.internet.defer import inlineCallbacks
 from django.conf import settings
-from src.server.models import ServerConfig
+from src.server.models import ServerConfig, StoreEntry
 from src.server.sessionhandler import SESSIONS
 #from src.scripts.scripts import Script
 #from src.utils.create import create_script
 from src.scripts.tickerhandler import Ticker, TickerPool, TickerHandler
-from src.utils.dbserialize import dbserialize, dbunserialize, pack_dbobj, unpack_dbobj
+from src.utils.dbserialize import dbunserialize, pack_dbobj, unpack_dbobj
 from src.utils import logger
 from src.utils.utils import all_from_module, make_iter, to_str
 
@@ -244,17 +244,16 @@ class OOBHandler(object):
         """
         self.sessionhandler = SESSIONS
         self.oob_tracker_storage = {}
+        self.save_name = "oob_tracker_storage"
         self.tickerhandler = OOBTickerHandler("oob_ticker_storage")
+        self._restoring = False
 
     def save(self):
         """
-        Save the command_storage as a serialized string into a temporary
-        ServerConf field
+        The trackers are stored on the fly, one entry at a time, as
+        they are added and removed. This only saves the timers of the
+        repeating actions.
         """
-        if self.oob_tracker_storage:
-            #print "saved tracker_storage:", self.oob_tracker_storage
-            ServerConfig.objects.conf(key="oob_tracker_storage",
-                                    value=dbserialize(self.oob_tracker_storage))
         self.tickerhandler.save()
 
     def restore(self):
@@ -263,16 +262,40 @@ class OOBHandler(object):
         only triggered after a server reload, not after a shutdown-restart
         """
         # load stored command instructions and use them to re-initialize handler
-        tracker_storage = ServerConfig.objects.conf(key="oob_tracker_storage")
+        tracker_storage = ServerConfig.objects.conf(key=self.save_name)
         if tracker_storage:
-            self.oob_tracker_storage = dbunserialize(tracker_storage)
-            for (obj, sessid, fieldname, trackerclass, args, kwargs) in self.oob_tracker_storage.values():
+            # saved in the old format, as one serialized dictionary;
+            # let _track store it again as separate entries.
+            tracker_storage = dbunserialize(tracker_storage)
+            ServerConfig.objects.conf(key=self.save_name, delete=True)
+        else:
+            tracker_storage = StoreEntry.objects.load(self.save_name)
+            # these are already stored
+            self._restoring = True
+        try:
+            for store_key, (obj, sessid, fieldname, trackerclass, args, kwargs) in tracker_storage.items():
                 #print "restoring tracking:",obj, sessid, fieldname, trackerclass
-                self._track(unpack_dbobj(obj), sessid, fieldname, trackerclass, *args, **kwargs)
-            # make sure to purge the storage
-            ServerConfig.objects.conf(key="oob_tracker_storage", delete=True)
+                obj = unpack_dbobj(obj)
+                if obj is None:
+                    # the tracked object no longer exists
+                    StoreEntry.objects.del_entry(self.save_name, store_key)
+                    continue
+                self._track(obj, sessid, fieldname, trackerclass, *args, **kwargs)
+        finally:
+            self._restoring = False
         self.tickerhandler.restore()
 
+    def clear_storage(self):
+        """
+        Remove all stored trackers and repeating actions. Sessions
+        don't survive a shutdown, so this is called by the server
+        on a cold start instead of restore().
+        """
+        self.oob_tracker_storage = {}
+        StoreEntry.objects.clear(self.save_name)
+        ServerConfig.objects.conf(key=self.save_name, delete=True)
+        self.tickerhandler.clear()
+
     def _track(self, obj, sessid, propname, trackerclass, *args, **kwargs):
         """
         Create an OOB obj of class _oob_MAPPING[tracker_key] on obj. args,
@@ -298,6 +321,8 @@ class OOBHandler(object):
         storekey = (obj_packed, sessid, propname)
         stored = (obj_packed, sessid, propname, trackerclass,  args, kwargs)
         self.oob_tracker_storage[storekey] = stored
+        if not self._restoring:
+            StoreEntry.objects.set_entry(self.save_name, storekey, stored)
         #print "_track:", obj, id(obj), obj.__dict__
 
     def _untrack(self, obj, sessid, propname, trackerclass, *args, **kwargs):
@@ -316,7 +341,8 @@ class OOBHandler(object):
             pass
         # remove the pickle from storage
         store_key = (pack_dbobj(obj), sessid, propname)
-        self.oob_tracker_storage.pop(store_key, None)
+        if self.oob_tracker_storage.pop(store_key, None) is not None:
+            StoreEntry.objects.del_entry(self.save_name, store_key)
 
     def get_all_tracked(self, session):
         """
@@ -27,6 +27,8 @@ class PortalSessionHandler(SessionHandler):
         """
         self.portal = None
         self.sessions = {}
+        # {suid: sessid} for sessions having a suid (like webclients)
+        self._suid_index = {}
         self.latest_sessid = 0
         self.uptime = time.time()
         self.connection_time = 0
@@ -49,6 +51,8 @@ class PortalSessionHandler(SessionHandler):
         session.sessid = sessid
         sessdata = session.get_sync_data()
         self.sessions[sessid] = session
+        if getattr(session, "suid", None):
+            self._suid_index[session.suid] = sessid
         # sync with server-side
         if self.portal.amp_protocol:  # this is a timing issue
             self.portal.amp_protocol.call_remote_ServerAdmin(sessid,
@@ -85,6 +89,7 @@ class PortalSessionHandler(SessionHandler):
         sessid = session.sessid
         if sessid in self.sessions:
             del self.sessions[sessid]
+        self._suid_index.pop(getattr(session, "suid", None), None)
         del session
         # tell server to also delete this session
         self.portal.amp_protocol.call_remote_ServerAdmin(sessid,
@@ -127,6 +132,7 @@ class PortalSessionHandler(SessionHandler):
             if sessid in self.sessions:
                 # in case sess.disconnect doesn't delete it
                 del self.sessions[sessid]
+            self._suid_index.pop(getattr(session, "suid", None), None)
             del session
 
     def server_disconnect_all(self, reason=""):
@@ -137,6 +143,7 @@ class PortalSessionHandler(SessionHandler):
             session.disconnect(reason)
             del session
         self.sessions = {}
+        self._suid_index = {}
 
     def server_logged_in(self, sessid, data):
         """
@@ -176,8 +183,8 @@ class PortalSessionHandler(SessionHandler):
         Given a session id, retrieve the session (this is primarily
         intended to be called by web clients)
         """
-        return [sess for sess in self.get_sessions(include_unloggedin=True)
-                if hasattr(sess, 'suid') and sess.suid == suid]
+        sess = self.sessions.get(self._suid_index.get(suid))
+        return [sess] if sess and sess.suid == suid else []
 
     def data_in(self, session, text="", **kwargs):
         """
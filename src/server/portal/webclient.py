@@ -15,6 +15,10 @@ found on http://localhost:8000/webclient.)
                  The WebClient resource in this module will
                  handle these requests and act as a gateway
                  to sessions connected over the webclient.
+                 If settings.WEBCLIENT_STREAMING is set, clients
+                 may instead open a GET request in 'stream' mode,
+                 which is kept open and has messages pushed to it
+                 as server-sent events.
 """
 import time
 import json
@@ -32,6 +36,7 @@ from src.server import session
 
 SERVERNAME = settings.SERVERNAME
 ENCODINGS = settings.ENCODINGS
+STREAMING = settings.WEBCLIENT_STREAMING
 
 # defining a simple json encoder for returning
 # django data to the client. Might need to
@@ -56,13 +61,19 @@ def jsonify(obj):
 
 class WebClient(resource.Resource):
     """
-    An ajax/comet long-polling transport
+    An ajax/comet long-polling transport, optionally
+    pushing messages over a server-sent-events stream.
+
+    Messages are buffered per suid until the client asks
+    for them; each receive request empties the entire
+    buffer into one json list.
     """
     isLeaf = True
-    allowedMethods = ('POST',)
+    allowedMethods = ('POST', 'GET')
 
     def __init__(self):
         self.requests = {}
+        self.streams = {}
         self.databuffer = {}
 
     #def getChild(self, path, request):
@@ -73,27 +84,38 @@ class WebClient(resource.Resource):
 
     def _responseFailed(self, failure, suid, request):
         "callback if a request is lost/timed out"
-        try:
+        if self.requests.get(suid) is request:
             del self.requests[suid]
-        except KeyError:
-            pass
+
+    def _streamClosed(self, result, suid, request):
+        "callback when a stream is closed by either side"
+        if self.streams.get(suid) is request:
+            del self.streams[suid]
+
+    def _streamWrite(self, request, entries):
+        "write a list of entries to a stream as one server-sent event"
+        request.write("data: %s\n\n" % jsonify(entries))
 
     def lineSend(self, suid, string, data=None):
         """
         This adds the data to the buffer and/or sends it to
         the client as soon as possible.
         """
+        entry = {'msg': string, 'data': data}
+        stream = self.streams.get(suid)
+        if stream:
+            # an open stream; push the message directly
+            self._streamWrite(stream, [entry])
+            return
         request = self.requests.get(suid)
         if request:
             # we have a request waiting. Return immediately.
-            request.write(jsonify({'msg': string, 'data': data}))
+            request.write(jsonify([entry]))
             request.finish()
             del self.requests[suid]
         else:
             # no waiting request. Store data in buffer
-            dataentries = self.databuffer.get(suid, [])
-            dataentries.append(jsonify({'msg': string, 'data': data}))
-            self.databuffer[suid] = dataentries
+            self.databuffer.setdefault(suid, []).append(entry)
 
     def client_disconnect(self, suid):
         """
@@ -102,6 +124,8 @@ class WebClient(resource.Resource):
         if suid in self.requests:
             self.requests[suid].finish()
             del self.requests[suid]
+        if suid in self.streams:
+            self.streams.pop(suid).finish()
         if suid in self.databuffer:
             del self.databuffer[suid]
 
@@ -127,7 +151,7 @@ class WebClient(resource.Resource):
             sess.init_session("webclient", remote_addr, self.sessionhandler)
             sess.suid = suid
             sess.sessionhandler.connect(sess)
-        return jsonify({'msg': host_string, 'suid': suid})
+        return jsonify({'msg': host_string, 'suid': suid, 'stream': STREAMING})
 
     def mode_input(self, request):
         """
@@ -151,21 +175,51 @@ class WebClient(resource.Resource):
         that it is ready to receive data as soon as it is
         available. This is the basis of a long-polling (comet)
         mechanism: the server will wait to reply until data is
-        available.
+        available. All buffered messages are returned together
+        as a json list.
         """
         suid = request.args.get('suid', ['0'])[0]
         if suid == '0':
             return ''
 
-        dataentries = self.databuffer.get(suid, [])
+        dataentries = self.databuffer.get(suid)
         if dataentries:
-            return dataentries.pop(0)
+            self.databuffer[suid] = []
+            return jsonify(dataentries)
         request.notifyFinish().addErrback(self._responseFailed, suid, request)
         if suid in self.requests:
             self.requests[suid].finish()  # Clear any stale request.
         self.requests[suid] = request
         return server.NOT_DONE_YET
 
+    def mode_stream(self, request):
+        """
+        This is called by render_GET when the client opens a
+        server-sent-events stream. The response is never finished
+        by us; instead every message is written to it as soon as
+        it is sent. Anything already buffered is flushed at once.
+        """
+        suid = request.args.get('suid', ['0'])[0]
+        if not STREAMING or suid == '0' or suid not in self.databuffer:
+            request.setResponseCode(404)
+            return ''
+
+        request.setHeader('Content-Type', 'text/event-stream')
+        request.setHeader('Cache-Control', 'no-cache')
+        request.notifyFinish().addBoth(self._streamClosed, suid, request)
+        if suid in self.streams:
+            self.streams[suid].finish()  # Clear any stale stream.
+        if suid in self.requests:
+            self.requests.pop(suid).finish()
+        self.streams[suid] = request
+        # make sure the client starts reading immediately
+        request.write(": stream\n\n")
+        dataentries = self.databuffer.get(suid)
+        if dataentries:
+            self.databuffer[suid] = []
+            self._streamWrite(request, dataentries)
+        return server.NOT_DONE_YET
+
     def mode_close(self, request):
         """
         This is called by render_POST when the client is signalling
@@ -209,6 +263,18 @@ class WebClient(resource.Resource):
             # this should not happen if client sends valid data.
             return ''
 
+    def render_GET(self, request):
+        """
+        Twisted calls this with GET requests. The only mode
+        served this way is 'stream', since the browser's
+        EventSource can only open GET requests.
+        """
+        dmode = request.args.get('mode', [None])[0]
+        if dmode == 'stream':
+            return self.mode_stream(request)
+        request.setResponseCode(405)
+        return ''
+
 
 #
 # A session type handling communication over the
@@ -27,6 +27,7 @@ from src.players.models import PlayerDB
 from src.scripts.models import ScriptDB
 from src.server.models import ServerConfig
 from src.server import initial_setup
+from src.server.hookrunner import run_hooks, precompute_hook_overrides
 
 from src.utils.utils import get_evennia_version, mod_import, make_iter
 from src.comms import channelhandler
@@ -76,6 +77,7 @@ WEBSERVER_PORTS = settings.WEBSERVER_PORTS
 WEBSERVER_INTERFACES = settings.WEBSERVER_INTERFACES
 
 GUEST_ENABLED = settings.GUEST_ENABLED
+TYPECLASS_LAZY_INIT = settings.TYPECLASS_LAZY_INIT
 
 # server-channel mappings
 WEBSERVER_ENABLED = settings.WEBSERVER_ENABLED and WEBSERVER_PORTS and WEBSERVER_INTERFACES
@@ -231,15 +233,24 @@ class Evennia(object):
         #update eventual changed defaults
         self.update_defaults()
 
+        # find out which typeclasses override which hooks
+        precompute_hook_overrides()
+
         #print "run_init_hooks:", ObjectDB.get_all_cached_instances()
-        [(o.typeclass, o.at_init()) for o in ObjectDB.get_all_cached_instances()]
-        [(p.typeclass, p.at_init()) for p in PlayerDB.get_all_cached_instances()]
+        if not TYPECLASS_LAZY_INIT:
+            # in lazy mode, at_init is called when each typeclass loads
+            run_hooks(ObjectDB.get_all_cached_instances(), "at_init")
+            run_hooks(PlayerDB.get_all_cached_instances(), "at_init")
 
         with open(SERVER_RESTART, 'r') as f:
             mode = f.read()
+        from src.server.oobhandler import OOB_HANDLER
         if mode in ('True', 'reload'):
-            from src.server.oobhandler import OOB_HANDLER
             OOB_HANDLER.restore()
+        else:
+            # oob trackers are bound to sessions, which don't
+            # survive a shutdown
+            OOB_HANDLER.clear_storage()
 
         from src.scripts.tickerhandler import TICKER_HANDLER
         TICKER_HANDLER.restore()
@@ -305,12 +316,10 @@ class Evennia(object):
 
         if mode == 'reload':
             # call restart hooks
-            yield [(o.typeclass, o.at_server_reload())
-                                   for o in ObjectDB.get_all_cached_instances()]
-            yield [(p.typeclass, p.at_server_reload())
-                                   for p in PlayerDB.get_all_cached_instances()]
-            yield [(s.typeclass, s.pause(), s.at_server_reload())
-                                   for s in ScriptDB.get_all_cached_instances()]
+            run_hooks(ObjectDB.get_all_cached_instances(), "at_server_reload")
+            run_hooks(PlayerDB.get_all_cached_instances(), "at_server_reload")
+            run_hooks(ScriptDB.get_all_cached_instances(), "at_server_reload",
+                      always=lambda script: script.pause())
             yield self.sessions.all_sessions_portal_sync()
             ServerConfig.objects.conf("server_restart_mode", "reload")
 
@@ -325,24 +334,26 @@ class Evennia(object):
             if mode == 'reset':
                 # don't unset the is_connected flag on reset, otherwise
                 # same as shutdown
-                yield [(o.typeclass, o.at_server_shutdown())
-                                   for o in ObjectDB.get_all_cached_instances()]
-                yield [(p.typeclass, p.at_server_shutdown())
-                                       for p in PlayerDB.get_all_cached_instances()]
+                run_hooks(ObjectDB.get_all_cached_instances(), "at_server_shutdown")
+                run_hooks(PlayerDB.get_all_cached_instances(), "at_server_shutdown")
             else:  # shutdown
                 yield [_SA(p, "is_connected", False)
                                    for p in PlayerDB.get_all_cached_instances()]
-                yield [(o.typeclass, o.at_server_shutdown())
-                                   for o in ObjectDB.get_all_cached_instances()]
-                yield [(p.typeclass, p.unpuppet_all(), p.at_server_shutdown())
-                                       for p in PlayerDB.get_all_cached_instances()]
-            yield [(s.typeclass, s.at_server_shutdown())
-                                   for s in ScriptDB.get_all_cached_instances()]
+                run_hooks(ObjectDB.get_all_cached_instances(), "at_server_shutdown")
+                run_hooks(PlayerDB.get_all_cached_instances(), "at_server_shutdown",
+                          always=lambda player: player.unpuppet_all())
+            run_hooks(ScriptDB.get_all_cached_instances(), "at_server_shutdown")
             yield ObjectDB.objects.clear_all_sessids()
             ServerConfig.objects.conf("server_restart_mode", "reset")
 
             self.at_server_cold_stop()
 
+        # save Attributes with unsaved changes
+        from src.utils.dbserialize import flush_unsaved_mutables
+        from src.typeclasses.models import flush_attribute_saves
+        flush_unsaved_mutables()
+        flush_attribute_saves()
+
         # stopping time
         from src.utils import gametime
         gametime.save()
@@ -186,6 +186,35 @@ class ServerSessionHandler(SessionHandler):
         self.sessions = {}
         self.server = None
         self.server_data = {"servername": SERVERNAME}
+        # lookup index {uid: set(sessids)}, and the uid each
+        # sessid is currently indexed under
+        self._uid_index = {}
+        self._indexed = {}
+
+    def reindex(self, session):
+        """
+        Update the player lookup index for a session. This must be
+        called whenever the session's uid or login state changes.
+        """
+        self._unindex(session.sessid)
+        if session.sessid in self.sessions:
+            uid = getattr(session, "uid", None) if session.logged_in else None
+            if uid:
+                self._uid_index.setdefault(uid, set()).add(session.sessid)
+                self._indexed[session.sessid] = uid
+
+    def _unindex(self, sessid):
+        "Remove a sessid from the lookup index"
+        uid = self._indexed.pop(sessid, None)
+        if uid in self._uid_index:
+            self._uid_index[uid].discard(sessid)
+            if not self._uid_index[uid]:
+                del self._uid_index[uid]
+
+    def _sessions_from_index(self, index, key):
+        "Get the sessions stored under key in index, ordered by sessid"
+        return [self.sessions[sessid] for sessid in sorted(index.get(key, ()))
+                if sessid in self.sessions]
 
     def portal_connect(self, portalsession):
         """
@@ -207,9 +236,10 @@ class ServerSessionHandler(SessionHandler):
             # protocols like SSH
             sess.player = _PlayerDB.objects.get_player_from_uid(sess.uid)
         sess.at_sync()
-        # validate all scripts
-        _ScriptDB.objects.validate()
+        # validate the scripts concerned by connections
+        _ScriptDB.objects.validate(event="connect")
         self.sessions[sess.sessid] = sess
+        self.reindex(sess)
         sess.data_in(CMD_LOGINSTART)
 
     def portal_session_sync(self, portalsessiondata):
@@ -226,6 +256,7 @@ class ServerSessionHandler(SessionHandler):
             # ones which should only be changed from portal (like
             # protocol_flags etc)
             session.load_sync_data(portalsessiondata)
+            self.reindex(session)
 
     def portal_disconnect(self, sessid):
         """
@@ -243,6 +274,7 @@ class ServerSessionHandler(SessionHandler):
         session.at_disconnect()
         session.disconnect()
         del self.sessions[session.sessid]
+        self._unindex(session.sessid)
 
     def portal_sessions_sync(self, portalsessions):
         """
@@ -268,6 +300,7 @@ class ServerSessionHandler(SessionHandler):
             if sess.uid:
                 sess.player = _PlayerDB.objects.get_player_from_uid(sess.uid)
             self.sessions[sessid] = sess
+            self.reindex(sess)
             sess.at_sync()
 
         # after sync is complete we force-validate all scripts
@@ -323,6 +356,7 @@ class ServerSessionHandler(SessionHandler):
 
         # sets up and assigns all properties on the session
         session.at_login(player)
+        self.reindex(session)
 
         # player init
         player.at_init()
@@ -369,6 +403,7 @@ class ServerSessionHandler(SessionHandler):
         session.at_disconnect()
         sessid = session.sessid
         del self.sessions[sessid]
+        self._unindex(sessid)
         # inform portal that session should be closed.
         self.server.amp_protocol.call_remote_PortalAdmin(sessid,
                                                          operation=SDISCONN,
@@ -402,7 +437,7 @@ class ServerSessionHandler(SessionHandler):
         Disconnects any existing sessions with the same user.
         """
         uid = curr_session.uid
-        doublet_sessions = [sess for sess in self.sessions.values()
+        doublet_sessions = [sess for sess in self._sessions_from_index(self._uid_index, uid)
                             if sess.logged_in
                             and sess.uid == uid
                             and sess != curr_session]
@@ -427,7 +462,8 @@ class ServerSessionHandler(SessionHandler):
         player may have more than one session depending on settings).
         Only logged-in players are counted here.
         """
-        return len(set(session.uid for session in self.sessions.values() if session.logged_in))
+        return len([uid for uid in self._uid_index
+                    if any(sess.logged_in for sess in self._sessions_from_index(self._uid_index, uid))])
 
     def session_from_sessid(self, sessid):
         """
@@ -453,7 +489,8 @@ class ServerSessionHandler(SessionHandler):
         Given a player, return all matching sessions.
         """
         uid = player.uid
-        return [session for session in self.sessions.values() if session.logged_in and session.uid == uid]
+        return [session for session in self._sessions_from_index(self._uid_index, uid)
+                if session.logged_in and session.uid == uid]
 
     def sessions_from_character(self, character):
         """
@@ -461,7 +498,7 @@ class ServerSessionHandler(SessionHandler):
         """
         sessid = character.sessid.get()
         if is_iter(sessid):
-            return [self.sessions.get(sess) for sess in sessid if sessid in self.sessions]
+            return [self.sessions.get(sess) for sess in sessid if sess in self.sessions]
         return self.sessions.get(sessid)
 
     def announce_all(self, message):
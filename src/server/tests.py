@@ -49,6 +49,33 @@ class EvenniaTestSuiteRunner(DjangoTestSuiteRunner):
         return super(EvenniaTestSuiteRunner, self).build_suite(test_labels, extra_tests=extra_tests, **kwargs)
 
 
+
+class TestStoreEntry(TestCase):
+    "Test the StoreEntry persistent store"
+    def setUp(self):
+        from src.server.models import StoreEntry
+        self.manager = StoreEntry.objects
+        self.store = "test_store"
+
+    def tearDown(self):
+        self.manager.clear(self.store)
+
+    def test_roundtrip(self):
+        key = (("__packed_dbobj__", ("objects", "objectdb"), "2014:01:01-00:00:00:000000", 300), 10, "")
+        value = ((u"caf\xe9", 256), {"_start_delay": 2.5})
+        self.manager.set_entry(self.store, key, value)
+        self.assertEqual(self.manager.load(self.store), {key: value})
+        self.manager.set_entry(self.store, key, "new")
+        self.assertEqual(self.manager.load(self.store), {key: "new"})
+        self.manager.del_entry(self.store, key)
+        self.assertEqual(self.manager.load(self.store), {})
+
+    def test_equal_keys(self):
+        self.manager.set_entry(self.store, ("obj", 10, u"x"), 1)
+        self.manager.del_entry(self.store, ("obj", 10.0, "x"))
+        self.assertEqual(self.manager.load(self.store), {})
+
+
 def suite():
     """
     This function is called automatically by the django test runner.
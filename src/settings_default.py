@@ -62,6 +62,11 @@ WEBSERVER_THREADPOOL_LIMITS = (1, 20)
 # offers the fallback ajax-based webclient backbone for browsers not supporting
 # the websocket one.
 WEBCLIENT_ENABLED = True
+# If set, the ajax webclient will (in browsers supporting it) keep one
+# server-sent-events response open and have messages pushed to it as
+# they arrive, instead of long-polling for them. Some proxies buffer
+# streamed responses; turn this off if messages appear delayed.
+WEBCLIENT_STREAMING = False
 # Activate Websocket support for modern browsers. If this is on, the
 # default webclient will use this and only use the ajax version of the browser
 # is too old to support websockets. Requires WEBCLIENT_ENABLED.
@@ -147,26 +152,24 @@ AMP_INTERFACE = '127.0.0.1'
 # caching results in a massive speedup of the server (since it dramatically
 # limits the number of database accesses needed) and also allows for
 # storing temporary data on objects. It is however also the main memory
-# consumer of Evennia. With this setting the cache can be capped and
-# flushed when it reaches a certain size. Minimum is 50 MB but it is
-# not recommended to set this to less than 100 MB for a distribution
-# system.
-# Empirically, N_objects_in_cache ~ ((RMEM - 35) / 0.0157):
-#  mem(MB)   |  objs in cache   ||   mem(MB)   |   objs in cache
-#      50    |       ~1000      ||      800    |     ~49 000
-#     100    |       ~4000      ||     1200    |     ~75 000
-#     200    |      ~10 000     ||     1600    |    ~100 000
-#     500    |      ~30 000     ||     2000    |    ~125 000
-# Note that the estimated memory usage is not exact (and the cap is only
-# checked every 5 minutes), so err on the side of caution if
-# running on a server with limited memory. Also note that Python
-# will not necessarily return the memory to the OS when the idmapper
-# flashes (the memory will be freed and made available to the Python
-# process only). How many objects need to be in memory at any given
-# time depends very much on your game so some experimentation may
-# be necessary (use @server to see how many objects are in the idmapper
-# cache at any time). Setting this to None disables the cache cap.
-IDMAPPER_CACHE_MAXSIZE = 200      # (MB)
+# consumer of Evennia. With this setting the cache of each database
+# model (objects, players, scripts, attributes etc) is capped at the
+# given number of instances. When a model's cache is full, the least
+# recently used instances are dropped from it, one at a time as new
+# ones are loaded. Instances with connected sessions, or which are
+# otherwise protected from recaching, are never dropped.
+# Empirically, each 10 000 cached objects cost about 150-200 MB of
+# memory. How many objects need to be in memory at any given time
+# depends very much on your game so some experimentation may be
+# necessary (use @server to see how many objects are in the idmapper
+# cache and how often they are dropped). Setting this to None
+# disables the cache cap, which is the default. Entities with ndb data
+# are never dropped; other objects, players and scripts are, and get
+# their typeclass reloaded (calling at_init) when next used. Custom
+# code must not keep references to database entities across
+# operations when the cap is active, since a dropped instance is no
+# longer updated and a later lookup will load a separate copy.
+IDMAPPER_CACHE_MAX_INSTANCES = None
 
 ######################################################################
 # Evennia Database config
@@ -239,6 +242,11 @@ MSSP_META_MODULE = ""
 # Tuple of modules implementing lock functions. All callable functions
 # inside these modules will be available as lock functions.
 LOCK_FUNC_MODULES = ("src.locks.lockfuncs",)
+# Parsed lock definitions are cached and shared by all objects having
+# the same lockstring (such as the defaults set when objects are
+# created). This is the maximum number of unique lockstrings kept in
+# the cache before the least recently used ones are dropped.
+LOCKSTRING_CACHE_SIZE = 5000
 # Module holding OOB (Out of Band) hook objects. This allows for customization
 # and expansion of which hooks OOB protocols are allowed to call on the server
 # protocols for attaching tracker hooks for when various object field change
@@ -267,6 +275,12 @@ CMDSET_CHARACTER = "src.commands.default.cmdset_character.CharacterCmdSet"
 CMDSET_PLAYER = "src.commands.default.cmdset_player.PlayerCmdSet"
 # Location to search for cmdsets if full path not given
 CMDSET_PATHS = ["game.gamesrc.commands"]
+# The command handler caches the result of merging cmdsets, so that
+# players sharing the same cmdsets (like when standing in the same room)
+# don't have to re-merge them for every command. This is the maximum
+# number of merged cmdsets kept in the cache before the least recently
+# used ones are dropped.
+CMDSET_MERGE_CACHE_SIZE = 1000
 
 ######################################################################
 # Typeclasses and other paths
@@ -318,6 +332,39 @@ START_LOCATION = "#2"
 # out of sync between the processes. Keep on unless you face such
 # issues.
 TYPECLASS_AGGRESSIVE_CACHE = True
+# Normally all Attributes on an object are loaded together the first
+# time any of them is accessed. If this is set, each Attribute is
+# instead loaded when it is first accessed. This saves memory and
+# time for objects with many Attributes of which only a few are used.
+TYPECLASS_LAZY_ATTRIBUTES = False
+# Changing the value of an Attribute normally saves it to the database
+# right away. If this is set to a number of seconds, changed Attributes
+# are instead saved together (in one transaction) at most this many
+# seconds later, as well as when the server reloads or shuts down.
+# This is much faster for often-changing Attributes, but changes made
+# within this time are lost if the server crashes.
+ATTRIBUTE_WRITE_BEHIND_DELAY = 0
+# Changing a list, dict or set stored in an Attribute in-place (like
+# obj.db.mydict["key"] = value) normally saves the whole Attribute at
+# once. If this is set, the Attribute is instead saved only once at the
+# end of the current server tick, no matter how many times it changed.
+ATTRIBUTE_DEFER_MUTABLE_SAVES = False
+# A typeclass is loaded (and its at_init hook called) the first time
+# its database object is used. Normally the server will in addition
+# call at_init on all objects already in memory when it starts. If this
+# is set, that startup sweep is skipped, so each typeclass is only
+# loaded and initialized when something actually accesses it.
+TYPECLASS_LAZY_INIT = False
+# The TickerHandler normally calls all objects subscribing to a given
+# interval at the same time. With many subscribers this causes a lag
+# spike every interval. If this is set to a number N > 1, subscribers
+# are instead divided into N groups, spread evenly across the interval
+# (every subscriber is still called once per interval).
+TICKER_SUBDIVISIONS = 1
+# Max time (in seconds) a ticker may spend calling subscribers before
+# letting the server handle other things. Remaining subscribers are
+# called as soon as possible after that. None means no limit.
+TICKER_TIME_BUDGET = 0.05
 
 ######################################################################
 # Batch processors
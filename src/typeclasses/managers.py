@@ -12,6 +12,9 @@ __all__ = ("AttributeManager", "TypedObjectManager")
 _GA = object.__getattribute__
 _Tag = None
 
+# max number of objects to prefetch Attributes/Tags for in one query
+_PREFETCH_BATCH_SIZE = 500
+
 #
 # helper functions for the TypedObjectManager.
 #
@@ -175,6 +178,59 @@ class TypedObjectManager(idmapper.manager.SharedMemoryManager):
             tag.save()
         return make_iter(tag)[0]
 
+    # Bulk loading of Attributes and Tags
+
+    def _prefetch_handlers(self, dbobjs, m2m_fieldname, relname, typename, handlernames):
+        """
+        Helper for prefetch. Fills the caches of the given handlers on
+        all dbobjs (unless already cached) using one query per batch of
+        objects on the through table of m2m_fieldname.
+        """
+        modelname = self.model.__name__.lower()
+        handlers = {}
+        for dbobj in dbobjs:
+            for handlername in handlernames:
+                if not hasattr(dbobj.__class__, handlername):
+                    continue
+                handler = _GA(dbobj, handlername)
+                if not getattr(handler, "_cache_complete", handler._cache is not None):
+                    handlers[(_GA(dbobj, "id"), getattr(handler, typename))] = handler
+        if not handlers:
+            return
+        objids = list(set(key[0] for key in handlers))
+        found = dict((key, []) for key in handlers)
+        through = getattr(self.model, m2m_fieldname).through
+        for istart in xrange(0, len(objids), _PREFETCH_BATCH_SIZE):
+            query = {"%s__id__in" % modelname: objids[istart:istart + _PREFETCH_BATCH_SIZE]}
+            for conn in through.objects.filter(**query).select_related(relname):
+                relobj = getattr(conn, relname)
+                key = (getattr(conn, "%s_id" % modelname), getattr(relobj, "db_%s" % typename.lstrip("_")))
+                if key in found:
+                    found[key].append(relobj)
+        for key, handler in handlers.items():
+            handler._set_cache(found[key])
+
+    def prefetch(self, objs, attributes=True, tags=True):
+        """
+        Loads the Attributes (including Nicks) and Tags (including
+        Aliases and Permissions) of many objects at once, filling the
+        caches of their handlers. This avoids one database query per
+        object and handler when looping over many objects, such as the
+        contents of a room or a search result.
+
+        objs - objects (typeclassed or not) of this manager's model.
+               Handlers that are already cached are not reloaded.
+        attributes - prefetch Attributes and Nicks
+        tags - prefetch Tags, Aliases and Permissions
+        """
+        dbobjs = [_GA(obj, "dbobj") for obj in make_iter(objs) if obj]
+        if attributes:
+            self._prefetch_handlers(dbobjs, "db_attributes", "attribute",
+                                    "_attrtype", ("attributes", "nicks"))
+        if tags:
+            self._prefetch_handlers(dbobjs, "db_tags", "tag",
+                                    "_tagtype", ("tags", "aliases", "permissions"))
+
     # object-manager methods
 
     def dbref(self, dbref, reqhash=True):
@@ -30,8 +30,9 @@ import sys
 import re
 import traceback
 import weakref
+from itertools import count
 
-from django.db import models
+from django.db import models, transaction
 from django.core.exceptions import ObjectDoesNotExist
 from django.conf import settings
 from django.utils.encoding import smart_str
@@ -43,11 +44,15 @@ from src.server.caches import get_prop_cache, set_prop_cache
 #from src.server.caches import call_ndb_hooks
 from src.server.models import ServerConfig
 from src.typeclasses import managers
+from src.typeclasses.typeclass import (
+        _RESOLUTION_CACHE, resolves_elsewhere, clear_resolution_cache)
 from src.locks.lockhandler import LockHandler
 from src.utils import logger
 from src.utils.utils import (
     make_iter, is_iter, to_str, inherits_from, lazy_property)
-from src.utils.dbserialize import to_pickle, from_pickle
+from src.utils.dbserialize import (
+    to_pickle, from_pickle, unsaved_mutable, discard_unsaved_mutable,
+    is_current_dbobj, is_cacheable_value, typeclass_path_of)
 from src.utils.picklefield import PickledObjectField
 
 __all__ = ("Attribute", "TypeNick", "TypedObject")
@@ -56,11 +61,19 @@ TICKER_HANDLER = None
 
 _PERMISSION_HIERARCHY = [p.lower() for p in settings.PERMISSION_HIERARCHY]
 _TYPECLASS_AGGRESSIVE_CACHE = settings.TYPECLASS_AGGRESSIVE_CACHE
+_TYPECLASS_LAZY_ATTRIBUTES = settings.TYPECLASS_LAZY_ATTRIBUTES
+_ATTRIBUTE_WRITE_BEHIND_DELAY = settings.ATTRIBUTE_WRITE_BEHIND_DELAY
 
 _GA = object.__getattribute__
 _SA = object.__setattr__
 _DA = object.__delattr__
 
+# version stamps for nick changes (never reused)
+_NICK_VERSION = count(1)
+
+# the instance attributes every typeclass has (see TypeClass.__init__)
+_PLAIN_TYPECLASS_STATE = ("dbobj", "typeclass")
+
 
 #------------------------------------------------------------
 #
@@ -68,6 +81,78 @@ _DA = object.__delattr__
 #
 #------------------------------------------------------------
 
+# Attributes waiting to be saved, stored as
+# {id(attr): (attr, set(fieldnames), previous recache protection)}
+_ATTRIBUTE_SAVE_QUEUE = {}
+_ATTRIBUTE_FLUSH_CALL = None
+
+
+def _queue_attribute(attr, fieldnames, protected):
+    "Queue fields of an Attribute for saving by flush_attribute_saves"
+    global _ATTRIBUTE_FLUSH_CALL
+    try:
+        _ATTRIBUTE_SAVE_QUEUE[id(attr)][1].update(fieldnames)
+    except KeyError:
+        _ATTRIBUTE_SAVE_QUEUE[id(attr)] = (attr, set(fieldnames), protected)
+        # don't let the idmapper drop the only up-to-date copy
+        attr.set_recache_protection(True)
+    if not _ATTRIBUTE_FLUSH_CALL:
+        from twisted.internet import reactor
+        _ATTRIBUTE_FLUSH_CALL = reactor.callLater(_ATTRIBUTE_WRITE_BEHIND_DELAY,
+                                                  flush_attribute_saves)
+
+
+def _save_attribute(attr, fieldname):
+    """
+    Save a field on an Attribute. With write-behind active, the save is
+    queued and done together with others by flush_attribute_saves.
+    """
+    if not _ATTRIBUTE_WRITE_BEHIND_DELAY:
+        attr.save(update_fields=[fieldname])
+        return
+    _queue_attribute(attr, (fieldname,), _GA(attr, "_idmapper_recache_protection"))
+
+
+def flush_attribute_saves():
+    """
+    Save all Attributes queued by the write-behind, in one transaction.
+    This is called automatically after settings.ATTRIBUTE_WRITE_BEHIND_DELAY
+    seconds, and when the server reloads or shuts down.
+
+    If the transaction fails, the Attributes are saved one by one
+    instead. Those still failing are queued again for the next flush.
+    """
+    global _ATTRIBUTE_FLUSH_CALL
+    if _ATTRIBUTE_FLUSH_CALL and _ATTRIBUTE_FLUSH_CALL.active():
+        _ATTRIBUTE_FLUSH_CALL.cancel()
+    _ATTRIBUTE_FLUSH_CALL = None
+    queue = _ATTRIBUTE_SAVE_QUEUE.values()
+    _ATTRIBUTE_SAVE_QUEUE.clear()
+    if not queue:
+        return
+    failed = []
+    try:
+        with transaction.atomic():
+            for attr, fieldnames, _ in queue:
+                if attr.pk:
+                    # deleted Attributes have no pk
+                    attr.save(update_fields=list(fieldnames))
+    except Exception:
+        logger.log_trace("Error saving %i queued Attributes, retrying one by one." % len(queue))
+        for item in queue:
+            attr, fieldnames, _ = item
+            try:
+                if attr.pk:
+                    attr.save(update_fields=list(fieldnames))
+            except Exception:
+                logger.log_trace("Error saving Attribute %s." % attr)
+                failed.append(item)
+    for attr, fieldnames, protected in queue:
+        attr.set_recache_protection(protected)
+    for attr, fieldnames, protected in failed:
+        _queue_attribute(attr, fieldnames, protected)
+
+
 class Attribute(SharedMemoryModel):
     """
     Abstract django model.
@@ -129,6 +214,9 @@ class Attribute(SharedMemoryModel):
     # Database manager
     #objects = managers.AttributeManager()
 
+    # (db_value, value, dbobjs) of the last deserialized value
+    _value_cache = None
+
     @lazy_property
     def locks(self):
         return LockHandler(self)
@@ -168,11 +256,29 @@ class Attribute(SharedMemoryModel):
     def __value_get(self):
         """
         Getter. Allows for value = self.value.
-        We cannot cache here since it makes certain cases (such
-        as storing a dbobj which is then deleted elsewhere) out-of-sync.
-        The overhead of unpickling seems hard to avoid.
+        The deserialized value is cached until db_value changes or one
+        of the database objects in it is deleted, flushed from the
+        idmapper cache or gets a new typeclass (otherwise it would go
+        out-of-sync). Values that could be changed in-place without
+        saving (like instances of custom classes) are never cached.
         """
-        return from_pickle(self.db_value, db_obj=self)
+        unsaved = unsaved_mutable(self)
+        if unsaved is not None:
+            # changed in-place and waiting to be saved
+            return unsaved
+        db_value = self.db_value
+        cache = self._value_cache
+        if cache and cache[0] is db_value and all(is_current_dbobj(dbobj, path)
+                                                  for dbobj, path in cache[2]):
+            return cache[1]
+        dbobjs = []
+        value = from_pickle(db_value, db_obj=self, dbobjs=dbobjs)
+        if is_cacheable_value(value):
+            self._value_cache = (db_value, value,
+                                 [(dbobj, typeclass_path_of(dbobj)) for dbobj in dbobjs])
+        else:
+            self._value_cache = None
+        return value
 
     #@value.setter
     def __value_set(self, new_value):
@@ -180,8 +286,10 @@ class Attribute(SharedMemoryModel):
         Setter. Allows for self.value = value. We cannot cache here,
         see self.__value_get.
         """
+        discard_unsaved_mutable(self)
+        self._value_cache = None
         self.db_value = to_pickle(new_value)
-        self.save(update_fields=["db_value"])
+        _save_attribute(self, "db_value")
 
     #@value.deleter
     def __value_del(self):
@@ -234,15 +342,58 @@ class AttributeHandler(object):
         self._objid = obj.id
         self._model = to_str(obj.__class__.__name__.lower())
         self._cache = None
+        self._cache_complete = False
 
     def _recache(self):
         "Cache all attributes of this object"
         query = {"%s__id" % self._model : self._objid,
                  "attribute__db_attrtype" : self._attrtype}
-        attrs = [conn.attribute for conn in getattr(self.obj, self._m2m_fieldname).through.objects.filter(**query)]
+        attrs = [conn.attribute for conn in getattr(self.obj, self._m2m_fieldname).through.objects.filter(
+                                                                            **query).select_related("attribute")]
+        self._set_cache(attrs)
+
+    def _set_cache(self, attrs):
+        "Cache the given Attributes as all the attributes of this object"
         self._cache = dict(("%s-%s" % (to_str(attr.db_key).lower(),
-                                       attr.db_category.lower() if conn.attribute.db_category else None),
+                                       attr.db_category.lower() if attr.db_category else None),
                             attr) for attr in attrs)
+        self._cache_complete = True
+
+    def _load(self, keys, category):
+        """
+        Make sure the Attributes with the given (lowercase) keys and
+        category are cached. With settings.TYPECLASS_LAZY_ATTRIBUTES
+        only those Attributes are loaded (non-existing ones are cached
+        as None), otherwise all Attributes on the object are.
+        """
+        if not _TYPECLASS_LAZY_ATTRIBUTES:
+            if self._cache is None or not _TYPECLASS_AGGRESSIVE_CACHE:
+                self._recache()
+            return
+        if self._cache is None or not _TYPECLASS_AGGRESSIVE_CACHE:
+            self._cache = {}
+            self._cache_complete = False
+        elif self._cache_complete:
+            return
+        cachekeys = dict(("%s-%s" % (key, category), key) for key in keys)
+        missing = [key for cachekey, key in cachekeys.items() if cachekey not in self._cache]
+        if not missing:
+            return
+        query = {"%s__id" % self._model : self._objid,
+                 "attribute__db_attrtype" : self._attrtype,
+                 "attribute__db_key__in" : missing}
+        for conn in getattr(self.obj, self._m2m_fieldname).through.objects.filter(
+                                                            **query).select_related("attribute"):
+            attr = conn.attribute
+            self._cache["%s-%s" % (to_str(attr.db_key).lower(),
+                                   attr.db_category.lower() if attr.db_category else None)] = attr
+        for cachekey in cachekeys:
+            self._cache.setdefault(cachekey, None)
+
+    def _load_all(self):
+        "Make sure all Attributes on the object are cached"
+        if self._cache is None or not _TYPECLASS_AGGRESSIVE_CACHE or not self._cache_complete:
+            self._recache()
 
     def has(self, key, category=None):
         """
@@ -251,12 +402,11 @@ class AttributeHandler(object):
 
         If an iterable is given, returns list of booleans.
         """
-        if self._cache is None or not _TYPECLASS_AGGRESSIVE_CACHE:
-            self._recache()
         key = [k.strip().lower() for k in make_iter(key) if k]
         category = category.strip().lower() if category is not None else None
+        self._load(key, category)
         searchkeys = ["%s-%s" % (k, category) for k in make_iter(key)]
-        ret = [self._cache.get(skey) for skey in searchkeys if skey in self._cache]
+        ret = [self._cache.get(skey) for skey in searchkeys if self._cache.get(skey)]
         return ret[0] if len(ret) == 1 else ret
 
     def get(self, key=None, category=None, default=None, return_obj=False,
@@ -283,17 +433,17 @@ class AttributeHandler(object):
                 self.value = default
                 self.strvalue = str(default) if default is not None else None
 
-        if self._cache is None or not _TYPECLASS_AGGRESSIVE_CACHE:
-            self._recache()
         ret = []
         key = [k.strip().lower() for k in make_iter(key) if k]
         category = category.strip().lower() if category is not None else None
         #print "cache:", self._cache.keys(), key
         if not key:
             # return all with matching category (or no category)
+            self._load_all()
             catkey = "-%s" % category if category is not None else None
             ret = [attr for key, attr in self._cache.items() if key and key.endswith(catkey)]
         else:
+            self._load(key, category)
             for searchkey in ("%s-%s" % (k, category) for k in key):
                 attr_obj = self._cache.get(searchkey)
                 if attr_obj:
@@ -331,13 +481,12 @@ class AttributeHandler(object):
                                       self._attrcreate, default=default_access):
             # check create access
             return
-        if self._cache is None:
-            self._recache()
         if not key:
             return
 
         category = category.strip().lower() if category is not None else None
         keystr = key.strip().lower()
+        self._load([keystr], category)
         cachekey = "%s-%s" % (keystr, category)
         attr_obj = self._cache.get(cachekey)
 
@@ -346,7 +495,7 @@ class AttributeHandler(object):
             if strattr:
                 # store as a simple string (will not notify OOB handlers)
                 attr_obj.db_strvalue = value
-                attr_obj.save(update_fields=["db_strvalue"])
+                _save_attribute(attr_obj, "db_strvalue")
             else:
                 # store normally (this will also notify OOB handlers)
                 attr_obj.value = value
@@ -376,8 +525,6 @@ class AttributeHandler(object):
                                       self._attrcreate, default=default_access):
             # check create access
             return
-        if self._cache is None:
-            self._recache()
         if not key:
             return
 
@@ -386,6 +533,7 @@ class AttributeHandler(object):
         if len(keys) != len(values):
             raise RuntimeError("AttributeHandler.add(): key and value of different length: %s vs %s" % key, value)
         category = category.strip().lower() if category is not None else None
+        self._load([keystr.strip().lower() for keystr in keys], category)
         new_attrobjs = []
         for ikey, keystr in enumerate(keys):
             keystr = keystr.strip().lower()
@@ -398,7 +546,7 @@ class AttributeHandler(object):
                 if strattr:
                     # store as a simple string (will not notify OOB handlers)
                     attr_obj.db_strvalue = new_value
-                    attr_obj.save(update_fields=["db_strvalue"])
+                    _save_attribute(attr_obj, "db_strvalue")
                 else:
                     # store normally (this will also notify OOB handlers)
                     attr_obj.value = new_value
@@ -424,10 +572,9 @@ class AttributeHandler(object):
         If accessing_obj is given, will check against the 'attredit' lock.
         If not given, this check is skipped.
         """
-        if self._cache is None or not _TYPECLASS_AGGRESSIVE_CACHE:
-            self._recache()
         key = [k.strip().lower() for k in make_iter(key) if k]
         category = category.strip().lower() if category is not None else None
+        self._load(key, category)
         for searchstr in ("%s-%s" % (k, category) for k in key):
             attr_obj = self._cache.get(searchstr)
             if attr_obj:
@@ -444,8 +591,7 @@ class AttributeHandler(object):
         given, check the 'attredit' lock on each Attribute before
         continuing. If not given, skip check.
         """
-        if self._cache is None or not _TYPECLASS_AGGRESSIVE_CACHE:
-            self._recache()
+        self._load_all()
         if accessing_obj:
             [attr.delete() for attr in self._cache.values()
              if attr.access(accessing_obj, self._attredit, default=default_access)]
@@ -461,8 +607,7 @@ class AttributeHandler(object):
         each attribute before returning them. If not given, this
         check is skipped.
         """
-        if self._cache is None or not _TYPECLASS_AGGRESSIVE_CACHE:
-            self._recache()
+        self._load_all()
         attrs = sorted(self._cache.values(), key=lambda o: o.id)
         if accessing_obj:
             return [attr for attr in attrs
@@ -480,6 +625,15 @@ class NickHandler(AttributeHandler):
     with categories nick_<nicktype>
     """
     _attrtype = "nick"
+    # changes whenever the nicks change
+    _version = 0
+    # (key, regex, replacements) used by nickreplace
+    _matcher = None
+
+    def _set_cache(self, attrs):
+        "Cache the given nicks, marking the nicks as changed"
+        super(NickHandler, self)._set_cache(attrs)
+        self._version = _NICK_VERSION.next()
 
     def has(self, key, category="inputline"):
         return super(NickHandler, self).has(key, category=category)
@@ -491,26 +645,53 @@ class NickHandler(AttributeHandler):
     def add(self, key, replacement, category="inputline", **kwargs):
         "Add a new nick"
         super(NickHandler, self).add(key, replacement, category=category, strattr=True, **kwargs)
+        self._version = _NICK_VERSION.next()
 
     def remove(self, key, category="inputline", **kwargs):
         "Remove Nick with matching category"
         super(NickHandler, self).remove(key, category=category, **kwargs)
+        self._version = _NICK_VERSION.next()
+
+    def _matcher_key(self, categories, player_nicks):
+        "Identifies the nicks a matcher was built from"
+        return (categories, self._version, player_nicks,
+                player_nicks._version if player_nicks else None)
 
     def nickreplace(self, raw_string, categories=("inputline", "channel"), include_player=True):
-        "Replace entries in raw_string with nick replacement"
-        raw_string
-        obj_nicks, player_nicks = [], []
-        for category in make_iter(categories):
-            obj_nicks.extend([n for n in make_iter(self.get(category=category, return_obj=True)) if n])
+        """
+        Replace entries in raw_string with nick replacement. The first
+        matching nick of this object (or of its player) is used.
+
+        All nick keys are compiled into one regex, which is rebuilt only
+        when the nicks of this object or its player change.
+        """
+        categories = tuple(make_iter(categories))
+        player_nicks = None
         if include_player and self.obj.has_player:
-            for category in make_iter(categories):
-                player_nicks.extend([n for n in make_iter(self.obj.player.nicks.get(category=category, return_obj=True)) if n])
-        for nick in obj_nicks + player_nicks:
+            player_nicks = self.obj.player.nicks
+        matcher = self._matcher
+        if (not matcher or not _TYPECLASS_AGGRESSIVE_CACHE or
+                matcher[0] != self._matcher_key(categories, player_nicks)):
+            nicks = []
+            for category in categories:
+                nicks.extend([n for n in make_iter(self.get(category=category, return_obj=True)) if n])
+            if player_nicks:
+                for category in categories:
+                    nicks.extend([n for n in make_iter(player_nicks.get(category=category, return_obj=True)) if n])
+            nicks = [nick for nick in nicks if nick.db_key]
+            replacements = {}
+            for nick in nicks:
+                # the first nick with a given key is the one to use
+                replacements.setdefault(nick.db_key.lower(), nick.db_strvalue)
             # make a case-insensitive match here
-            match = re.match(re.escape(nick.db_key), raw_string, re.IGNORECASE)
-            if match:
-                raw_string = raw_string.replace(match.group(), nick.db_strvalue, 1)
-                break
+            regex = re.compile("|".join(re.escape(nick.db_key) for nick in nicks),
+                               re.IGNORECASE) if nicks else None
+            matcher = (self._matcher_key(categories, player_nicks), regex, replacements)
+            self._matcher = matcher
+        regex, replacements = matcher[1], matcher[2]
+        match = regex and regex.match(raw_string)
+        if match and match.group().lower() in replacements:
+            raw_string = raw_string.replace(match.group(), replacements[match.group().lower()], 1)
         return raw_string
 
 
@@ -633,7 +814,12 @@ class TagHandler(object):
         "Cache all tags of this object"
         query = {"%s__id" % self._model : self._objid,
                  "tag__db_tagtype" : self._tagtype}
-        tagobjs = [conn.tag for conn in getattr(self.obj, self._m2m_fieldname).through.objects.filter(**query)]
+        tagobjs = [conn.tag for conn in getattr(self.obj, self._m2m_fieldname).through.objects.filter(
+                                                                            **query).select_related("tag")]
+        self._set_cache(tagobjs)
+
+    def _set_cache(self, tagobjs):
+        "Cache the given Tags as all the tags of this object"
         self._cache = dict(("%s-%s" % (to_str(tagobj.db_key).lower(),
                                        tagobj.db_category.lower() if tagobj.db_category else None),
                             tagobj) for tagobj in tagobjs)
@@ -826,6 +1012,21 @@ class TypedObject(SharedMemoryModel):
     def nattributes(self):
         return NAttributeHandler(self)
 
+    def _idmapper_pinned(self):
+        """
+        Entities holding ndb data, or a typeclass instance with state
+        of its own, are never evicted from the cache, since that state
+        would be lost with them. A plain typeclass is just reloaded
+        (calling at_init) when the entity is next fetched.
+        """
+        if _GA(self, "_idmapper_recache_protection"):
+            return True
+        nattributes = _GA(self, "__dict__").get("nattributes")
+        if nattributes and nattributes._store:
+            return True
+        typeclass = _GA(self, "_cached_typeclass")
+        return (typeclass is not None and
+                any(key not in _PLAIN_TYPECLASS_STATE for key in _GA(typeclass, "__dict__")))
 
     class Meta:
         """
@@ -880,6 +1081,19 @@ class TypedObject(SharedMemoryModel):
         the typeclass refers back to the databaseobject as well, we
         have to be very careful to avoid loops.
         """
+        if propname[:1] != '_':
+            try:
+                elsewhere = _RESOLUTION_CACHE[_GA(self, '__class__')][propname]
+            except KeyError:
+                elsewhere = resolves_elsewhere(_GA(self, '__class__'), propname)
+            if elsewhere:
+                # not defined on the model; unless set on this instance
+                # (like database field values are), go straight to the
+                # typeclass.
+                selfdict = _GA(self, '__dict__')
+                if propname in selfdict:
+                    return selfdict[propname]
+                return _GA(_GA(self, 'typeclass'), propname)
         try:
             return _GA(self, propname)
         except AttributeError:
@@ -1197,6 +1411,8 @@ class TypedObject(SharedMemoryModel):
         # this will automatically use a default class if
         # there is an error with the given typeclass.
         new_typeclass = self.typeclass
+        # the class may have been changed since its lookups were resolved
+        clear_resolution_cache(new_typeclass.__class__)
         if self.typeclass_path != new_typeclass.path and no_default:
             # something went wrong; the default was loaded instead,
             # and we don't allow that; instead we return to previous.
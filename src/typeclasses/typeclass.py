@@ -12,7 +12,7 @@ used by the typesystem or django itself.
 
 from src.utils.logger import log_trace, log_errmsg
 
-__all__ = ("TypeClass",)
+__all__ = ("TypeClass", "resolves_elsewhere", "clear_resolution_cache")
 
 # these are called so many times it's worth to avoid lookup calls
 _GA = object.__getattribute__
@@ -33,6 +33,39 @@ PROTECTED = ('id', 'dbobj', 'db', 'ndb', 'objects', 'typeclass', 'db_player',
 # If this is true, all non-protected property assignments
 # are directly stored to a database attribute
 
+# Resolution table {class: {propname: bool}}, recording if a property
+# name is defined on a class (or its parents) or not. If not, the
+# typeclass and its dbobj can relay lookups of it to each other
+# directly, instead of first trying (and failing) a normal lookup.
+_RESOLUTION_CACHE = {}
+
+
+def resolves_elsewhere(cls, propname):
+    """
+    Check if propname is not defined on the class cls nor any of its
+    parents. An instance of cls can then only have it in its __dict__;
+    otherwise it must be looked up elsewhere. The result is cached.
+    """
+    try:
+        return _RESOLUTION_CACHE[cls][propname]
+    except KeyError:
+        elsewhere = not any(propname in _GA(klass, "__dict__")
+                            for klass in _GA(cls, "__mro__"))
+        _RESOLUTION_CACHE.setdefault(cls, {})[propname] = elsewhere
+        return elsewhere
+
+
+def clear_resolution_cache(cls=None):
+    """
+    Clear the resolution table for cls, or for all classes if
+    not given. Use this if a class is changed on the fly.
+    """
+    if cls:
+        _RESOLUTION_CACHE.pop(cls, None)
+    else:
+        _RESOLUTION_CACHE.clear()
+
+
 class MetaTypeClass(type):
     """
     This metaclass just makes sure the class object gets
@@ -104,18 +137,29 @@ class TypeClass(object):
             return _GA(self, propname)
         #print "get %s (dbobj:%s)" % (propname, type(dbobj))
         try:
-            return _GA(self, propname)
-        except AttributeError:
+            elsewhere = _RESOLUTION_CACHE[_GA(self, '__class__')][propname]
+        except KeyError:
+            elsewhere = resolves_elsewhere(_GA(self, '__class__'), propname)
+        if elsewhere:
+            # not defined on the class; go straight to the dbobj
+            # unless it was set on this instance.
+            selfdict = _GA(self, '__dict__')
+            if propname in selfdict:
+                return selfdict[propname]
+            dbobj = selfdict.get('dbobj')
+        else:
             try:
-                dbobj = _GA(self, 'dbobj')
+                return _GA(self, propname)
             except AttributeError:
-                log_trace("Typeclass CRITICAL ERROR! dbobj not found for Typeclass %s!" % self)
-                raise
-            try:
-                return _GA(dbobj, propname)
-            except AttributeError:
-                string = "Object: '%s' not found on %s(#%s), nor on its typeclass %s."
-                raise AttributeError(string % (propname, dbobj, _GA(dbobj, "dbid"), _GA(dbobj, "typeclass_path")))
+                dbobj = _GA(self, '__dict__').get('dbobj')
+        if dbobj is None:
+            log_trace("Typeclass CRITICAL ERROR! dbobj not found for Typeclass %s!" % self)
+            raise AttributeError("dbobj")
+        try:
+            return _GA(dbobj, propname)
+        except AttributeError:
+            string = "Object: '%s' not found on %s(#%s), nor on its typeclass %s."
+            raise AttributeError(string % (propname, dbobj, _GA(dbobj, "dbid"), _GA(dbobj, "typeclass_path")))
 
     def __setattr__(self, propname, value):
         """
@@ -130,19 +174,21 @@ class TypeClass(object):
             string += " (protected: [%s])" % (", ".join(PROTECTED))
             log_errmsg(string % (self.name, propname))
             return
-        try:
-            _GA(self, propname)
-            _SA(self, propname, value)
-        except AttributeError:
+        selfdict = _GA(self, '__dict__')
+        if (propname in selfdict
+                or not resolves_elsewhere(_GA(self, '__class__'), propname)):
             try:
-                dbobj = _GA(self, 'dbobj')
-            except AttributeError:
-                dbobj = None
-            if dbobj:
-                _SA(dbobj, propname, value)
-            else:
-                # only as a last resort do we save on the typeclass object
+                _GA(self, propname)
                 _SA(self, propname, value)
+                return
+            except AttributeError:
+                pass
+        dbobj = selfdict.get('dbobj')
+        if dbobj:
+            _SA(dbobj, propname, value)
+        else:
+            # only as a last resort do we save on the typeclass object
+            _SA(self, propname, value)
 
     def __eq__(self, other):
         """
@@ -20,11 +20,13 @@ be out of sync with the database.
 """
 
 from functools import update_wrapper
+from datetime import datetime, date, time, timedelta
 from collections import defaultdict, MutableSequence, MutableSet, MutableMapping
 try:
     from cPickle import dumps, loads
 except ImportError:
     from pickle import dumps, loads
+from django.conf import settings
 from django.db import transaction
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.contenttypes.models import ContentType
@@ -35,6 +37,7 @@ from src.utils import logger
 __all__ = ("to_pickle", "from_pickle", "do_pickle", "do_unpickle")
 
 PICKLE_PROTOCOL = 2
+_DEFER_MUTABLE_SAVES = settings.ATTRIBUTE_DEFER_MUTABLE_SAVES
 
 # initialization and helpers
 
@@ -78,6 +81,57 @@ def _init_globals():
 # SaverList, SaverDict, SaverSet - Attribute-specific helper classes and functions
 #
 
+# root mutables changed in-place but not yet saved, stored as
+# {id(attr): (attr, root)} where attr is the Attribute to save to
+# (Attributes themselves are not hashable once deleted)
+_UNSAVED_MUTABLES = {}
+_UNSAVED_FLUSH_CALL = None
+
+
+def unsaved_mutable(db_obj):
+    """
+    Returns the root mutable changed in-place but not yet saved to
+    db_obj (normally an Attribute), or None. This is more up-to-date
+    than what is stored on db_obj.
+    """
+    unsaved = _UNSAVED_MUTABLES.get(id(db_obj))
+    return unsaved[1] if unsaved else None
+
+
+def discard_unsaved_mutable(db_obj):
+    "Forget unsaved changes to db_obj, such as when it gets a new value"
+    _UNSAVED_MUTABLES.pop(id(db_obj), None)
+
+
+def flush_unsaved_mutables():
+    """
+    Save all root mutables changed in-place since the last flush. This
+    is called automatically at the end of the reactor iteration in which
+    they changed (with settings.ATTRIBUTE_DEFER_MUTABLE_SAVES), so that
+    many changes to the same value only cause one save.
+    """
+    global _UNSAVED_FLUSH_CALL
+    if _UNSAVED_FLUSH_CALL and _UNSAVED_FLUSH_CALL.active():
+        _UNSAVED_FLUSH_CALL.cancel()
+    _UNSAVED_FLUSH_CALL = None
+    while _UNSAVED_MUTABLES:
+        db_obj, root = _UNSAVED_MUTABLES.popitem()[1]
+        if db_obj.pk:
+            # deleted Attributes have no pk
+            try:
+                db_obj.value = root
+            except Exception:
+                logger.log_trace()
+
+
+def _defer_save(root):
+    "Mark a root mutable as changed, to be saved later"
+    global _UNSAVED_FLUSH_CALL
+    _UNSAVED_MUTABLES[id(root._db_obj)] = (root._db_obj, root)
+    if not _UNSAVED_FLUSH_CALL:
+        from twisted.internet import reactor
+        _UNSAVED_FLUSH_CALL = reactor.callLater(0, flush_unsaved_mutables)
+
 
 def _save(method):
     "method decorator that saves data to Attribute"
@@ -107,7 +161,10 @@ class _SaverMutable(object):
         if self._parent:
             self._parent._save_tree()
         elif self._db_obj:
-            self._db_obj.value = self
+            if _DEFER_MUTABLE_SAVES:
+                _defer_save(self)
+            else:
+                self._db_obj.value = self
         else:
             logger.log_errmsg("_SaverMutable %s has no root Attribute to save to." % self)
 
@@ -223,18 +280,28 @@ def pack_dbobj(item):
                              _TO_DATESTRING(obj), _GA(obj, "id")) or item
 
 
-def unpack_dbobj(item):
+def unpack_dbobj(item, found=None):
     """
     Check and convert internal representations back to Django database models.
     The fact that item is a packed dbobj should be checked before this call.
     This either returns the original input or converts the internal store back
     to a database representation (its typeclass is returned if applicable).
+
+    found - optional dict {(natural_key, id): dbobj} of already fetched
+            objects, as created by _fetch_dbobjs. dbobj is None for
+            objects that were looked for but don't exist.
     """
     _init_globals()
-    try:
-        obj = item[3] and _TO_TYPECLASS(_TO_MODEL_MAP[item[1]].objects.get(id=item[3]))
-    except ObjectDoesNotExist:
-        return None
+    if found is not None and (item[1], item[3]) in found:
+        obj = found[(item[1], item[3])]
+        if obj is None:
+            return None
+        obj = _TO_TYPECLASS(obj)
+    else:
+        try:
+            obj = item[3] and _TO_TYPECLASS(_TO_MODEL_MAP[item[1]].objects.get(id=item[3]))
+        except ObjectDoesNotExist:
+            return None
     # even if we got back a match, check the sanity of the date (some
     # databases may 're-use' the id)
     try:
@@ -243,6 +310,99 @@ def unpack_dbobj(item):
         dbobj = obj
     return _TO_DATESTRING(dbobj) == item[2] and obj or None
 
+
+def _fetch_dbobjs(data):
+    """
+    Find all packed dbobjs in data and fetch their database objects,
+    from the idmapper cache when possible and otherwise with one
+    query per model. Returns a dict {(natural_key, id): dbobj}, where
+    dbobj is None if the object does not exist.
+    """
+    _init_globals()
+    wanted = defaultdict(set)
+
+    def find(item):
+        "Recursively gather packed dbobjs"
+        if _IS_PACKED_DBOBJ(item):
+            if item[3]:
+                wanted[item[1]].add(item[3])
+        elif isinstance(item, dict):
+            for key, val in item.items():
+                find(key)
+                find(val)
+        elif isinstance(item, (tuple, list, set, frozenset)):
+            for val in item:
+                find(val)
+    find(data)
+
+    found = {}
+    for natural_key, ids in wanted.items():
+        model = _TO_MODEL_MAP[natural_key]
+        if not model:
+            continue
+        get_cached = getattr(model, "get_cached_instance", None)
+        missing = []
+        for dbid in ids:
+            dbobj = get_cached(dbid) if get_cached else None
+            if dbobj is None:
+                missing.append(dbid)
+            else:
+                found[(natural_key, dbid)] = dbobj
+        if missing:
+            for dbid in missing:
+                found[(natural_key, dbid)] = None
+            for dbobj in model.objects.filter(id__in=missing):
+                found[(natural_key, _GA(dbobj, "id"))] = dbobj
+    return found
+
+
+def typeclass_path_of(dbobj):
+    "Get the typeclass path of dbobj, or None if it has no typeclass"
+    try:
+        return _GA(dbobj, "db_typeclass_path")
+    except AttributeError:
+        return None
+
+
+def is_current_dbobj(dbobj, typeclass_path=None):
+    """
+    Check if a database object fetched earlier is still usable, i.e.
+    it was not deleted and is still the instance in the idmapper cache.
+    If typeclass_path is given, it must also still have that typeclass
+    (a swapped typeclass means a new typeclass instance).
+    """
+    dbid = _GA(dbobj, "id")
+    if not dbid:
+        return False
+    if typeclass_path is not None and typeclass_path_of(dbobj) != typeclass_path:
+        return False
+    get_cached = getattr(dbobj.__class__, "get_cached_instance", None)
+    return not get_cached or get_cached(dbid) is dbobj
+
+
+_IMMUTABLE_TYPES = (basestring, int, long, float, bool, complex, type(None),
+                    datetime, date, time, timedelta)
+
+
+def is_cacheable_value(value):
+    """
+    Check if an unpickled value (as returned by from_pickle) can be
+    handed out again on later reads. This is the case if it can't be
+    changed in-place without the change being saved, so it may only
+    contain immutables, database objects and _Saver* mutables (whose
+    changes are saved).
+    """
+    if isinstance(value, _IMMUTABLE_TYPES) or hasattr(value, "dbobj"):
+        return True
+    elif isinstance(value, (tuple, frozenset)):
+        return all(is_cacheable_value(val) for val in value)
+    elif isinstance(value, _SaverDict):
+        return all(is_cacheable_value(key) and is_cacheable_value(val)
+                   for key, val in value._data.items())
+    elif isinstance(value, (_SaverList, _SaverSet)):
+        return all(is_cacheable_value(val) for val in value._data)
+    return False
+
 #
 # Access methods
 #
@@ -279,7 +439,7 @@ def to_pickle(data):
 
 
 #@transaction.autocommit
-def from_pickle(data, db_obj=None):
+def from_pickle(data, db_obj=None, dbobjs=None):
     """
     This should be fed a just de-pickled data object. It will be converted back
     to a form that may contain database objects again. Note that if a database
@@ -294,7 +454,14 @@ def from_pickle(data, db_obj=None):
     If db_obj is given, this function will convert lists, dicts and sets
     to their _SaverList, _SaverDict and _SaverSet counterparts.
 
+    dbobjs - optional list; all database objects found in data are
+             added to it.
+
     """
+    found = _fetch_dbobjs(data)
+    if dbobjs is not None:
+        dbobjs.extend(dbobj for dbobj in found.values() if dbobj is not None)
+
     def process_item(item):
         "Recursive processor and identification of data"
         dtype = type(item)
@@ -302,7 +469,7 @@ def from_pickle(data, db_obj=None):
             return item
         elif _IS_PACKED_DBOBJ(item):
             # this must be checked before tuple
-            return unpack_dbobj(item)
+            return unpack_dbobj(item, found)
         elif dtype == tuple:
             return tuple(process_item(val) for val in item)
         elif dtype == dict:
@@ -325,7 +492,7 @@ def from_pickle(data, db_obj=None):
             return item
         elif _IS_PACKED_DBOBJ(item):
             # this must be checked before tuple
-            return unpack_dbobj(item)
+            return unpack_dbobj(item, found)
         elif dtype == tuple:
             return tuple(process_tree(val, item) for val in item)
         elif dtype == list:
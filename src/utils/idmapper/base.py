@@ -4,23 +4,30 @@ Django ID mapper
 Modified for Evennia by making sure that no model references
 leave caching unexpectedly (no use of WeakRefs).
 
-Also adds cache_size() for monitoring the size of the cache.
+Also adds cache_size() for monitoring the size of the cache, and
+caps the number of instances cached per model (see InstanceCache).
+
+Field changes made through the db_* wrapper properties can be
+saved together rather than one by one, see deferred_saves().
 """
 
-import os, threading, gc, time
+import os, threading, gc
+from collections import OrderedDict
+from contextlib import contextmanager
 #from twisted.internet import reactor
 #from twisted.internet.threads import blockingCallFromThread
 from weakref import WeakValueDictionary
 from twisted.internet.reactor import callFromThread
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist, FieldError
+from django.db import transaction
 from django.db.models.base import Model, ModelBase
 from django.db.models.signals import post_save, pre_delete, post_syncdb
-from src.utils import logger
 from src.utils.utils import dbref, get_evennia_pids, to_str
 
 from manager import SharedMemoryManager
 
-AUTO_FLUSH_MIN_INTERVAL = 60.0 * 5 # at least 5 mins between cache flushes
+_MAX_INSTANCES = settings.IDMAPPER_CACHE_MAX_INSTANCES
 
 _GA = object.__getattribute__
 _SA = object.__setattr__
@@ -39,6 +46,176 @@ _SERVER_PID, _PORTAL_PID = get_evennia_pids()
 _IS_SUBPROCESS = (_SERVER_PID and _PORTAL_PID) and not _SELF_PID in (_SERVER_PID, _PORTAL_PID)
 _IS_MAIN_THREAD = threading.currentThread().getName() == "MainThread"
 
+# field saves waiting for the end of a deferred_saves block,
+# stored as {id(instance): (instance, set(fieldnames))}
+_DEFERRED_DEPTH = 0
+_DEFERRED_SAVES = OrderedDict()
+
+class InstanceCache(OrderedDict):
+    """
+    The per-model cache of instances, mapping pk:instance.
+
+    If given a maxsize, the cache drops instances when it grows beyond
+    it, using the CLOCK ("second chance") algorithm: instances are
+    kept in insertion order and each lookup marks its instance as
+    referenced. When room is needed, the oldest instance is dropped
+    unless it was referenced since it was last checked (then it
+    gets another round) or it is pinned (see
+    SharedMemoryModel._idmapper_pinned). This approximates LRU
+    without having to reorder the cache on every lookup. If a full
+    pass finds too few instances to drop, the cache is allowed to
+    grow by a tenth of its maxsize before the next attempt, so a
+    cache full of pinned instances is not scanned on every add.
+
+    An evicted instance is no longer kept in sync with the database;
+    the next lookup fetches a new instance. Code holding on to model
+    instances past the current operation must therefore only do so
+    for instances that are pinned.
+
+    The cache also counts lookup hits and misses as well as the
+    number of instances evicted, for monitoring.
+    """
+    def __init__(self, maxsize=None):
+        super(InstanceCache, self).__init__()
+        self.maxsize = maxsize
+        self.referenced = set()
+        # size below which no eviction is attempted after a failed pass
+        self.backoff_size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        "Look up an instance, marking it as recently used"
+        try:
+            instance = self[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.referenced.add(key)
+        return instance
+
+    def add(self, key, instance):
+        "Cache an instance, evicting old ones if the cache is full"
+        self[key] = instance
+        size = len(self)
+        if self.maxsize and size > self.maxsize and size > self.backoff_size:
+            self.evict(size - self.maxsize)
+
+    def evict(self, num):
+        """
+        Drop (up to) num instances from the cache. Stops if
+        every instance in the cache has been checked without
+        finding enough to drop, then backs off until the cache
+        has grown some more.
+        """
+        referenced = self.referenced
+        nchecked, nmax = 0, len(self)
+        while num > 0 and nchecked < nmax:
+            key = next(iter(self))
+            instance = self[key]
+            nchecked += 1
+            pinned = key in referenced or instance._idmapper_pinned()
+            del self[key]
+            if pinned:
+                # give it another round at the end of the line
+                self[key] = instance
+            else:
+                num -= 1
+                self.evictions += 1
+        if num > 0:
+            self.backoff_size = len(self) + max(1, (self.maxsize or 0) // 10)
+        else:
+            self.backoff_size = 0
+
+    def __delitem__(self, key):
+        super(InstanceCache, self).__delitem__(key)
+        self.referenced.discard(key)
+
+    def clear(self):
+        super(InstanceCache, self).clear()
+        self.referenced.clear()
+
+    def stats(self):
+        "Return (size, maxsize, hits, misses, evictions)"
+        return len(self), self.maxsize, self.hits, self.misses, self.evictions
+
+
+def _save_field(instance, fname):
+    """
+    Save a field changed through a wrapper property. Inside a
+    deferred_saves block this only notes the field as changed.
+    """
+    # only use explicit update_fields in save if we actually have a
+    # primary key assigned already (won't be set when first creating object)
+    if _GA(instance, "_get_pk_val")(_GA(instance, "_meta")) is None:
+        _GA(instance, "save")(update_fields=None)
+    elif _DEFERRED_DEPTH:
+        try:
+            _DEFERRED_SAVES[id(instance)][1].add(fname)
+        except KeyError:
+            _DEFERRED_SAVES[id(instance)] = (instance, set([fname]))
+    else:
+        _GA(instance, "save")(update_fields=[fname])
+
+
+def flush_deferred_saves():
+    """
+    Save all field changes noted so far inside a deferred_saves
+    block, with one save per instance. This is called automatically
+    when the outermost block ends.
+    """
+    with transaction.atomic():
+        while _DEFERRED_SAVES:
+            instance, fieldnames = _DEFERRED_SAVES.popitem(last=False)[1]
+            if (_GA(instance, "_get_pk_val")(_GA(instance, "_meta")) is None
+                    or getattr(instance, "_is_deleted", False)):
+                # deleted while its save was pending
+                continue
+            _GA(instance, "save")(update_fields=list(fieldnames))
+
+
+@contextmanager
+def deferred_saves():
+    """
+    Context manager for coalescing field saves. Inside the block,
+    assigning to the db_* wrapper properties (like obj.key = "foo")
+    updates the instance but does not save it right away. When the
+    (outermost) block ends, each changed instance is saved once,
+    with all its changed fields, and all inside one transaction.
+
+        from src.utils.idmapper.base import deferred_saves
+
+        with deferred_saves():
+            obj.key = "box"
+            obj.home = room
+            obj.desc = "A box."
+
+    If the block raises an exception, the pending saves are dropped
+    (the changed instances then differ from the database until saved
+    again) and the exception is passed on.
+
+    Since the save signals are only sent at the end, the _at_*_postsave
+    handlers and OOB trackers are notified then, and only see the
+    final value of each field. Database queries made inside the block
+    (like searches) also see the old values. Assigning to db_* fields
+    directly and then calling save() is not affected.
+    """
+    global _DEFERRED_DEPTH
+    _DEFERRED_DEPTH += 1
+    try:
+        yield
+    except:
+        _DEFERRED_DEPTH -= 1
+        if not _DEFERRED_DEPTH:
+            _DEFERRED_SAVES.clear()
+        raise
+    _DEFERRED_DEPTH -= 1
+    if not _DEFERRED_DEPTH:
+        flush_deferred_saves()
+
+
 class SharedMemoryModelBase(ModelBase):
     # CL: upstream had a __new__ method that skipped ModelBase's __new__ if
     # SharedMemoryModelBase was not in the model class's ancestors. It's not
@@ -68,7 +245,7 @@ class SharedMemoryModelBase(ModelBase):
 
 
     def _prepare(cls):
-        cls.__instance_cache__ = {}
+        cls.__instance_cache__ = InstanceCache(maxsize=_MAX_INSTANCES)
         cls._idmapper_recache_protection = False
         super(SharedMemoryModelBase, cls)._prepare()
 
@@ -107,10 +284,7 @@ class SharedMemoryModelBase(ModelBase):
                 if _GA(cls, "_is_deleted"):
                     raise ObjectDoesNotExist("Cannot set %s to %s: Hosting object was already deleted!" % (fname, value))
                 _SA(cls, fname, value)
-                # only use explicit update_fields in save if we actually have a
-                # primary key assigned already (won't be set when first creating object)
-                update_fields = [fname] if _GA(cls, "_get_pk_val")(_GA(cls, "_meta")) is not None else None
-                _GA(cls, "save")(update_fields=update_fields)
+                _save_field(cls, fname)
             def _set_foreign(cls, fname, value):
                 "Setter only used on foreign key relations, allows setting with #dbref"
                 if _GA(cls, "_is_deleted"):
@@ -134,18 +308,14 @@ class SharedMemoryModelBase(ModelBase):
                                 # maybe it is just a name that happens to look like a dbid
                                 pass
                 _SA(cls, fname, value)
-                # only use explicit update_fields in save if we actually have a
-                # primary key assigned already (won't be set when first creating object)
-                update_fields = [fname] if _GA(cls, "_get_pk_val")(_GA(cls, "_meta")) is not None else None
-                _GA(cls, "save")(update_fields=update_fields)
+                _save_field(cls, fname)
             def _del_nonedit(cls, fname):
                 "wrapper for not allowing deletion"
                 raise FieldError("Field %s cannot be edited." % fname)
             def _del(cls, fname):
                 "Wrapper for clearing database field - sets it to None"
                 _SA(cls, fname, None)
-                update_fields = [fname] if _GA(cls, "_get_pk_val")(_GA(cls, "_meta")) is not None else None
-                _GA(cls, "save")(update_fields=update_fields)
+                _save_field(cls, fname)
 
             # wrapper factories
             fget = lambda cls: _get(cls, fieldname)
@@ -234,9 +404,13 @@ class SharedMemoryModel(Model):
         """
         Method to store an instance in the cache.
         """
-        if instance._get_pk_val() is not None:
-
-            cls.__instance_cache__[instance._get_pk_val()] = instance
+        pk = instance._get_pk_val()
+        if pk is not None:
+            cache = cls.__instance_cache__
+            if isinstance(cache, InstanceCache):
+                cache.add(pk, instance)
+            else:
+                cache[pk] = instance
     cache_instance = classmethod(cache_instance)
 
     def get_all_cached_instances(cls):
@@ -270,16 +444,25 @@ class SharedMemoryModel(Model):
         "set if this instance should be allowed to be recached."
         cls._idmapper_recache_protection = bool(mode)
 
+    def _idmapper_pinned(cls):
+        """
+        If this returns True, this instance will not be evicted
+        from a full cache. Overload to pin instances in use.
+        """
+        return _GA(cls, "_idmapper_recache_protection")
+
     def flush_instance_cache(cls, force=False):
         """
         This will clean safe objects from the cache. Use force
         keyword to remove all objects, safe or not.
         """
+        cache = cls.__instance_cache__
         if force:
-            cls.__instance_cache__ = {}
+            cache.clear()
         else:
-            cls.__instance_cache__ = dict((key, obj) for key, obj in cls.__instance_cache__.items()
-                                                      if obj._idmapper_recache_protection)
+            for key, obj in cache.items():
+                if not obj._idmapper_recache_protection:
+                    del cache[key]
     flush_instance_cache = classmethod(flush_instance_cache)
 
     def save(cls, *args, **kwargs):
@@ -370,69 +553,6 @@ def update_cached_instance(sender, instance, **kwargs):
 post_save.connect(update_cached_instance)
 
 
-LAST_FLUSH = None
-def conditional_flush(max_rmem, force=False):
-    """
-    Flush the cache if the estimated memory usage exceeds max_rmem.
-
-    The flusher has a timeout to avoid flushing over and over
-    in particular situations (this means that for some setups
-    the memory usage will exceed the requirement and a server with
-    more memory is probably required for the given game)
-
-    force - forces a flush, regardless of timeout.
-    """
-    global LAST_FLUSH
-
-    def mem2cachesize(desired_rmem):
-        """
-        Estimate the size of the idmapper cache based on the memory
-        desired. This is used to optionally cap the cache size.
-
-        desired_rmem - memory in MB (minimum 50MB)
-
-        The formula is empirically estimated from usage tests (Linux)
-        and is
-            Ncache = RMEM - 35.0 / 0.0157
-        where RMEM is given in MB and Ncache is the size of the cache
-        for this memory usage. VMEM tends to be about 100MB higher
-        than RMEM for large memory usage.
-        """
-        vmem = max(desired_rmem, 50.0)
-        Ncache = int(abs(float(vmem) - 35.0) / 0.0157)
-        return Ncache
-
-    if not max_rmem:
-        # auto-flush is disabled
-        return
-
-    now = time.time()
-    if not LAST_FLUSH:
-        # server is just starting
-        LAST_FLUSH = now
-        return
-
-    if ((now - LAST_FLUSH) < AUTO_FLUSH_MIN_INTERVAL) and not force:
-        # too soon after last flush.
-        logger.log_warnmsg("Warning: Idmapper flush called more than "\
-                            "once in %s min interval. Check memory usage." % (AUTO_FLUSH_MIN_INTERVAL/60.0))
-        return
-
-    if os.name == "nt":
-        # we can't look for mem info in Windows at the moment
-        return
-
-    # check actual memory usage
-    Ncache_max = mem2cachesize(max_rmem)
-    Ncache, _ = cache_size()
-    actual_rmem = float(os.popen('ps -p %d -o %s | tail -1' % (os.getpid(), "rss")).read()) / 1000.0  # resident memory
-
-    if Ncache >= Ncache_max and actual_rmem > max_rmem * 0.9:
-        # flush cache when number of objects in cache is big enough and our
-        # actual memory use is within 10% of our set max
-        flush_cache()
-        LAST_FLUSH = now
-
 def cache_size(mb=True):
     """
     Calculate statistics about the cache.
@@ -460,3 +580,24 @@ def cache_size(mb=True):
                 get_recurse(subclasses)
     get_recurse(SharedMemoryModel.__subclasses__())
     return numtotal[0], classdict
+
+
+def cache_stats():
+    """
+    Get usage statistics for the cache of each model.
+
+    Returns
+      {objclass:(size, maxsize, hits, misses, evictions), ...}
+    """
+    stats = {}
+    def get_recurse(submodels):
+        for submodel in submodels:
+            subclasses = submodel.__subclasses__()
+            if not subclasses:
+                cache = submodel.__instance_cache__
+                if isinstance(cache, InstanceCache):
+                    stats[submodel.__name__] = cache.stats()
+            else:
+                get_recurse(subclasses)
+    get_recurse(SharedMemoryModel.__subclasses__())
+    return stats
@@ -1,15 +1,78 @@
 from django.db.models.manager import Manager
+from django.db.models.query import QuerySet
 try:
     from django.db import router
 except:
     pass
 
+_GA = object.__getattribute__
+
+
+def _to_pk(value):
+    """
+    Convert a lookup value to the form used as key in the instance
+    cache. Returns None if this cannot be done.
+    """
+    if isinstance(value, (int, long)):
+        return value
+    if isinstance(value, basestring) and value.isdigit():
+        return int(value)
+    return None
+
+
+def _sort_by_ordering(instances, ordering):
+    """
+    Sort instances in-place the way the database would, given the
+    model's Meta.ordering. Returns False if the ordering is too
+    complex to reproduce here.
+    """
+    for field in reversed(ordering):
+        reverse = field.startswith("-")
+        fieldname = field.lstrip("-")
+        if not fieldname or "__" in fieldname or "?" in fieldname:
+            return False
+        if fieldname == "pk":
+            fieldname = "id"
+        instances.sort(key=lambda inst: _GA(inst, fieldname), reverse=reverse)
+    return True
+
+
+class SharedMemoryQuerySet(QuerySet):
+    """
+    A QuerySet that can answer a plain pk__in lookup from the
+    idmapper cache, only asking the database for the instances
+    not already cached. Any other use (including further
+    filtering of such a lookup) works like a normal QuerySet.
+    """
+    _idmapper_ids = None
+
+    def _fetch_all(self):
+        ids = self._idmapper_ids
+        if self._result_cache is None and ids is not None:
+            get_cached = self.model.get_cached_instance
+            instances, missing = [], []
+            for pk in ids:
+                instance = get_cached(pk)
+                if instance is None:
+                    missing.append(pk)
+                else:
+                    instances.append(instance)
+            if missing:
+                # a plain QuerySet, we don't want to loop back here
+                instances.extend(QuerySet(model=self.model, using=self._db).filter(pk__in=missing))
+            if _sort_by_ordering(instances, self.model._meta.ordering):
+                self._result_cache = instances
+        super(SharedMemoryQuerySet, self)._fetch_all()
+
 
 class SharedMemoryManager(Manager):
     # CL: this ensures our manager is used when accessing instances via
     # ForeignKey etc. (see docs)
     use_for_related_fields = True
 
+    def get_queryset(self):
+        return SharedMemoryQuerySet(model=self.model, using=self._db)
+
     # CL: in the dev version of django, ReverseSingleRelatedObjectDescriptor
     # will call us as:
     #     rel_obj = rel_mgr.using(db).get(**params)
@@ -34,7 +97,34 @@ class SharedMemoryManager(Manager):
             if key.endswith('__exact'):
                 key = key[:-len('__exact')]
             if key in ('pk', self.model._meta.pk.attname):
-                inst = self.model.get_cached_instance(kwargs[items[0]])
+                pk = _to_pk(kwargs[items[0]])
+                if pk is not None:
+                    inst = self.model.get_cached_instance(pk)
         if inst is None:
             inst = super(SharedMemoryManager, self).get(**kwargs)
         return inst
+
+    def filter(self, *args, **kwargs):
+        """
+        A filter on only pk__in (or id__in) is resolved from the
+        idmapper cache when the result is used, fetching only the
+        instances not already cached.
+        """
+        queryset = super(SharedMemoryManager, self).filter(*args, **kwargs)
+        if (not args and len(kwargs) == 1
+                and len(queryset.query.where.children) == 1):
+            # the latter makes sure this is not a related manager,
+            # whose queryset is already restricted by the relation.
+            key, value = kwargs.items()[0]
+            if (key in ('pk__in', '%s__in' % self.model._meta.pk.attname)
+                    and isinstance(value, (list, tuple, set, frozenset))):
+                ids, seen = [], set()
+                for pk in value:
+                    pk = _to_pk(pk)
+                    if pk is None:
+                        return queryset
+                    if pk not in seen:
+                        seen.add(pk)
+                        ids.append(pk)
+                queryset._idmapper_ids = ids
+        return queryset
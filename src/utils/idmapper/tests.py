@@ -1,7 +1,8 @@
 from django.test import TestCase
 
-from base import SharedMemoryModel
+from base import SharedMemoryModel, InstanceCache, deferred_saves
 from django.db import models
+from django.db.models.signals import post_save
 
 class Category(SharedMemoryModel):
     name = models.CharField(max_length=32)
@@ -19,6 +20,12 @@ class RegularArticle(models.Model):
     category = models.ForeignKey(Category)
     category2 = models.ForeignKey(RegularCategory)
 
+class Note(SharedMemoryModel):
+    # gets wrapper properties title and text
+    db_title = models.CharField(max_length=32)
+    db_text = models.CharField(max_length=32)
+    _is_deleted = False
+
 class SharedMemorysTest(TestCase):
     # TODO: test for cross model relation (singleton to regular)
     
@@ -66,5 +73,104 @@ class SharedMemorysTest(TestCase):
         pk = article.pk
         article.delete()
         self.assertEquals(pk not in Article.__instance_cache__, True)
-        
-        
\ No newline at end of file
+
+    def testCachedLookups(self):
+        articles = list(Article.objects.all())
+        pks = [article.pk for article in articles]
+        # all articles are cached, so no queries are needed
+        with self.assertNumQueries(0):
+            self.assertEquals(Article.objects.get(pk=pks[0]) is articles[0], True)
+            self.assertEquals(list(Article.objects.filter(id__in=pks)), articles)
+        # only the uncached article is fetched
+        Article.flush_cached_instance(articles[0])
+        with self.assertNumQueries(1):
+            self.assertEquals(len(Article.objects.filter(id__in=pks)), len(pks))
+
+    def testDeferredSaves(self):
+        note = Note.objects.create(db_title="old", db_text="old")
+        saved = []
+        def _post_save(sender, instance=None, update_fields=None, **kwargs):
+            saved.append(set(update_fields))
+        post_save.connect(_post_save, sender=Note)
+        try:
+            with deferred_saves():
+                note.title = "new"
+                note.text = "new"
+                note.title = "newer"
+                self.assertEquals(saved, [])
+                self.assertEquals(Note.objects.filter(id=note.id).values_list("db_title", flat=True)[0], "old")
+        finally:
+            post_save.disconnect(_post_save, sender=Note)
+        # one save for both fields
+        self.assertEquals(saved, [set(["db_title", "db_text"])])
+        self.assertEquals(list(Note.objects.filter(id=note.id).values_list("db_title", "db_text")),
+                          [("newer", "new")])
+
+    def testDeferredSavesError(self):
+        note = Note.objects.create(db_title="old", db_text="old")
+        def _fail():
+            with deferred_saves():
+                note.title = "new"
+                raise ValueError
+        self.assertRaises(ValueError, _fail)
+        # the pending save was dropped
+        self.assertEquals(Note.objects.filter(id=note.id).values_list("db_title", flat=True)[0], "old")
+
+class _Cached(object):
+    "Stand-in for a cached model instance"
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+    def _idmapper_pinned(self):
+        return self.pinned
+
+class InstanceCacheTest(TestCase):
+
+    def testEviction(self):
+        cache = InstanceCache(maxsize=3)
+        for key in xrange(3):
+            cache.add(key, _Cached())
+        cache.get(0)
+        cache.add(3, _Cached())
+        # 0 was recently used, so 1 is evicted
+        self.assertEquals(sorted(cache.keys()), [0, 2, 3])
+        self.assertEquals(cache.evictions, 1)
+
+    def testPinned(self):
+        cache = InstanceCache(maxsize=2)
+        cache.add(0, _Cached(pinned=True))
+        cache.add(1, _Cached(pinned=True))
+        cache.add(2, _Cached())
+        self.assertEquals(sorted(cache.keys()), [0, 1])
+        # all pinned; the cache grows beyond its size instead
+        cache.add(3, _Cached(pinned=True))
+        cache.add(4, _Cached(pinned=True))
+        self.assertEquals(sorted(cache.keys()), [0, 1, 3, 4])
+
+    def testBackoff(self):
+        cache = InstanceCache(maxsize=20)
+        for key in xrange(20):
+            cache.add(key, _Cached(pinned=True))
+        cache.add(20, _Cached(pinned=True))
+        # the failed pass is not repeated until the cache grew
+        cache.evict = lambda num: self.fail("evict should back off")
+        cache.add(21, _Cached(pinned=True))
+        self.assertEquals(len(cache), 22)
+
+    def testTypeclassed(self):
+        from src.utils import create
+        objs = [create.create_object("src.objects.objects.Object", key="Evictable%i" % n, nohome=True).dbobj
+                for n in xrange(3)]
+        # a loaded typeclass alone does not pin
+        self.assertEquals([obj._idmapper_pinned() for obj in objs], [False, False, False])
+        objs[0].ndb.test = True
+        cache = InstanceCache(maxsize=1)
+        for obj in objs:
+            cache.add(obj.id, obj)
+        self.assertEquals(cache.keys(), [objs[0].id])
+
+    def testCounters(self):
+        cache = InstanceCache()
+        cache.add(0, _Cached())
+        cache.get(0)
+        cache.get(1)
+        self.assertEquals(cache.stats(), (1, None, 1, 1, 0))
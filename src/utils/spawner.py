@@ -77,6 +77,7 @@ from django.conf import settings
 from random import randint
 from src.objects.models import ObjectDB
 from src.utils.create import handle_dbref
+from src.utils.idmapper.base import deferred_saves
 from src.utils.utils import make_iter, all_from_module
 
 _CREATE_OBJECT_KWARGS = ("key", "location", "home", "destination")
@@ -145,23 +146,27 @@ def _batch_create_object(*objparams):
         obj.basetype_setup()
         obj.at_object_creation()
 
-        if objparam[1]:
-            # permissions
-            obj.permissions.add(objparam[1])
-        if objparam[2]:
-            # locks
-            obj.locks.add(objparam[2])
-        if objparam[3]:
-            # aliases
-            obj.aliases.add(objparam[3])
-        if objparam[4]:
-            # nattributes
-            for key, value in objparam[4].items():
-                obj.nattributes.add(key, value)
-        if objparam[5]:
-            # attributes
-            keys, values = objparam[5].keys(), objparam[5].values()
-            obj.attributes.batch_add(keys, values)
+        # the fields set from the prototype are saved together. The
+        # hooks run outside this, so they see (and commit) their
+        # own changes as usual.
+        with deferred_saves():
+            if objparam[1]:
+                # permissions
+                obj.permissions.add(objparam[1])
+            if objparam[2]:
+                # locks
+                obj.locks.add(objparam[2])
+            if objparam[3]:
+                # aliases
+                obj.aliases.add(objparam[3])
+            if objparam[4]:
+                # nattributes
+                for key, value in objparam[4].items():
+                    obj.nattributes.add(key, value)
+            if objparam[5]:
+                # attributes
+                keys, values = objparam[5].keys(), objparam[5].values()
+                obj.attributes.batch_add(keys, values)
 
         obj.basetype_posthook_setup()
         objs.append(obj)
@@ -558,10 +558,8 @@ def clean_object_caches(obj):
         return
     obj = hasattr(obj, "dbobj") and obj.dbobj or obj
     # contents cache
-    try:
-        _SA(obj, "_contents_cache", None)
-    except AttributeError:
-        pass
+    if "contents_cache" in obj.__dict__:
+        obj.__dict__["contents_cache"].clear()
 
     # on-object property cache
     [_DA(obj, cname) for cname in obj.__dict__.keys()
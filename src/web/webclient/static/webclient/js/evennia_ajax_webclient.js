@@ -15,10 +15,14 @@ contain the 'mode' of the request to be handled by the protocol:
  mode 'receive' - tell the server that we are ready to receive data. This is a
                   long-polling (comet-style) request since the server
                   will not reply until it actually has data available.
-                  The returned data object has two variables 'msg' and 'data'
+                  The returned data is a list of all messages buffered since
+                  the last request, each with two variables 'msg' and 'data'
                   where msg should be output and 'data' is an arbitrary piece
                   of data the server and client understands (not used in default
                   client).
+ mode 'stream' - (GET) an alternative to 'receive', used if the server reports
+                 streaming as available on init. The server keeps the response
+                 open and pushes each list of messages as a server-sent event.
  mode 'input' - the user has input data on some form. The POST request
                 should also contain variables 'msg' and 'data' where
                 the 'msg' is a string and 'data' is an arbitrary piece
@@ -96,7 +100,7 @@ function webclient_receive(){
         // callback methods
 
         success: function(data){       // called when request to waitreceive completes
-            msg_display("out", data.msg);  // Add response to the message area
+            msg_display_all(data);         // Add response to the message area
             webclient_receive();              // immediately start a new request
         },
         error: function(XMLHttpRequest, textStatus, errorThrown){
@@ -105,6 +109,23 @@ function webclient_receive(){
     });
 };
 
+function webclient_stream(){
+    // Open a server-sent-events stream. The server pushes data to it as
+    // it arrives, so no further requests are needed. The browser will
+    // reconnect by itself if the connection is lost.
+
+    var stream = new EventSource("/webclientdata?mode=stream&suid=" + CLIENT_HASH);
+    stream.onmessage = function(event){
+        msg_display_all($.parseJSON(event.data));
+    };
+    stream.onerror = function(event){
+        if (stream.readyState == EventSource.CLOSED) {
+            // the server refused the stream; fall back to long-polling
+            webclient_receive();
+        }
+    };
+};
+
 function webclient_input(arg, no_update){
     // Send an input from the player to the server
     // no_update is used for sending idle messages behind the scenes.
@@ -162,7 +183,12 @@ function webclient_init(){
             msg_display('sys',"Connected to " + data.msg + ".");
 
             // Wait for input
-            webclient_receive();
+            if (data.stream && window.EventSource) {
+                webclient_stream();
+            }
+            else {
+                webclient_receive();
+            }
         },
         error: function(XMLHttpRequest, textStatus, errorThrown){
             msg_display("err", "Connection error ..." + " (" + errorThrown + ")");
@@ -204,6 +230,16 @@ function msg_display(type, msg){
     $('#messagewindow').animate({scrollTop: $('#messagewindow')[0].scrollHeight});
 }
 
+function msg_display_all(data){
+    // Display a list of messages from the server (or a single one).
+    if (!$.isArray(data)) {
+        data = [data];
+    }
+    for (var i = 0; i < data.length; i++) {
+        msg_display("out", data[i].msg);
+    }
+}
+
 // Input history mechanism
 
 var HISTORY_MAX_LENGTH = 21